@@ -0,0 +1,559 @@
+#!/usr/bin/python
+"""
+Headless multi-client load generator.
+
+Simulates a number of clients typing into a number of documents,
+speaking ctxt.protocol directly (no Qt involved), and reports
+throughput, commit fan-out latency and the resource usage of
+the server process.
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+import random
+import select
+import socket
+import string
+import subprocess
+import sys
+import time
+
+import ctxt.protocol as cp
+
+
+class ServerProcess():
+	"""
+	Samples CPU time and memory of a (local) server process from /proc.
+	"""
+	def __init__(self, pid):
+		self.pid = pid
+		self.ticks = float(os.sysconf("SC_CLK_TCK")) if hasattr(os, "sysconf") else 100.0
+		self.peak_rss = 0
+		self.cpu_start = self.get_cpu()
+		self.t_start = time.time()
+
+	def get_cpu(self):
+		"""
+		Get user + system CPU time (seconds) of the process.
+		"""
+		try:
+			with open("/proc/{}/stat".format(self.pid)) as f:
+				# The command name may contain spaces, skip past it.
+				fields = f.read().rsplit(")", 1)[1].split()
+			return (int(fields[11]) + int(fields[12])) / self.ticks
+		except (IOError, OSError, IndexError, ValueError):
+			return None
+
+	def get_rss(self):
+		"""
+		Get resident set size (bytes) of the process.
+		"""
+		try:
+			with open("/proc/{}/status".format(self.pid)) as f:
+				for line in f:
+					if line.startswith("VmRSS:"):
+						return int(line.split()[1]) * 1024
+		except (IOError, OSError, ValueError):
+			pass
+		return None
+
+	def sample(self):
+		"""
+		Periodic sample, to keep track of the peak memory usage.
+		"""
+		rss = self.get_rss()
+		if rss != None:
+			self.peak_rss = max(self.peak_rss, rss)
+
+	def report(self):
+		cpu = self.get_cpu()
+		elapsed = time.time() - self.t_start
+		res = {
+				"pid": self.pid,
+				"rss_bytes": self.get_rss(),
+				"peak_rss_bytes": self.peak_rss or None,
+				"cpu_seconds": None,
+				"cpu_percent": None,
+				}
+		if cpu != None and self.cpu_start != None:
+			res["cpu_seconds"] = cpu - self.cpu_start
+			res["cpu_percent"] = 100.0 * (cpu - self.cpu_start) / max(elapsed, 1e-9)
+		return res
+
+
+class SimClient():
+	"""
+	A simulated author connected to the server.
+	"""
+	STAT_CONNECTING = 0
+	STAT_JOINING = 1
+	STAT_LOADING = 2
+	STAT_EDITING = 3
+
+	def __init__(self, bench, index, docname, typing=True):
+		self.bench = bench
+		self.index = index
+		self.name = "bot{}".format(index)
+		self.docname = docname
+		self.typing = typing
+		self.rng = random.Random(bench.args.seed * 100003 + index)
+
+		self.socket = None
+		self.state = SimClient.STAT_CONNECTING
+		self.rx = bytearray()
+		self.tx = bytearray()
+		self.seq = 0
+		# Our idea of the document length (for picking cursors).
+		self.doc_len = 0
+		self.t_join = None
+		self.next_key = None
+		self.burst_left = 0
+
+	def connect(self, address, port):
+		self.socket = socket.create_connection((address, port), LoadBench.CONNECT_TIMEOUT)
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.socket.setblocking(0)
+		self.t_join = time.time()
+		self.state = SimClient.STAT_JOINING
+		flags = cp.Protocol.JOIN_CUMULATIVE_ACKS if self.bench.args.cumulative_acks else 0
+		self.send(cp.Protocol.req_join(self.name, self.docname, flags))
+
+	def fileno(self):
+		return self.socket.fileno()
+
+	def send(self, data):
+		self.tx += data
+		self.bench.bytes_out += len(data)
+		self.flush()
+
+	def flush(self):
+		"""
+		Write as much of the outbound buffer as the socket takes.
+		"""
+		try:
+			while len(self.tx) > 0:
+				n = self.socket.send(self.tx)
+				del self.tx[:n]
+		except socket.error as e:
+			if e.errno not in [errno.EWOULDBLOCK, errno.EAGAIN]:
+				raise
+
+	def on_readable(self):
+		"""
+		Read everything available and handle complete frames.
+		"""
+		while True:
+			try:
+				data = self.socket.recv(65536)
+			except socket.error as e:
+				if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN]:
+					break
+				raise
+			if len(data) == 0:
+				raise socket.error(errno.ECONNRESET, "Connection closed by server")
+			self.bench.bytes_in += len(data)
+			self.rx += data
+		now = time.time()
+		while len(self.rx) >= cp.Protocol.MIN_REQ_LEN:
+			r_len = cp.Protocol.get_len(self.rx[:cp.Protocol.MIN_REQ_LEN])
+			end = cp.Protocol.MIN_REQ_LEN + r_len
+			if len(self.rx) < end:
+				break
+			frame = bytes(self.rx[:end])
+			del self.rx[:end]
+			self.on_frame(cp.Protocol.unpack(frame), now)
+
+	def on_frame(self, d, now):
+		self.bench.frames_in += 1
+		if d["id"] in [cp.Protocol.RES_OK, cp.Protocol.RES_ACK]:
+			self.bench.acks_in += 1
+		if d["id"] == cp.Protocol.RES_OK:
+			if self.state == SimClient.STAT_JOINING and d["req_id"] == cp.Protocol.REQ_JOIN:
+				self.state = SimClient.STAT_LOADING
+				self.send(cp.Protocol.req_text())
+		elif d["id"] == cp.Protocol.RES_ERROR:
+			self.bench.errors += 1
+		elif d["id"] == cp.Protocol.RES_TEXT:
+			if self.state == SimClient.STAT_LOADING:
+				self.bench.join_latency.append(now - self.t_join)
+				self.state = SimClient.STAT_EDITING
+				self.next_key = now + self.rng.uniform(0, self.bench.args.think)
+			self.doc_len = len(d["text"])
+		elif d["id"] == cp.Protocol.RES_COMMIT:
+			for op in d["sequence"]:
+				self.bench.on_delivery(self, op, now)
+				if op["id"] == cp.Protocol.RES_INSERT:
+					self.doc_len += len(op["text"])
+				elif op["id"] == cp.Protocol.RES_REMOVE:
+					self.doc_len = max(0, self.doc_len - op["length"])
+
+	def tick(self, now):
+		"""
+		Type something, if it's time to.
+		"""
+		if not self.typing or self.state != SimClient.STAT_EDITING or now < self.next_key:
+			return
+		args = self.bench.args
+		if self.burst_left <= 0:
+			# Start a new burst of typing.
+			self.burst_left = max(1, int(self.rng.expovariate(1.0 / args.burst)))
+		self.burst_left -= 1
+
+		cursor = self.rng.randint(0, self.doc_len)
+		r = self.rng.random()
+		if r < args.paste_prob:
+			op = {"id": cp.Protocol.RES_INSERT, "cursor": cursor,
+					"text": self.bench.random_text(self.rng, args.paste_size)}
+			self.bench.pastes += 1
+		elif r < args.paste_prob + args.remove_prob and self.doc_len > 0:
+			op = {"id": cp.Protocol.RES_REMOVE, "cursor": max(0, cursor - 1), "length": 1}
+		else:
+			op = {"id": cp.Protocol.RES_INSERT, "cursor": cursor,
+					"text": self.bench.random_text(self.rng, 1)}
+		# Tag the operation, so that deliveries can be matched to it.
+		self.seq += 1
+		op["name"] = "{}#{}".format(self.name, self.seq)
+		self.bench.on_commit(self, op["name"], now)
+		self.send(cp.Protocol.res_commit(0, [op]))
+
+		if self.burst_left > 0:
+			self.next_key = now + self.rng.expovariate(1.0 / args.key_interval)
+		else:
+			self.next_key = now + self.rng.expovariate(1.0 / args.think)
+
+
+class LoadBench():
+	"""
+	The load generator itself.
+	"""
+	LOGNAME = "CT.Bench.Load"
+	# How long to wait for the server to accept a connection (s).
+	CONNECT_TIMEOUT = 10.0
+	TEXT_CHARS = string.ascii_letters + string.digits + u" \n.,\u00e4\u00f5\u20ac"
+
+	def __init__(self, args):
+		self.args = args
+		self.log = logging.getLogger(LoadBench.LOGNAME)
+		self.rng = random.Random(args.seed)
+
+		self.clients = []
+		# Send time and document of every commit, by tag.
+		self.sent = {}
+		self.fanout_latency = []
+		self.join_latency = []
+		self.commits = 0
+		self.deliveries = 0
+		self.misrouted = 0
+		self.echoes = 0
+		self.pastes = 0
+		self.errors = 0
+		self.disconnects = 0
+		self.connect_errors = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.frames_in = 0
+		self.acks_in = 0
+
+	def random_text(self, rng, length):
+		return u"".join(rng.choice(LoadBench.TEXT_CHARS) for _ in range(length))
+
+	def on_commit(self, client, tag, now):
+		self.commits += 1
+		self.sent[tag] = (now, client.docname)
+
+	def on_delivery(self, client, op, now):
+		sent = self.sent.get(op.get("name"))
+		if sent == None:
+			return
+		self.deliveries += 1
+		if sent[1] != client.docname:
+			# Not a document the client is interested in.
+			self.misrouted += 1
+			return
+		self.fanout_latency.append(now - sent[0])
+		if op["name"].split("#")[0] == client.name:
+			self.echoes += 1
+
+	def add_clients(self, count, typing=True):
+		for i in range(count):
+			index = len(self.clients)
+			docname = "bench-{}".format(index % self.args.docs)
+			client = SimClient(self, index, docname, typing)
+			try:
+				client.connect(self.args.address, self.args.port)
+			except socket.error as e:
+				self.log.warning("{} failed to connect: {}".format(client.name, e))
+				self.connect_errors += 1
+				continue
+			self.clients.append(client)
+
+	def run(self, server=None):
+		args = self.args
+		t_start = time.time()
+		t_end = t_start + args.ramp + args.duration
+		t_sample = t_start
+		storm_done = args.storm == 0
+
+		# Ramp the typists up (or join them all at once).
+		ramp_interval = float(args.ramp) / args.clients if args.clients > 0 else 0
+		joined = 0
+		t_measure = None
+
+		while True:
+			now = time.time()
+			if now >= t_end:
+				break
+			# Join the next clients, if it's their turn.
+			while joined < args.clients and (ramp_interval == 0 or now >= t_start + joined * ramp_interval):
+				self.add_clients(1)
+				joined += 1
+			if t_measure == None and joined == args.clients:
+				t_measure = time.time()
+			# A join storm of extra (silent) clients?
+			if not storm_done and now >= t_start + args.ramp + args.storm_at:
+				self.log.info("Join storm: {} clients".format(args.storm))
+				self.add_clients(args.storm, typing=False)
+				storm_done = True
+
+			self.poll(0.001)
+			now = time.time()
+			for client in list(self.clients):
+				try:
+					client.tick(now)
+				except socket.error as e:
+					self.drop(client, e)
+
+			if server != None and now - t_sample >= 0.5:
+				server.sample()
+				t_sample = now
+
+		# Let the last commits arrive.
+		t_drain = time.time() + args.drain
+		while time.time() < t_drain:
+			self.poll(0.01)
+
+		return self.report(time.time() - (t_measure or t_start), server)
+
+	def poll(self, timeout):
+		"""
+		Wait for any socket to become readable and service it.
+		"""
+		socks = [c for c in self.clients if c.socket != None]
+		if len(socks) == 0:
+			time.sleep(timeout)
+			return
+		writable = [c for c in socks if len(c.tx) > 0]
+		try:
+			readable, writable, _ = select.select(socks, writable, [], timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+		for client in writable:
+			try:
+				client.flush()
+			except socket.error as e:
+				self.drop(client, e)
+		for client in readable:
+			try:
+				client.on_readable()
+			except socket.error as e:
+				self.drop(client, e)
+
+	def drop(self, client, error):
+		self.log.warning("{} disconnected: {}".format(client.name, error))
+		self.disconnects += 1
+		client.socket.close()
+		client.socket = None
+		client.typing = False
+		self.clients.remove(client)
+
+	def report(self, elapsed, server):
+		lat = sorted(self.fanout_latency)
+		joins = sorted(self.join_latency)
+		res = {
+				"elapsed_seconds": elapsed,
+				"commits": self.commits,
+				"commits_per_second": self.commits / max(elapsed, 1e-9),
+				"deliveries": self.deliveries,
+				"deliveries_per_second": self.deliveries / max(elapsed, 1e-9),
+				"echoes": self.echoes,
+				"lost_commits": self.commits - self.echoes,
+				"misrouted_deliveries": self.misrouted,
+				"pastes": self.pastes,
+				"errors": self.errors,
+				"disconnects": self.disconnects,
+				"connect_errors": self.connect_errors,
+				"bytes_in": self.bytes_in,
+				"bytes_out": self.bytes_out,
+				"frames_in": self.frames_in,
+				"acks_in": self.acks_in,
+				"fanout_latency": summarize(lat),
+				"join_latency": summarize(joins),
+				"server": server.report() if server != None else None,
+				}
+		return res
+
+	def close(self):
+		for client in self.clients:
+			if client.socket != None:
+				client.socket.close()
+
+
+def percentile(values, q):
+	"""
+	Nearest-rank percentile of a sorted list.
+	"""
+	if len(values) == 0:
+		return None
+	k = max(0, min(len(values) - 1, int(round(q * len(values) + 0.5)) - 1))
+	return values[k]
+
+def summarize(values):
+	"""
+	Summary statistics of a sorted list of latencies (seconds).
+	"""
+	if len(values) == 0:
+		return {"count": 0}
+	return {
+			"count": len(values),
+			"mean": sum(values) / len(values),
+			"p50": percentile(values, 0.5),
+			"p99": percentile(values, 0.99),
+			"p999": percentile(values, 0.999),
+			"max": values[-1],
+			}
+
+# Metrics compared between runs, and whether higher is better.
+COMPARED = [
+		("commits_per_second", True),
+		("deliveries_per_second", True),
+		("fanout_latency.p50", False),
+		("fanout_latency.p99", False),
+		("fanout_latency.p999", False),
+		("join_latency.p50", False),
+		("join_latency.p99", False),
+		("server.cpu_percent", False),
+		("server.peak_rss_bytes", False),
+		]
+
+def lookup(results, path):
+	value = results
+	for key in path.split("."):
+		if not isinstance(value, dict):
+			return None
+		value = value.get(key)
+	return value
+
+def compare(baseline, results):
+	"""
+	Produce a human-readable comparison of two runs.
+	"""
+	lines = ["{:<28} {:>14} {:>14} {:>9}".format("metric", "baseline", "current", "change")]
+	for path, higher_better in COMPARED:
+		old = lookup(baseline, path)
+		new = lookup(results, path)
+		if old == None or new == None:
+			continue
+		change = (new - old) / float(old) * 100.0 if old != 0 else 0.0
+		better = (change > 0) == higher_better or change == 0
+		lines.append("{:<28} {:>14.6g} {:>14.6g} {:>+8.1f}%{}".format(
+			path, old, new, change, "" if better else " !"))
+	return "\n".join(lines)
+
+def spawn_server(args):
+	"""
+	Start a server in a scratch directory.
+	"""
+	workdir = args.workdir
+	storage = os.path.join(workdir, "storage")
+	if not os.path.isdir(storage):
+		os.makedirs(storage)
+	cmd = [sys.executable, "-m", "ctxt.server.server", "--port", str(args.port)]
+	env = dict(os.environ)
+	root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+	with open(os.path.join(workdir, "server_output.txt"), "w") as out:
+		proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT)
+	# Wait for the server to start listening.
+	for _ in range(100):
+		try:
+			socket.create_connection((args.address, args.port)).close()
+			break
+		except socket.error:
+			time.sleep(0.05)
+	return proc
+
+def stop_server(proc, timeout=5.0):
+	"""
+	Ask a spawned server to close, and kill it if it doesn't.
+	"""
+	proc.terminate()
+	t_end = time.time() + timeout
+	while proc.poll() == None and time.time() < t_end:
+		time.sleep(0.05)
+	if proc.poll() == None:
+		proc.kill()
+		proc.wait()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Collaborative Text Editor load generator")
+	parser.add_argument("-a", "--address", dest="address", type=str, default="127.0.0.1", help="server IP address")
+	parser.add_argument("-p", "--port", dest="port", type=int, default=7777, help="server port number")
+	parser.add_argument("-c", "--clients", dest="clients", type=int, default=10, help="number of typing clients")
+	parser.add_argument("-d", "--docs", dest="docs", type=int, default=1, help="number of documents")
+	parser.add_argument("-t", "--duration", dest="duration", type=float, default=10.0, help="measurement duration (s)")
+	parser.add_argument("--ramp", dest="ramp", type=float, default=1.0, help="time to join all typists (s), 0 for a join storm")
+	parser.add_argument("--storm", dest="storm", type=int, default=0, help="extra clients joining at once mid-run")
+	parser.add_argument("--storm-at", dest="storm_at", type=float, default=5.0, help="when the join storm hits (s)")
+	parser.add_argument("--burst", dest="burst", type=float, default=8.0, help="mean keystrokes per burst")
+	parser.add_argument("--key-interval", dest="key_interval", type=float, default=0.12, help="mean time between keystrokes (s)")
+	parser.add_argument("--think", dest="think", type=float, default=1.5, help="mean pause between bursts (s)")
+	parser.add_argument("--paste-prob", dest="paste_prob", type=float, default=0.002, help="probability of a keystroke being a paste")
+	parser.add_argument("--paste-size", dest="paste_size", type=int, default=20000, help="characters per paste")
+	parser.add_argument("--remove-prob", dest="remove_prob", type=float, default=0.1, help="probability of a keystroke being a backspace")
+	parser.add_argument("--drain", dest="drain", type=float, default=1.0, help="time to wait for late deliveries (s)")
+	parser.add_argument("--cumulative-acks", dest="cumulative_acks", action="store_true", help="have requests acknowledged cumulatively")
+	parser.add_argument("--seed", dest="seed", type=int, default=1, help="random seed")
+	parser.add_argument("--server-pid", dest="server_pid", type=int, default=0, help="PID of a local server to sample")
+	parser.add_argument("--spawn-server", dest="spawn", action="store_true", help="start a server for the run")
+	parser.add_argument("--workdir", dest="workdir", type=str, default="bench_server", help="working directory of a spawned server")
+	parser.add_argument("-o", "--output", dest="output", type=str, default="", help="write JSON results to a file")
+	parser.add_argument("--compare", dest="compare", type=str, default="", help="JSON results of a previous run to compare with")
+
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format="[%(levelname)s: %(name)s]\t%(message)s")
+	log = logging.getLogger(LoadBench.LOGNAME)
+
+	proc = None
+	if args.spawn:
+		proc = spawn_server(args)
+		args.server_pid = proc.pid
+
+	server = ServerProcess(args.server_pid) if args.server_pid != 0 else None
+	bench = LoadBench(args)
+	try:
+		results = bench.run(server)
+	finally:
+		bench.close()
+		if proc != None:
+			stop_server(proc)
+
+	output = {"config": vars(args), "results": results}
+	print(json.dumps(results, indent=2, sort_keys=True))
+	if args.output != "":
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent=2, sort_keys=True)
+		log.info("Results written to {}".format(args.output))
+	if args.compare != "":
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		print(compare(baseline.get("results", baseline), results))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,383 @@
+#!/usr/bin/python
+"""
+Microbenchmarks for the Protocol and Document hot paths.
+
+Every case runs with a fixed random seed, so that the numbers
+of two runs (e.g. before and after a codec or storage change)
+can be compared. Results can be saved as JSON and checked
+against a baseline with a regression threshold.
+"""
+import argparse
+import gc
+import json
+import logging
+import random
+import re
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+import ctxt.protocol as cp
+import ctxt.shared_document.document as cd
+import ctxt.util as cu
+
+try:
+	import tracemalloc
+except ImportError:
+	# Python 2 has no allocation tracking (without pytracemalloc).
+	tracemalloc = None
+try:
+	import resource
+except ImportError:
+	# Not on Windows.
+	resource = None
+
+KB = 1024
+MB = 1024 * KB
+
+TEXT_CHARS = string.ascii_letters + string.digits + u" \n.,\u00e4\u00f5\u20ac"
+
+
+def random_text(rng, length):
+	"""
+	Generate random text. Long texts repeat a random block,
+	as generating 100 MB character by character takes ages.
+	"""
+	block = u"".join(rng.choice(TEXT_CHARS) for _ in range(min(length, 64 * KB)))
+	if len(block) == 0:
+		return block
+	return (block * (length // len(block) + 1))[:length]
+
+def random_ops(rng, count, doc_len=1000, name=u"bench"):
+	"""
+	Generate a random sequence of insert and remove operations.
+	"""
+	ops = []
+	for _ in range(count):
+		if rng.random() < 0.7 or doc_len < 2:
+			text = random_text(rng, rng.randint(1, 8))
+			ops.append({"id": cp.Protocol.RES_INSERT, "name": name,
+				"cursor": rng.randint(0, doc_len), "text": text})
+			doc_len += len(text)
+		else:
+			length = rng.randint(1, min(8, doc_len))
+			ops.append({"id": cp.Protocol.RES_REMOVE, "name": name,
+				"cursor": rng.randint(0, doc_len - length), "length": length})
+			doc_len -= length
+	return ops
+
+def max_rss():
+	"""
+	Largest resident set of the process so far, in bytes
+	(Linux counts it in kilobytes, macOS in bytes).
+	"""
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == "darwin" else rss * KB
+
+def size_label(size):
+	if size >= MB:
+		return "{}MB".format(size // MB)
+	if size >= KB:
+		return "{}KB".format(size // KB)
+	return "{}B".format(size)
+
+
+class Case():
+	"""
+	A single benchmark case.
+	The setup function returns the state which is passed to the
+	benchmarked function, so that setup costs aren't measured.
+	"""
+	def __init__(self, name, setup, fn, ops=1):
+		self.name = name
+		self.setup = setup
+		self.fn = fn
+		# Operations per call (for per-op figures).
+		self.ops = ops
+
+
+class Runner():
+	"""
+	Runs the cases and collects their timings.
+	"""
+	LOGNAME = "CT.Bench.Micro"
+
+	def __init__(self, args):
+		self.args = args
+		self.log = logging.getLogger(Runner.LOGNAME)
+
+	def run_case(self, case):
+		"""
+		Time a case: calibrate the number of calls per repeat,
+		take the best and median of several repeats.
+		"""
+		random.seed(self.args.seed)
+		state = case.setup(random.Random(self.args.seed))
+
+		# Without tracemalloc, how much the first call grows the largest
+		# resident set: only what goes past the largest so far shows,
+		# so it's a lower bound.
+		rss_growth = None
+		if tracemalloc == None and resource != None:
+			gc.collect()
+			before = max_rss()
+			case.fn(state)
+			rss_growth = max_rss() - before
+
+		# Calibrate.
+		number = 1
+		while True:
+			elapsed = self.time_calls(case, state, number)
+			if elapsed >= self.args.min_time or number >= self.args.max_number:
+				break
+			number *= 10 if elapsed < self.args.min_time / 10 else 2
+
+		times = [elapsed / number]
+		for _ in range(self.args.repeat - 1):
+			times.append(self.time_calls(case, state, number) / number)
+		times.sort()
+
+		res = {
+				"number": number,
+				"repeat": len(times),
+				"best": times[0],
+				"median": times[len(times) // 2],
+				"per_op": times[len(times) // 2] / case.ops,
+				"alloc_peak_bytes": None,
+				"alloc_blocks": None,
+				"rss_growth_bytes": None,
+				}
+		# Allocation tracking of a single call.
+		if tracemalloc != None:
+			gc.collect()
+			tracemalloc.start()
+			snapshot = tracemalloc.take_snapshot()
+			case.fn(state)
+			current, peak = tracemalloc.get_traced_memory()
+			after = tracemalloc.take_snapshot()
+			tracemalloc.stop()
+			res["alloc_peak_bytes"] = peak
+			res["alloc_blocks"] = sum(s.count_diff for s in after.compare_to(snapshot, "filename"))
+		res["rss_growth_bytes"] = rss_growth
+		return res
+
+	def time_calls(self, case, state, number):
+		gc_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			t_start = time.time()
+			for _ in range(number):
+				case.fn(state)
+			return time.time() - t_start
+		finally:
+			if gc_enabled:
+				gc.enable()
+
+	def run(self, cases):
+		results = {}
+		pattern = re.compile(self.args.filter) if self.args.filter != "" else None
+		for case in cases:
+			if pattern != None and not pattern.search(case.name):
+				continue
+			res = self.run_case(case)
+			results[case.name] = res
+			print("{:<40} {:>12} {:>12} {:>8} {}".format(
+				case.name,
+				format_time(res["median"]),
+				format_time(res["per_op"]) + "/op",
+				res["number"],
+				format_alloc(res)))
+			sys.stdout.flush()
+		return results
+
+
+def format_time(t):
+	if t >= 1:
+		return "{:.3f} s".format(t)
+	if t >= 1e-3:
+		return "{:.3f} ms".format(t * 1e3)
+	if t >= 1e-6:
+		return "{:.3f} us".format(t * 1e6)
+	return "{:.1f} ns".format(t * 1e9)
+
+def format_alloc(res):
+	if res["alloc_peak_bytes"] != None:
+		return "peak " + size_label(res["alloc_peak_bytes"])
+	if res["rss_growth_bytes"] == 0:
+		return "max RSS not exceeded"
+	if res["rss_growth_bytes"] != None:
+		return "max RSS +" + size_label(res["rss_growth_bytes"])
+	return "alloc not measured"
+
+
+def protocol_cases():
+	"""
+	Marshalling and unmarshalling.
+	"""
+	cases = []
+	cases.append(Case("protocol.res_insert",
+		lambda rng: random_text(rng, 8),
+		lambda text: cp.Protocol.res_insert(u"bench", 1234, text)))
+	for n in [1, 100, 10000]:
+		cases.append(Case("protocol.res_commit[{}]".format(n),
+			lambda rng, n=n: random_ops(rng, n),
+			lambda ops: cp.Protocol.res_commit(1, ops), n))
+		cases.append(Case("protocol.unpack[{}]".format(n),
+			lambda rng, n=n: cp.Protocol.res_commit(1, random_ops(rng, n)),
+			lambda frame: cp.Protocol.unpack(frame), n))
+	cases.append(Case("protocol.unpack_op",
+		lambda rng: cp.Protocol.res_insert(u"bench", 1234, random_text(rng, 8)),
+		lambda frame: cp.Protocol.unpack_op(frame)))
+	for size in [KB, MB]:
+		cases.append(Case("protocol.res_text[{}]".format(size_label(size)),
+			lambda rng, size=size: random_text(rng, size),
+			lambda text: cp.Protocol.res_text(1, 0, text)))
+		cases.append(Case("protocol.res_text_chunks[{}]".format(size_label(size)),
+			lambda rng, size=size: random_text(rng, size),
+			lambda text: [cp.Protocol.res_text_chunk(offset, chunk)
+				for offset, chunk in cp.Protocol.text_chunks(text)]))
+	return cases
+
+def document_cases(sizes):
+	"""
+	Document operations on documents of various sizes.
+	"""
+	cases = []
+	for size in sizes:
+		label = size_label(size)
+
+		def setup(rng, size=size):
+			doc = cd.Document(u"bench-{}".format(size))
+			doc.text = random_text(rng, size)
+			return (doc, rng)
+
+		def insert(state):
+			doc, rng = state
+			doc.insert(0, rng.randint(0, len(doc.text)), u"x")
+
+		def remove(state):
+			doc, rng = state
+			doc.remove(0, rng.randint(0, len(doc.text) - 1), 1)
+			# Keep the size stable.
+			doc.text += u"x"
+
+		def setup_commit(rng, size=size):
+			doc, rng = setup(rng, size)
+			commit = cp.Message({"id": cp.Protocol.REQ_COMMIT, "version": 0,
+				"sequence": random_ops(rng, 10, size)})
+			return (doc, commit)
+
+		def process_commit(state):
+			doc, commit = state
+			doc.process_commit(commit)
+
+		def setup_indexed(rng, size=size):
+			doc, rng = setup(rng, size)
+			doc.get_index()
+			return (doc, rng)
+
+		def offset_to_line(state):
+			doc, rng = state
+			doc.offset_to_line(rng.randint(0, len(doc.text)))
+
+		def offset_to_utf16(state):
+			doc, rng = state
+			doc.offset_to_utf16(rng.randint(0, len(doc.text)))
+
+		cases.append(Case("document.insert[{}]".format(label), setup, insert))
+		cases.append(Case("document.insert_indexed[{}]".format(label), setup_indexed, insert))
+		cases.append(Case("document.offset_to_line[{}]".format(label), setup_indexed, offset_to_line))
+		cases.append(Case("document.offset_to_utf16[{}]".format(label), setup_indexed, offset_to_utf16))
+		cases.append(Case("document.remove[{}]".format(label), setup, remove))
+		cases.append(Case("document.process_commit[{}]".format(label),
+			setup_commit, process_commit, 10))
+	return cases
+
+def util_cases():
+	cases = []
+	for size in [16, 4 * KB]:
+		cases.append(Case("util.to_hex_str[{}]".format(size_label(size)),
+			lambda rng, size=size: bytearray(rng.getrandbits(8) for _ in range(size)),
+			lambda data: cu.to_hex_str(data), size))
+	return cases
+
+
+def check_regressions(baseline, results, threshold):
+	"""
+	Compare median timings with a baseline.
+	Returns a list of the cases that got slower than the threshold allows.
+	"""
+	regressions = []
+	print("\n{:<40} {:>12} {:>12} {:>9}".format("case", "baseline", "current", "change"))
+	for name in sorted(results):
+		if name not in baseline:
+			continue
+		old = baseline[name]["median"]
+		new = results[name]["median"]
+		change = (new - old) / old if old > 0 else 0.0
+		flag = ""
+		if change > threshold:
+			flag = " REGRESSION"
+			regressions.append(name)
+		print("{:<40} {:>12} {:>12} {:>+8.1f}%{}".format(
+			name, format_time(old), format_time(new), change * 100.0, flag))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Collaborative Text Editor microbenchmarks")
+	parser.add_argument("-k", "--filter", dest="filter", type=str, default="", help="only run cases matching a regexp")
+	parser.add_argument("--sizes", dest="sizes", type=str, default="1KB,1MB,100MB", help="document sizes")
+	parser.add_argument("--quick", dest="quick", action="store_true", help="skip documents over 1 MB")
+	parser.add_argument("--seed", dest="seed", type=int, default=1, help="random seed")
+	parser.add_argument("--repeat", dest="repeat", type=int, default=5, help="repeats per case")
+	parser.add_argument("--min-time", dest="min_time", type=float, default=0.1, help="minimum time per repeat (s)")
+	parser.add_argument("--max-number", dest="max_number", type=int, default=1000000, help="maximum calls per repeat")
+	parser.add_argument("-o", "--output", dest="output", type=str, default="", help="write JSON results to a file")
+	parser.add_argument("--baseline", dest="baseline", type=str, default="", help="JSON results to compare with")
+	parser.add_argument("--threshold", dest="threshold", type=float, default=0.2, help="allowed slowdown against the baseline (0.2 = 20%%)")
+
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING, format="[%(levelname)s: %(name)s]\t%(message)s")
+	log = logging.getLogger(Runner.LOGNAME)
+	if tracemalloc == None and resource != None:
+		log.warning("tracemalloc is not available, only the growth of the max RSS is measured")
+	elif tracemalloc == None:
+		log.warning("tracemalloc is not available, allocations are not measured")
+
+	sizes = []
+	for s in args.sizes.split(","):
+		s = s.strip().upper()
+		size = int(s.rstrip("KMB") or 0) * (MB if s.endswith("MB") else KB if s.endswith("KB") else 1)
+		if args.quick and size > MB:
+			continue
+		sizes.append(size)
+
+	# Documents are stored on every change, keep them out of the way.
+	storage = tempfile.mkdtemp(prefix="ctxt_bench_")
+	cd.Document.STORAGE_PATH = storage
+	try:
+		runner = Runner(args)
+		results = runner.run(protocol_cases() + document_cases(sizes) + util_cases())
+	finally:
+		shutil.rmtree(storage, ignore_errors=True)
+
+	output = {"config": vars(args), "results": results}
+	if args.output != "":
+		with open(args.output, "w") as f:
+			json.dump(output, f, indent=2, sort_keys=True)
+	if args.baseline != "":
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = check_regressions(baseline.get("results", baseline), results, args.threshold)
+		if len(regressions) > 0:
+			log.error("{} case(s) regressed by more than {:.0f}%".format(
+				len(regressions), args.threshold * 100.0))
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,21 +1,18 @@
 #!/usr/bin/python
 import Queue as queue
-import argparse
 import errno
 import logging
 import socket
 import sys
 
-from PyQt5 import QtWidgets
-
 import ctxt.protocol as cp
 import ctxt.util as cu
-from ctxt.client.ui import MainWindow
 
 
 class Client():
 	"""
 	A client class for low-level production of requests and handling of responses.
+	Doesn't depend on Qt, the GUI is only imported by main().
 	"""
 	LOGNAME = "CT.Client"
 
@@ -34,6 +31,17 @@ class Client():
 	# We've received the full text, will edit it.
 	STAT_EDITING = 5
 
+	# How much to read from the socket at once.
+	RECV_SIZE = 65536
+	# How much of a message to dump into the debug log.
+	LOG_BYTES = 64
+	# Ask for the full text in chunks?
+	CHUNKED_TEXT = True
+	# Or compressed (in a single response)?
+	COMPRESSED_TEXT = False
+	# Lines to ask for first, when loading the text lazily.
+	FIRST_LINES = 200
+
 	@staticmethod
 	def get_log():
 		"""
@@ -48,6 +56,26 @@ class Client():
 		self.socket = None
 		self.state = Client.STAT_IDLE
 		self.queue_sc = queue.Queue()
+		# Received data that doesn't make a complete message yet.
+		self.rx_buffer = bytearray()
+		# Requests the socket hasn't taken yet (it's non-blocking).
+		self.tx_buffer = bytearray()
+		# Parts of a response received so far.
+		self.parts = cp.Parts()
+		# Full text being received in chunks: characters so far and checksum.
+		self.text_offset = None
+		self.text_crc = 0
+		# Load the text lazily, range by range,
+		# rather than waiting for all of it?
+		self.lazy_text = False
+		# Have the server acknowledge our requests cumulatively?
+		self.cumulative_acks = True
+		# Only watch the document (e.g. on a relay server)?
+		self.spectator = False
+		# Requests sent since the join (the join being number 1),
+		# and how many of them the server has acknowledged.
+		self.tx_seq = 0
+		self.acked_seq = 0
 
 		self.log.info("Starting the client")
 
@@ -68,7 +96,11 @@ class Client():
 			# This makes implementation a bit easier.
 
 			self.socket.connect((address, port))
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 			self.socket.setblocking(0)
+			self.rx_buffer = bytearray()
+			self.tx_buffer = bytearray()
+			self.parts = cp.Parts()
 			self.state = Client.STAT_CONNECTED
 			self.online = True
 
@@ -88,13 +120,21 @@ class Client():
 		self.nickname = nickname
 		self.docname = doc
 
+		flags = 0
+		if self.cumulative_acks:
+			flags |= cp.Protocol.JOIN_CUMULATIVE_ACKS
+		if self.spectator:
+			flags |= cp.Protocol.JOIN_SPECTATOR
 		# TODO:: Shouldn't convert from QString to string here.
-		req = cp.Protocol.req_join(str(nickname), str(doc))
-		self.socket.sendall(req)
+		req = cp.Protocol.req_join(str(nickname), str(doc), flags)
+		self.tx_seq = 0
+		self.acked_seq = 0
+		self.send(req)
 
 	def update(self):
 		"""
-		Check for messages waiting in socket buffer.
+		Receive everything waiting in the socket buffer,
+		and queue all the complete messages.
 		"""
 		if not self.socket or not self.online:
 			return
@@ -106,54 +146,17 @@ class Client():
 			return
 
 		try:
-			# Receive the header
-			hdr = self.socket.recv(cp.Protocol.MIN_REQ_LEN)
-			if len(hdr) < cp.Protocol.MIN_REQ_LEN:
-				return
-
-			self.log.debug("Received header: " + cu.to_hex_str(hdr))
-
-			# TODO:: Should change socket back to blocking with timeout here?
-
-			# Extract payload length.
-			r_len = cp.Protocol.get_len(hdr)
-			# Receive the rest of the data.
-			data = self.socket.recv(r_len)
-			if len(data) < r_len:
-				self.log.warning("Dropped message")
-				return
-
-			self.log.debug("Received data: " + cu.to_hex_str(hdr + data))
-
-			d = cp.Protocol.unpack(hdr + data)
-			print d
-			# Request acknowledged?
-			if d["id"] == cp.Protocol.RES_OK:
-				# That might mean we've successfully joined.
-				if self.state == Client.STAT_JOINING and d["req_id"] == cp.Protocol.REQ_JOIN:
-					self.log.info("We have successfully joined")
-
-					self.state = Client.STAT_JOINED
-					msg = cp.Message(d, True)
-					self.queue_sc.put(msg)
-					# Get the whole text that's written so far.
-					self.get_whole_text()
-			# Some kind of an error?
-			elif d["id"] == cp.Protocol.RES_ERROR:
-				self.log.error("Server error {}".format(d["error"]))
-			# A commit?
-			elif d["id"] == cp.Protocol.RES_COMMIT:
-				msg = cp.Message(d, True)
-				self.queue_sc.put(msg)
-			# We've received full text?
-			elif d["id"] == cp.Protocol.RES_TEXT:
-				self.log.debug(d)
-				# We have full text, so we can go ahead and edit it.
-				if self.state == Client.STAT_JOINED:
-					self.state = Client.STAT_EDITING
-				if self.state == Client.STAT_EDITING:
-					msg = cp.Message(d, True)
-					self.queue_sc.put(msg)
+			# Read everything the socket has for us.
+			while True:
+				data = self.socket.recv(Client.RECV_SIZE)
+				if len(data) == 0:
+					self.log.info("Connection closed by the server")
+					self.online = False
+					self.state = Client.STAT_IDLE
+					break
+				self.rx_buffer += data
+				if len(data) < Client.RECV_SIZE:
+					break
 		except socket.error as e:
 			# Skip "Resource temporarily unavailable".
 			if e.errno not in [errno.EWOULDBLOCK]:
@@ -164,13 +167,131 @@ class Client():
 		except Exception as e:
 			self.log.exception(e)
 
+		# Handle every complete message in the buffer.
+		while len(self.rx_buffer) >= cp.Protocol.MIN_REQ_LEN:
+			r_len = cp.Protocol.get_len(self.rx_buffer[:cp.Protocol.MIN_REQ_LEN])
+			f_len = cp.Protocol.MIN_REQ_LEN + r_len
+			if len(self.rx_buffer) < f_len:
+				# The rest will arrive later.
+				break
+			frame = bytes(self.rx_buffer[:f_len])
+			del self.rx_buffer[:f_len]
+			if self.log.isEnabledFor(logging.DEBUG):
+				self.log.debug("Received data: " + cu.to_hex_str(frame[:Client.LOG_BYTES]))
+			try:
+				self.handle(cp.Protocol.unpack(frame))
+			except Exception as e:
+				self.log.exception(e)
+
+	def handle(self, d):
+		"""
+		Handle a single message from the server.
+		"""
+		# A part of a longer response?
+		if d["id"] == cp.Protocol.RES_PART:
+			frame = self.parts.add(d)
+			if frame != None:
+				self.handle(cp.Protocol.unpack(frame))
+		# Request acknowledged?
+		elif d["id"] == cp.Protocol.RES_OK:
+			self.acked_seq += 1
+			# That might mean we've successfully joined.
+			if self.state == Client.STAT_JOINING and d["req_id"] == cp.Protocol.REQ_JOIN:
+				self.log.info("We have successfully joined")
+				self.acked_seq = 1
+
+				self.state = Client.STAT_JOINED
+				msg = cp.Message(d, True)
+				self.queue_sc.put(msg)
+				if self.lazy_text:
+					# Get what's visible first.
+					self.get_range(0, Client.FIRST_LINES, lines=True)
+				else:
+					# Get the whole text that's written so far.
+					self.get_whole_text()
+		# Some kind of an error?
+		elif d["id"] == cp.Protocol.RES_ERROR:
+			self.log.error("Server error {}".format(d["error"]))
+			msg = cp.Message(d, True)
+			self.queue_sc.put(msg)
+			# Our commit was rejected, our text doesn't match the server's.
+			if d["error"] == cp.Protocol.ERR_INVALID_OP and self.state == Client.STAT_EDITING:
+				self.get_whole_text()
+		# Requests acknowledged?
+		elif d["id"] == cp.Protocol.RES_ACK:
+			self.acked_seq = d["seq"]
+		# A commit?
+		elif d["id"] == cp.Protocol.RES_COMMIT:
+			if "ack" in d:
+				self.acked_seq = d["ack"]
+			msg = cp.Message(d, True)
+			self.queue_sc.put(msg)
+		# We've received full text?
+		elif d["id"] in [cp.Protocol.RES_TEXT, cp.Protocol.RES_TEXT_Z]:
+			d["id"] = cp.Protocol.RES_TEXT
+			self.log.debug("Received full text ({:08X})".format(d["version"]))
+			# We have full text, so we can go ahead and edit it.
+			if self.state == Client.STAT_JOINED:
+				self.state = Client.STAT_EDITING
+			if self.state == Client.STAT_EDITING:
+				msg = cp.Message(d, True)
+				self.queue_sc.put(msg)
+		# A range of the text?
+		elif d["id"] == cp.Protocol.RES_RANGE:
+			# The beginning of the text is enough for editing.
+			if self.state == Client.STAT_JOINED and d["start"] == 0:
+				self.state = Client.STAT_EDITING
+			if self.state == Client.STAT_EDITING:
+				self.queue_sc.put(cp.Message(d, True))
+		# Full text in chunks?
+		elif d["id"] == cp.Protocol.RES_TEXT_BEGIN:
+			self.log.debug("Receiving full text ({:08X}, {} characters)".format(d["version"], d["length"]))
+			self.text_offset = 0
+			self.text_crc = 0
+			self.queue_sc.put(cp.Message(d, True))
+		elif d["id"] == cp.Protocol.RES_TEXT_CHUNK:
+			if self.text_offset != d["offset"]:
+				self.log.error("Unexpected text chunk at {} (expected {})".format(d["offset"], self.text_offset))
+				return
+			self.text_offset += len(d["text"])
+			self.text_crc = cp.Protocol.checksum(d["text"].encode("utf8"), self.text_crc)
+			self.queue_sc.put(cp.Message(d, True))
+		elif d["id"] == cp.Protocol.RES_TEXT_END:
+			if self.text_offset == None:
+				return
+			d["valid"] = self.text_crc == d["checksum"]
+			self.text_offset = None
+			if not d["valid"]:
+				# Try again.
+				self.log.error("Full text checksum mismatch ({:08X} != {:08X})".format(
+					self.text_crc, d["checksum"]))
+				self.get_whole_text()
+			elif self.state == Client.STAT_JOINED:
+				self.state = Client.STAT_EDITING
+			self.queue_sc.put(cp.Message(d, True))
+		# Server metrics, catalog pages, search results, past versions,
+		# hashes or where the others' cursors are?
+		elif d["id"] in [cp.Protocol.RES_STATS, cp.Protocol.RES_LIST, cp.Protocol.RES_SEARCH,
+				cp.Protocol.RES_HISTORY, cp.Protocol.RES_HASH, cp.Protocol.RES_CURSOR]:
+			msg = cp.Message(d, True)
+			self.queue_sc.put(msg)
+
 	def commit(self, commit):
 		"""
 		Send a commit, potentially consisting of many
 		operations.
 		"""
 		req = cp.Protocol.res_commit(commit["version"], commit["sequence"])
-		self.socket.sendall(req)
+		self.send(req)
+
+	def move_cursor(self, cursor):
+		"""
+		Tell the others where our cursor is (a commit of nothing else,
+		which doesn't make a new version).
+		"""
+		req = cp.Protocol.res_commit(0, [{"id": cp.Protocol.RES_CURSOR,
+			"name": self.nickname, "cursor": cursor}])
+		self.send(req)
 
 	def get_whole_text(self):
 		"""
@@ -179,8 +300,103 @@ class Client():
 		connection errors. Should call it then, I suppose.
 		"""
 		self.log.debug("Requesting for whole text")
-		req = cp.Protocol.req_text()
-		self.socket.sendall(req)
+		flags = 0
+		if self.CHUNKED_TEXT:
+			flags |= cp.Protocol.TEXT_CHUNKED
+		elif self.COMPRESSED_TEXT:
+			flags |= cp.Protocol.TEXT_COMPRESSED
+		req = cp.Protocol.req_text(flags)
+		self.send(req)
+
+	def get_range(self, start, end, lines=False):
+		"""
+		Request for the text from (start) up to (end),
+		either characters or lines.
+		"""
+		flags = cp.Protocol.RANGE_LINES if lines else 0
+		req = cp.Protocol.req_range(start, end, flags)
+		self.send(req)
+
+	def list_docs(self, prefix=u"", offset=0, limit=100, order=cp.Protocol.LIST_BY_NAME):
+		"""
+		Request for a page of the document catalog.
+		"""
+		req = cp.Protocol.req_list(prefix, offset, limit, order)
+		self.send(req)
+
+	def search(self, query, doc=u"", limit=100):
+		"""
+		Search for a text in a document (or in all documents).
+		"""
+		req = cp.Protocol.req_search(query, doc, limit)
+		self.send(req)
+
+	def get_history(self, version, base=None, doc=u""):
+		"""
+		Request for a document (the joined one, unless named) at a
+		past version, or with (base), the changes from that version.
+		"""
+		if base == None:
+			req = cp.Protocol.req_history(version, 0, 0, doc)
+		else:
+			req = cp.Protocol.req_history(version, base, cp.Protocol.HISTORY_DIFF, doc)
+		self.send(req)
+
+	def get_hashes(self, level=cp.Protocol.HASH_ROOT, first=0, count=1, flags=0):
+		"""
+		Request for hashes of the document's hash tree (by default, its root),
+		to tell whether our copy of the text still matches the server's.
+		"""
+		req = cp.Protocol.req_hash(level, first, count, flags)
+		self.send(req)
+
+	def get_stats(self):
+		"""
+		Request for the server metrics.
+		"""
+		req = cp.Protocol.req_stats()
+		self.send(req)
+
+	def send(self, req):
+		"""
+		Send a request (every request has a sequence number).
+		Whatever the socket doesn't take right away is buffered,
+		and written once it's writable again (see flush_tx()).
+		"""
+		self.tx_buffer += req
+		self.tx_seq += 1
+		self.flush_tx()
+
+	def flush_tx(self):
+		"""
+		Write as much of the outbound buffer as the socket takes.
+		Returns whether there's still something left to write.
+		"""
+		if self.socket == None:
+			return False
+		try:
+			while len(self.tx_buffer) > 0:
+				n = self.socket.send(self.tx_buffer)
+				del self.tx_buffer[:n]
+		except socket.error as e:
+			if e.errno not in [errno.EWOULDBLOCK, errno.EAGAIN]:
+				self.log.exception(e)
+				if e.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED):
+					self.online = False
+					self.state = Client.STAT_IDLE
+		return self.wants_write()
+
+	def wants_write(self):
+		"""
+		Is there anything waiting for the socket to become writable?
+		"""
+		return len(self.tx_buffer) > 0
+
+	def get_unacked(self):
+		"""
+		Number of requests the server hasn't acknowledged yet.
+		"""
+		return self.tx_seq - self.acked_seq
 
 	@staticmethod
 	def close():
@@ -210,6 +426,8 @@ def init_logging():
 
 
 def main():
+	import argparse
+
 	parser = argparse.ArgumentParser(description="Collaborative Text Editor Client")
 	parser.add_argument('-a', '--address', dest='address', type=str, default="", help='server IP address')
 	parser.add_argument('-p', '--port', dest='port', type=int, default=0, help='server port number')
@@ -220,6 +438,10 @@ def main():
 
 	log = init_logging()
 
+	# Qt is only needed for the GUI, keep it out of library imports.
+	from PyQt5 import QtWidgets
+	from ctxt.client.ui import MainWindow
+
 	try:
 		app = QtWidgets.QApplication(sys.argv)
 		client = Client()
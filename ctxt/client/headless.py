@@ -0,0 +1,238 @@
+"""
+Headless client library for scripts and bots.
+
+Doesn't import Qt (nor need a display), and keeps a local mirror
+of the document. Can be driven with callbacks and poll():
+
+	client = HeadlessClient("bot", on_commit=handler)
+	client.connect("127.0.0.1", 7777)
+	client.join_doc("bot", "test")
+	client.run()
+
+from a select() loop of one's own, along with other sockets (the
+client has a fileno()), polling it when it's readable (or writable,
+while it has requests the socket hasn't taken yet), and now and
+then (to send the changes, and to verify the text):
+
+	writable = [client] if client.wants_write() else []
+	readable, _, _ = select.select([client, other], writable, [], 0.05)
+	client.poll()
+"""
+import errno
+import select
+import socket
+import time
+
+import ctxt.protocol as cp
+from ctxt.client.client import Client
+from ctxt.shared_document.mirror import Mirror
+
+
+class HeadlessClient(Client):
+	"""
+	A client without a GUI, with a local mirror of the document.
+	"""
+	LOGNAME = "CT.Client.Headless"
+
+	# How often (s) to make sure the mirror matches the server's text.
+	VERIFY_INTERVAL = 5.0
+	# How long (s) to wait for the last requests to go out when disconnecting.
+	LEAVE_TIMEOUT = 1.0
+
+	def __init__(self, nickname="Anon", on_text=None, on_commit=None, on_error=None):
+		"""
+		The callbacks are called with the client and the message:
+		on_text once the full text has arrived (with lazy_text, once
+		the last range of it has arrived), on_commit for every
+		commit (after it has been applied to the mirror) and on_error
+		for error responses.
+		"""
+		Client.__init__(self)
+
+		self.nickname = nickname
+		self.docname = None
+		# Local mirror of the document.
+		self.mirror = None
+		# Where the others' cursors are, by nickname.
+		self.cursors = {}
+
+		self.on_text = on_text
+		self.on_commit = on_commit
+		self.on_error = on_error
+
+		# Compare hashes with the server every (verify_interval) seconds
+		# (0 disables it), and count the repairs.
+		self.verify_interval = HeadlessClient.VERIFY_INTERVAL
+		self.t_verify = time.time()
+		self.repairs = 0
+
+	def join_doc(self, nickname, doc):
+		"""
+		Join a document, creating its local mirror.
+		"""
+		self.mirror = Mirror(doc, nickname)
+		Client.join_doc(self, nickname, doc)
+
+	def get_text(self):
+		"""
+		Get the text of the local mirror.
+		"""
+		if self.mirror == None:
+			return u""
+		return self.mirror.get_text()
+
+	def is_editing(self):
+		"""
+		Have we received the text (or its beginning), i.e. can we edit it?
+		"""
+		return self.state == Client.STAT_EDITING
+
+	def insert(self, cursor, text):
+		"""
+		Insert text at a cursor position.
+		The change is applied to the mirror right away,
+		and sent with the next flush().
+		"""
+		self.mirror.insert(cursor, text)
+
+	def remove(self, cursor, length):
+		"""
+		Remove (length) characters from a cursor position.
+		"""
+		self.mirror.remove(cursor, length)
+
+	def undo(self):
+		"""
+		Undo our latest edit (the others' edits are left alone).
+		Returns the operations made.
+		"""
+		return self.mirror.undo()
+
+	def redo(self):
+		"""
+		Redo our latest undone edit.
+		"""
+		return self.mirror.redo()
+
+	def flush(self):
+		"""
+		Send the active commit, if there's anything in it.
+		"""
+		if self.mirror == None or not self.mirror.has_unsent() or self.socket == None:
+			return
+		self.commit({"version": self.mirror.version, "sequence": self.mirror.take_unsent()})
+
+	def verify(self):
+		"""
+		Ask for the root hash of the document, to make sure the mirror
+		still matches the server's text (the chunks that don't are
+		fetched again).
+		"""
+		self.t_verify = time.time()
+		if self.mirror != None and self.is_editing() and self.mirror.can_verify():
+			self.get_hashes()
+
+	def poll(self, timeout=0):
+		"""
+		Send our changes, wait up to (timeout) seconds for
+		messages from the server and handle them.
+		Callbacks are called from here.
+		"""
+		self.flush()
+		if self.socket == None:
+			return
+		writable = [self.socket] if self.flush_tx() else []
+		readable, writable, _ = select.select([self.socket], writable, [], timeout)
+		if len(writable) > 0:
+			self.flush_tx()
+		if len(readable) > 0:
+			self.update()
+		self.dispatch()
+		if self.verify_interval > 0 and time.time() - self.t_verify >= self.verify_interval:
+			self.verify()
+
+	def run(self, interval=0.05):
+		"""
+		Poll until the connection is closed.
+		"""
+		while self.online and self.socket != None:
+			self.poll(interval)
+
+	def dispatch(self):
+		"""
+		Handle the messages that Client.update() has queued.
+		"""
+		while not self.queue_sc.empty():
+			msg = self.queue_sc.get()
+			if msg.id == cp.Protocol.RES_TEXT:
+				self.mirror.set_text(msg.version, msg.text)
+				if self.on_text != None:
+					self.on_text(self, msg)
+			# The full text in chunks.
+			elif msg.id == cp.Protocol.RES_TEXT_BEGIN:
+				self.mirror.begin_text(msg.version)
+			elif msg.id == cp.Protocol.RES_TEXT_CHUNK:
+				self.mirror.append_text(msg.text)
+			elif msg.id == cp.Protocol.RES_TEXT_END:
+				if not msg.valid:
+					self.mirror.abort_text()
+					continue
+				self.mirror.end_text()
+				msg.text = self.mirror.get_text()
+				if self.on_text != None:
+					self.on_text(self, msg)
+			# A range of the text, when loading it lazily.
+			elif msg.id == cp.Protocol.RES_RANGE:
+				self.mirror.add_range(msg.version, msg.start, msg.length, msg.text)
+				next_range = self.mirror.next_range()
+				if next_range != None:
+					self.get_range(*next_range)
+					continue
+				msg.text = self.mirror.get_text()
+				if self.on_text != None:
+					self.on_text(self, msg)
+			elif msg.id == cp.Protocol.RES_COMMIT:
+				self.mirror.apply_commit(msg)
+				if self.on_commit != None:
+					self.on_commit(self, msg)
+			# Hashes of the server's text, or the chunks of it we got wrong.
+			elif msg.id == cp.Protocol.RES_HASH:
+				if msg.flags & cp.Protocol.HASH_TEXT:
+					changes = self.mirror.repair(msg)
+					if len(changes) > 0:
+						self.log.warning("Repaired the text ({} changes)".format(len(changes)))
+						self.repairs += 1
+				else:
+					for req in self.mirror.verify(msg):
+						self.get_hashes(*req)
+			elif msg.id == cp.Protocol.RES_CURSOR:
+				self.cursors[msg.name] = msg.cursor
+			elif msg.id == cp.Protocol.RES_ERROR:
+				if self.on_error != None:
+					self.on_error(self, msg)
+
+	def disconnect(self):
+		"""
+		Close the connection.
+		"""
+		self.online = False
+		if self.socket != None:
+			try:
+				# Whatever's still buffered, then the leave request.
+				self.socket.settimeout(HeadlessClient.LEAVE_TIMEOUT)
+				self.socket.sendall(bytes(self.tx_buffer) + cp.Protocol.req_leave())
+			except socket.error as e:
+				if e.errno not in [errno.EPIPE, errno.ECONNRESET]:
+					self.log.exception(e)
+			self.socket.close()
+			self.socket = None
+			self.tx_buffer = bytearray()
+
+	def fileno(self):
+		"""
+		The socket's, for select() (-1 when not connected).
+		"""
+		if self.socket == None:
+			return -1
+		return self.socket.fileno()
+
@@ -3,8 +3,11 @@ from ctxt.client.ui_connect import Ui_ConnectDialog
 from ctxt.client.ui_main import Ui_MainWindow
 import ctxt.protocol as cp
 import ctxt.util as cu
+from ctxt.shared_document.mirror import Mirror
 
+import collections
 import logging
+import time
 
 class ConnectDialog(QtWidgets.QDialog):
 	"""
@@ -61,13 +64,25 @@ class MainWindow(QtWidgets.QMainWindow):
 	"""
 	The main window with the text editor.
 	"""
+	# How much time (s) to spend on applying remote changes per tick.
+	TICK_BUDGET = 0.02
+	# Least number of operations to apply per tick.
+	MIN_TICK_OPS = 16
+	# How often (ms) to make sure the text matches the server's.
+	VERIFY_INTERVAL = 5000
+
 	def __init__(self, client, address="localhost", port=7777, docname="test", nickname="Anon"):
 		super(MainWindow, self).__init__()
 
 		self.log = logging.getLogger("CT.Client.MainWnd")
 
 		self.client = client
-		self.update_interval = 0.1
+		# Show the beginning of the text first, load the rest in the background.
+		self.client.lazy_text = True
+		# Notifies us when the socket has something to read,
+		# and when it takes more of what we're sending.
+		self.notifier = None
+		self.write_notifier = None
 
 		# pyrcc5 ../../ui/resources.qrc -o resources_rc.py
 		# pyuic5 ../../ui/main.ui -o ui_main.py
@@ -77,6 +92,14 @@ class MainWindow(QtWidgets.QMainWindow):
 		self.content.actionConnect.triggered.connect(self.show_connect)
 		# Install an event filter on the text box.
 		self.content.textEdit.installEventFilter(self)
+		# Formatting isn't shared, so only take plain text.
+		self.content.textEdit.setAcceptRichText(False)
+		# Produce operations from the changes to the document.
+		self.applying_remote = False
+		self.content.textEdit.document().contentsChange.connect(self.on_contents_change)
+		# Qt's undo would undo the others' edits as well, the mirror
+		# undoes ours only (see undo()).
+		self.content.textEdit.setUndoRedoEnabled(False)
 		# Though, disable the text editor until we've managed to join a document.
 		self.content.textEdit.setDisabled(True)
 
@@ -84,14 +107,20 @@ class MainWindow(QtWidgets.QMainWindow):
 		self.set_port(port)
 		self.set_nickname(nickname)
 		self.set_docname(docname)
-		self.doc_ver = 0
-		self.active_commit = {"version":0, "sequence":[]}
+		# Local mirror of the document (once we've joined one).
+		self.mirror = None
 
-		# Start the update timer
-		self.update_timer = QtCore.QTimer()
-		self.update_timer.setSingleShot(False)
-		self.update_timer.timeout.connect(self.update)
-		self.update_timer.start(self.update_interval)
+		# Messages from the server, waiting to be applied.
+		self.backlog = collections.deque()
+		self.backlog_scheduled = False
+		# Estimated cost (s) of applying a single operation.
+		self.op_cost = 0.0001
+		# Is sending the active commit already scheduled?
+		self.send_scheduled = False
+		# Compare hashes of the text with the server's now and then.
+		self.verify_timer = QtCore.QTimer(self)
+		self.verify_timer.timeout.connect(self.verify)
+		self.verify_timer.start(MainWindow.VERIFY_INTERVAL)
 
 		self.show()
 	
@@ -146,170 +175,357 @@ class MainWindow(QtWidgets.QMainWindow):
 		Connect to the server and join the document.
 		"""
 		if self.client.connect(self.conn_address, self.conn_port):
+			self.watch_socket()
 			self.client.join_doc(self.nickname, self.docname)
+			self.watch_writes()
+
+	def watch_socket(self):
+		"""
+		Get notified whenever the socket becomes readable,
+		rather than polling it.
+		"""
+		self.unwatch_socket()
+		self.notifier = QtCore.QSocketNotifier(
+				self.client.socket.fileno(), QtCore.QSocketNotifier.Read, self)
+		self.notifier.activated.connect(self.update)
+		self.write_notifier = QtCore.QSocketNotifier(
+				self.client.socket.fileno(), QtCore.QSocketNotifier.Write, self)
+		self.write_notifier.setEnabled(False)
+		self.write_notifier.activated.connect(self.on_writable)
+
+	def unwatch_socket(self):
+		"""
+		Stop listening to the socket.
+		"""
+		for notifier in [self.notifier, self.write_notifier]:
+			if notifier != None:
+				notifier.setEnabled(False)
+				notifier.deleteLater()
+		self.notifier = None
+		self.write_notifier = None
+
+	def watch_writes(self):
+		"""
+		Get notified once the socket is writable, while the client has
+		requests it couldn't send yet (the socket is non-blocking).
+		"""
+		if self.write_notifier != None:
+			self.write_notifier.setEnabled(self.client.wants_write())
+
+	def on_writable(self):
+		"""
+		The socket is writable: send what's left in the outbound buffer.
+		"""
+		self.client.flush_tx()
+		self.watch_writes()
 	
 	def eventFilter(self, widget, event):
 		"""
 		Catch events in the text box.
+		Edits themselves are picked up from the document (on_contents_change).
 		"""
 		if event.type() == QtCore.QEvent.KeyPress and widget == self.content.textEdit:
-			key = event.key()
-			u = unicode(event.text())
-			if key in [QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter]:
-				self.req_insert('\n')
-			elif key == QtCore.Qt.Key_Backspace:
-				# Support for Ctrl+Backspace (removes the previous word).
-				if event.modifiers() & QtCore.Qt.ControlModifier:
-					self.req_remove_word(-1)
-				else:
-					self.req_remove(-1)
-			elif key == QtCore.Qt.Key_Delete:
-				# Support for Ctrl+Delete (removes the next word).
-				if event.modifiers() & QtCore.Qt.ControlModifier:
-					self.req_remove_word(1)
-				else:
-					self.req_remove(1)
-			elif key == QtCore.Qt.Key_Escape:
+			if event.key() == QtCore.Qt.Key_Escape:
 				self.close()
-			elif cu.u_is_printable(u):
-				self.req_insert(u)
+			elif event.matches(QtGui.QKeySequence.Undo):
+				self.undo()
+				return True
+			elif event.matches(QtGui.QKeySequence.Redo):
+				self.undo(True)
+				return True
 		# Handle the rest
 		return QtWidgets.QWidget.eventFilter(self, widget, event)
 
-	def req_insert(self, text):
+	def on_contents_change(self, position, removed, added):
 		"""
-		Generate a text insertion request.
+		The document has changed: (removed) characters were replaced
+		with (added) ones at (position). Whatever the user action
+		(typing, pasting, dropping, IME input), it becomes one
+		ranged removal and/or one ranged insertion.
 		"""
-		cursor = self.content.textEdit.textCursor().position()
-		d = {
-				"id": cp.Protocol.RES_INSERT,
-				"cursor": cursor,
-				"text": text,
-				"name": self.nickname
-				}
-		self.active_commit["sequence"].append(d)
-	
-	def req_remove(self, length):
+		# Our own doing?
+		if self.applying_remote or self.mirror == None:
+			return
+		doc = self.content.textEdit.document()
+		# Qt counts the implicit paragraph separator at the end of the
+		# document in some changes (e.g. replacing everything).
+		new_len = doc.characterCount() - 1
+		old_len = new_len - added + removed
+		removed = min(removed, old_len - position)
+		added = min(added, new_len - position)
+
+		# Qt positions are in UTF-16 units, ours in characters.
+		view = self.mirror.view
+		cursor_pos = view.utf16_to_offset(position)
+		if removed > 0:
+			self.req_remove(cursor_pos, view.utf16_to_offset(position + removed) - cursor_pos)
+		if added > 0:
+			cursor = QtGui.QTextCursor(doc)
+			cursor.setPosition(position)
+			cursor.setPosition(position + added, QtGui.QTextCursor.KeepAnchor)
+			# Qt uses paragraph separators in place of newlines.
+			text = unicode(cursor.selectedText()).replace(u"\u2029", u"\n")
+			self.req_insert(cursor_pos, text)
+
+	def undo(self, redo=False):
 		"""
-		Generate a text removal request.
+		Undo (or redo) our latest edit, leaving the others' alone.
+		"""
+		if self.mirror == None or not self.content.textEdit.isEnabled():
+			return
+		changes = self.mirror.redo() if redo else self.mirror.undo()
+		if len(changes) == 0:
+			return
+		cursor = QtGui.QTextCursor(self.content.textEdit.document())
+		self.applying_remote = True
+		cursor.beginEditBlock()
+		try:
+			self.apply_ops(changes, cursor)
+		finally:
+			cursor.endEditBlock()
+			self.applying_remote = False
+		# Where the edit was.
+		self.content.textEdit.setTextCursor(cursor)
+		self.schedule_send()
+
+	def req_insert(self, cursor, text):
+		"""
+		Generate a text insertion request.
 		"""
-		cursor = self.content.textEdit.textCursor().position()
-		# We shouldn't send negative length to the server.
-		# So, we'll remap the cursor position and length.
-		if length < 0:
-			length = abs(length)
-			cursor -= length
-		# And produce the message.
-		d = {
-				"id": cp.Protocol.RES_REMOVE,
-				"cursor": cursor,
-				"length": length,
-				"name": self.nickname
-				}
-		self.active_commit["sequence"].append(d)
+		self.mirror.insert(cursor, text)
+		self.schedule_send()
 	
-	def req_remove_word(self, direction):
+	def req_remove(self, cursor, length):
 		"""
-		Generate a request to remove a word
-		relative to the cursor position.
+		Generate a text removal request.
 		"""
-		# Select the word left or right to the cursor.
-		cursor = self.content.textEdit.textCursor()
-		if direction > 0:
-			cursor.movePosition(QtGui.QTextCursor.WordRight, QtGui.QTextCursor.KeepAnchor)
-		else:
-			cursor.movePosition(QtGui.QTextCursor.WordLeft, QtGui.QTextCursor.KeepAnchor)
-		# Get selection length
-		length = cursor.selectionEnd() - cursor.selectionStart()
-		# And produce the message.
-		d = {
-				"id": cp.Protocol.REQ_REMOVE,
-				"cursor": cursor.selectionStart(),
-				"length": length,
-				"name": self.nickname
-				}
-		self.active_commit["sequence"].append(d)
+		self.mirror.remove(cursor, length)
+		self.schedule_send()
 
-	def process_commit(self, commit):
+	def apply_ops(self, ops, cursor):
 		"""
-		Process a commit message.
+		Make changes to the text box, using the given text cursor.
 		"""
-		for op in commit.sequence:
-			self.log.debug("Processing commit {}".format(op))
-
+		for op in ops:
 			op_id = op["id"]
-			if "name" in op:
-				op_name = op["name"]
-			if "cursor" in op:
-				op_cursor = op["cursor"]
-			if "length" in op:
-				op_len = op["length"]
-			if "text" in op:
-				op_text = op["text"]
-
-			# NOTE:: Remove this, eventually
-			if op_name == self.nickname:
-				continue
-
+			# Qt counts in UTF-16 units.
+			op_cursor = op.get("cursor16", op["cursor"])
 			# Someone inserted some text?
 			if op_id == cp.Protocol.RES_INSERT:
-				self.log.debug(u"{} inserted at {}: \"{}\"".format(
-					op_name, op_cursor, op_text))
-
-				# Generate a cursor at the desired position
+				# Move the cursor to the desired position
 				# and insert the text there.
-				cursor = self.content.textEdit.textCursor()
 				cursor.setPosition(op_cursor)
-				cursor.insertText(op_text)
+				cursor.insertText(op["text"])
 			# Someone removed some text?
 			elif op_id == cp.Protocol.RES_REMOVE:
-				self.log.debug(u"{} removed {}-{}".format(
-					op_name, op_cursor, op_len))
-
-				# Generate the desired selection and remove the text.
-				cursor = self.content.textEdit.textCursor()
+				# Select the desired range and remove the text.
 				cursor.setPosition(op_cursor)
-				cursor.movePosition(QtGui.QTextCursor.Right, QtGui.QTextCursor.KeepAnchor, op_len)
+				cursor.setPosition(op_cursor + op.get("length16", op["length"]), QtGui.QTextCursor.KeepAnchor)
 				cursor.removeSelectedText()
 
-	def update(self):
+	def apply_commits(self, commits):
 		"""
-		Check for any updates from the server,
-		and schedule the next update.
+		Apply a batch of commits: first to the mirror, which rebases
+		them over our pending changes, then the resulting changes to
+		the text box as a single edit block, so that the document is
+		laid out once per batch, rather than once per operation.
 		"""
+		if len(commits) == 0 or self.mirror == None:
+			return
+		t_start = time.time()
+		changes = []
+		for commit in commits:
+			self.log.debug("Applying commit {:08X}".format(commit.version))
+			changes += self.mirror.apply_commit(commit)
+		self.apply_changes(changes, t_start)
 
-		if not self.client.online:
+	def apply_changes(self, changes, t_start):
+		"""
+		Apply the changes from the mirror to the text box.
+		"""
+		if len(changes) == 0:
+			return
+		cursor = QtGui.QTextCursor(self.content.textEdit.document())
+		self.applying_remote = True
+		cursor.beginEditBlock()
+		try:
+			self.apply_ops(changes, cursor)
+		finally:
+			cursor.endEditBlock()
+			self.applying_remote = False
+		# Keep track of how expensive the operations are,
+		# to know how many we can afford next time.
+		cost = (time.time() - t_start) / len(changes)
+		self.op_cost += 0.2 * (cost - self.op_cost)
+
+	def schedule_send(self):
+		"""
+		Send the active commit once control returns to the event loop,
+		so that the operations of a single user action go out together.
+		"""
+		if not self.send_scheduled:
+			self.send_scheduled = True
+			QtCore.QTimer.singleShot(0, self.send_commit)
+
+	def send_commit(self):
+		"""
+		Send the active commit.
+		"""
+		self.send_scheduled = False
+		if not self.client.online or self.mirror == None:
 			return
+		if self.mirror.has_unsent():
+			commit = {"version": self.mirror.version, "sequence": self.mirror.take_unsent()}
+			self.log.debug("Sending commit {}".format(commit))
+			self.client.commit(commit)
+			self.watch_writes()
 
-		# Send the active commit.
-		if self.active_commit["sequence"] != []:
-			self.active_commit["version"] = self.doc_ver
-			print("Sending commit {}".format(self.active_commit))
-			self.client.commit(self.active_commit)
-			# Reset the commit
-			self.active_commit["sequence"] = []
+	def verify(self):
+		"""
+		Ask for the root hash of the document, to make sure the text
+		still matches the server's (the chunks that don't are fetched again).
+		"""
+		if self.client.online and self.mirror != None and self.mirror.can_verify():
+			self.client.get_hashes()
+			self.watch_writes()
+
+	def update(self):
+		"""
+		The socket is readable: receive the updates from the server.
+		"""
+		if not self.client.online:
+			self.unwatch_socket()
+			return
 
+		# Receive everything there is.
 		self.client.update()
-		# Anything in the queue?
-		if not self.client.queue_sc.empty():
-			msg = self.client.queue_sc.get()
+		while not self.client.queue_sc.empty():
+			self.backlog.append(self.client.queue_sc.get())
+		self.process_backlog()
+
+		# The server may have closed the connection.
+		if not self.client.online:
+			self.unwatch_socket()
+
+	def process_backlog(self):
+		"""
+		Apply as much of the backlog as fits into the tick budget.
+		Consecutive commits are batched into a single edit block.
+		If anything is left over, another round is scheduled
+		right after the pending GUI events.
+		"""
+		self.backlog_scheduled = False
+		max_ops = max(MainWindow.MIN_TICK_OPS, int(MainWindow.TICK_BUDGET / max(self.op_cost, 1e-7)))
+		commits = []
+		ops = 0
+		while len(self.backlog) > 0 and ops < max_ops:
+			msg = self.backlog.popleft()
+			# A new commit?
+			if msg.id == cp.Protocol.RES_COMMIT:
+				commits.append(msg)
+				ops += len(msg.sequence)
+				continue
+			# Anything else is handled in order with the commits.
+			self.apply_commits(commits)
+			commits = []
 			# We've joined? Party?
 			if msg.id == cp.Protocol.RES_OK and msg.req_id == cp.Protocol.REQ_JOIN:
-				pass
+				# Forget the previous document, the text will follow.
+				self.mirror = None
 			# We've received full text?
 			elif msg.id == cp.Protocol.RES_TEXT:
-				self.content.textEdit.setText(msg.text)
+				self.mirror = Mirror(self.docname, self.nickname, utf16=True)
+				self.mirror.set_text(msg.version, msg.text)
+				self.applying_remote = True
+				try:
+					self.content.textEdit.setPlainText(msg.text)
+				finally:
+					self.applying_remote = False
 				# Enable the text editor
 				self.content.textEdit.setDisabled(False)
-			# A new commit?
-			elif msg.id == cp.Protocol.RES_COMMIT:
-				self.log.debug("Received commit {:08X}".format(msg.version))
-				# TODO:: Merging here
-				
-				self.process_commit(msg)
-	
+			# A range of the text: the beginning of it is shown first,
+			# the rest is loaded in the background.
+			elif msg.id == cp.Protocol.RES_RANGE:
+				if self.mirror == None:
+					self.mirror = Mirror(self.docname, self.nickname, utf16=True)
+					self.applying_remote = True
+					try:
+						self.content.textEdit.setPlainText(u"")
+					finally:
+						self.applying_remote = False
+				added = self.mirror.add_range(msg.version, msg.start, msg.length, msg.text)
+				if len(added) > 0:
+					cursor = QtGui.QTextCursor(self.content.textEdit.document())
+					cursor.movePosition(QtGui.QTextCursor.End)
+					self.applying_remote = True
+					try:
+						cursor.insertText(added)
+					finally:
+						self.applying_remote = False
+				self.content.textEdit.setDisabled(False)
+				next_range = self.mirror.next_range()
+				if next_range != None:
+					self.client.get_range(*next_range)
+				ops += 1
+			# The full text in chunks, shown as it arrives.
+			elif msg.id == cp.Protocol.RES_TEXT_BEGIN:
+				self.mirror = Mirror(self.docname, self.nickname, utf16=True)
+				self.mirror.begin_text(msg.version)
+				self.content.textEdit.setDisabled(True)
+				self.applying_remote = True
+				try:
+					self.content.textEdit.setPlainText(u"")
+				finally:
+					self.applying_remote = False
+			elif msg.id == cp.Protocol.RES_TEXT_CHUNK:
+				if self.mirror == None or not self.mirror.is_loading():
+					continue
+				self.mirror.append_text(msg.text)
+				cursor = QtGui.QTextCursor(self.content.textEdit.document())
+				cursor.movePosition(QtGui.QTextCursor.End)
+				self.applying_remote = True
+				try:
+					cursor.insertText(msg.text)
+				finally:
+					self.applying_remote = False
+				ops += 1
+			elif msg.id == cp.Protocol.RES_TEXT_END:
+				if self.mirror == None:
+					continue
+				if not msg.valid:
+					# The client has asked for it again.
+					self.mirror.abort_text()
+					self.applying_remote = True
+					try:
+						self.content.textEdit.setPlainText(u"")
+					finally:
+						self.applying_remote = False
+					continue
+				self.apply_changes(self.mirror.end_text(), time.time())
+				self.content.textEdit.setDisabled(False)
+			# Hashes of the server's text, or the chunks of it we got wrong.
+			elif msg.id == cp.Protocol.RES_HASH:
+				if self.mirror == None:
+					continue
+				if msg.flags & cp.Protocol.HASH_TEXT:
+					changes = self.mirror.repair(msg)
+					if len(changes) > 0:
+						self.log.warning("Repaired the text ({} changes)".format(len(changes)))
+						self.apply_changes(changes, time.time())
+				else:
+					for req in self.mirror.verify(msg):
+						self.client.get_hashes(*req)
+		self.apply_commits(commits)
+		# Whatever was requested from here (or by the client itself).
+		self.watch_writes()
+
+		if len(self.backlog) > 0 and not self.backlog_scheduled:
+			self.backlog_scheduled = True
+			QtCore.QTimer.singleShot(0, self.process_backlog)
+
 	def closeEvent(self, event):
 		"""
 		Handler for the window close event.
 		"""
+		self.unwatch_socket()
 		self.client.close()
@@ -0,0 +1,326 @@
+"""
+In-process metrics: counters, gauges and latency histograms.
+
+Everything here is cheap enough to be left on in production:
+an observation is a lock, an addition and (for histograms)
+a bisect over a short list of bucket bounds.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# Default latency buckets (seconds), roughly logarithmic from 0.1 ms to 10 s.
+LATENCY_BUCKETS = (
+		0.0001, 0.00025, 0.0005,
+		0.001, 0.0025, 0.005,
+		0.01, 0.025, 0.05,
+		0.1, 0.25, 0.5,
+		1.0, 2.5, 5.0, 10.0)
+
+# Default buckets for counting things (ops per commit and the like).
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000)
+
+
+class Counter():
+	"""
+	A monotonically increasing counter.
+	"""
+	TYPE = "counter"
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.value = 0
+
+	def inc(self, amount=1):
+		"""
+		Increase the counter.
+		"""
+		with self.lock:
+			self.value += amount
+
+	def get(self):
+		return self.value
+
+	def samples(self, name, labels):
+		"""
+		Produce (name, labels, value) tuples for the text dump.
+		"""
+		return [(name, labels, self.value)]
+
+
+class Meter(Counter):
+	"""
+	A counter which also tracks its per-second rate
+	as an exponentially weighted moving average.
+	"""
+	# How often (seconds) the moving average is folded in.
+	TICK = 5.0
+	# Smoothing window of the average (seconds).
+	WINDOW = 60.0
+
+	def __init__(self):
+		Counter.__init__(self)
+		self.rate = 0.0
+		self.uncounted = 0
+		self.last_tick = time.time()
+		self.alpha = 1.0 - math.exp(-Meter.TICK / Meter.WINDOW)
+		self.initialized = False
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+			self.uncounted += amount
+			self.tick()
+
+	def tick(self):
+		"""
+		Fold the uncounted events into the moving average.
+		Should be called with the lock held.
+		"""
+		now = time.time()
+		while now - self.last_tick >= Meter.TICK:
+			instant = self.uncounted / Meter.TICK
+			self.uncounted = 0
+			if self.initialized:
+				self.rate += self.alpha * (instant - self.rate)
+			else:
+				self.rate = instant
+				self.initialized = True
+			self.last_tick += Meter.TICK
+			# Long idle periods decay to zero quickly enough.
+			if now - self.last_tick > Meter.WINDOW * 10:
+				self.last_tick = now
+				self.rate = 0.0
+
+	def get_rate(self):
+		"""
+		Get the per-second rate.
+		"""
+		with self.lock:
+			self.tick()
+			return self.rate
+
+	def samples(self, name, labels):
+		return [
+				(name + "_total", labels, self.value),
+				(name + "_rate", labels, self.get_rate())]
+
+
+class Gauge():
+	"""
+	A value that can go up and down.
+	If a function is given, the value is sampled on read.
+	"""
+	TYPE = "gauge"
+
+	def __init__(self, fn=None):
+		self.fn = fn
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+	def get(self):
+		if self.fn != None:
+			try:
+				return self.fn()
+			except Exception:
+				return float("nan")
+		return self.value
+
+	def samples(self, name, labels):
+		return [(name, labels, self.get())]
+
+
+class Histogram():
+	"""
+	A histogram with fixed bucket upper bounds.
+	"""
+	TYPE = "histogram"
+
+	def __init__(self, buckets=LATENCY_BUCKETS):
+		self.lock = threading.Lock()
+		self.bounds = list(buckets)
+		# One extra bucket for +Inf.
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		"""
+		Record a single observation.
+		"""
+		i = bisect.bisect_left(self.bounds, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.sum += value
+			self.count += 1
+
+	def time(self):
+		"""
+		A context manager for timing a block of code.
+		"""
+		return _Timer(self)
+
+	def quantile(self, q):
+		"""
+		Estimate a quantile (upper bound of the bucket it falls into).
+		"""
+		with self.lock:
+			counts = list(self.counts)
+			total = self.count
+		if total == 0:
+			return float("nan")
+		rank = q * total
+		acc = 0
+		for i, c in enumerate(counts):
+			acc += c
+			if acc >= rank:
+				if i < len(self.bounds):
+					return self.bounds[i]
+				break
+		return float("inf")
+
+	def samples(self, name, labels):
+		with self.lock:
+			counts = list(self.counts)
+			hsum = self.sum
+			total = self.count
+		res = []
+		acc = 0
+		for bound, c in zip(self.bounds + [float("inf")], counts):
+			acc += c
+			res.append((name + "_bucket", labels + (("le", _format_value(bound)),), acc))
+		res.append((name + "_sum", labels, hsum))
+		res.append((name + "_count", labels, total))
+		return res
+
+
+class _Timer():
+	"""
+	Times a block of code into a histogram.
+	"""
+	def __init__(self, histogram):
+		self.histogram = histogram
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.histogram.observe(time.time() - self.start)
+		return False
+
+
+class Registry():
+	"""
+	A registry of named (and labelled) metrics.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Metric families by name: (type, help, {labels: metric})
+		self.families = {}
+
+	def get(self, cls, name, description, labels, *args):
+		"""
+		Get or create a metric.
+		"""
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.families.get(name)
+			if family == None:
+				family = (cls.TYPE, description, {})
+				self.families[name] = family
+			metric = family[2].get(key)
+			if metric == None:
+				metric = cls(*args)
+				family[2][key] = metric
+		return metric
+
+	def counter(self, name, description="", **labels):
+		return self.get(Counter, name, description, labels)
+
+	def meter(self, name, description="", **labels):
+		return self.get(Meter, name, description, labels)
+
+	def gauge(self, name, description="", fn=None, **labels):
+		gauge = self.get(Gauge, name, description, labels)
+		if fn != None:
+			gauge.fn = fn
+		return gauge
+
+	def histogram(self, name, description="", buckets=LATENCY_BUCKETS, **labels):
+		return self.get(Histogram, name, description, labels, buckets)
+
+	def remove(self, name, **labels):
+		"""
+		Forget a labelled metric (e.g. of a closed connection).
+		"""
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.families.get(name)
+			if family != None:
+				family[2].pop(key, None)
+
+	def render_text(self):
+		"""
+		Dump all metrics in the Prometheus text exposition format.
+		"""
+		with self.lock:
+			families = [(name, f[0], f[1], list(f[2].items()))
+					for name, f in sorted(self.families.items())]
+		lines = []
+		for name, mtype, description, metrics in families:
+			# Meters are exposed as a counter and a gauge.
+			if mtype == Counter.TYPE and any(isinstance(m, Meter) for k, m in metrics):
+				lines.append(u"# HELP {}_total {}".format(name, description))
+				lines.append(u"# TYPE {}_total counter".format(name))
+			else:
+				lines.append(u"# HELP {} {}".format(name, description))
+				lines.append(u"# TYPE {} {}".format(name, mtype))
+			for labels, metric in sorted(metrics):
+				for sname, slabels, value in metric.samples(name, labels):
+					lines.append(u"{}{} {}".format(
+						sname, _format_labels(slabels), _format_value(value)))
+		return u"\n".join(lines) + u"\n"
+
+
+def _format_labels(labels):
+	"""
+	Format a label tuple as {key="value",...}.
+	"""
+	if len(labels) == 0:
+		return ""
+	return u"{" + u",".join(u"{}=\"{}\"".format(k, _escape(v)) for k, v in labels) + u"}"
+
+def _escape(value):
+	"""
+	Escape a label value.
+	"""
+	if not isinstance(value, basestring):
+		value = unicode(value)
+	return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def _format_value(value):
+	"""
+	Format a sample value.
+	"""
+	if isinstance(value, float):
+		if math.isinf(value):
+			return "+Inf" if value > 0 else "-Inf"
+		if math.isnan(value):
+			return "NaN"
+		return repr(value)
+	return str(value)
+
+
+# The process-wide registry.
+REGISTRY = Registry()
+
+def get_registry():
+	"""
+	Get the process-wide metrics registry.
+	"""
+	return REGISTRY
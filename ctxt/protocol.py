@@ -4,6 +4,7 @@ marshalling and unmarshalling.
 """
 
 import struct
+import zlib
 import ctxt.util as cu
 
 """
@@ -24,8 +25,6 @@ class Protocol():
 	RES_OK = 0x00
 	# Response: Request was erroneous
 	RES_ERROR = 0x01
-	# Response: Move text cursor
-	RES_CURSOR = 0x0D
 	# A commit, both a request as well as response (sequence of insert, remove operations)
 	REQ_COMMIT = 0x0C
 	RES_COMMIT = 0x0C
@@ -35,20 +34,116 @@ class Protocol():
 	RES_INSERT = 0x0E
 	# Response: The text so far
 	RES_TEXT = 0x0F
+	# Response: Server metrics in the Prometheus text format
+	RES_STATS = 0x10
+	# Response: The text so far follows in chunks
+	RES_TEXT_BEGIN = 0x11
+	# Response: A chunk of the text
+	RES_TEXT_CHUNK = 0x12
+	# Response: All of the text has been sent (with a checksum)
+	RES_TEXT_END = 0x13
+	# Response: A range of the text
+	RES_RANGE = 0x14
+	# Response: The text so far, compressed
+	RES_TEXT_Z = 0x15
+	# Response: Requests up to a sequence number have been received
+	RES_ACK = 0x16
+	# Response: A commit, with an acknowledgement
+	RES_COMMIT_ACK = 0x17
+	# Replication: The whole text of a document
+	RES_REPL_TEXT = 0x18
+	# Replication: A commit to a document
+	RES_REPL_COMMIT = 0x19
+	# Response: A page of the document catalog
+	RES_LIST = 0x1A
+	# Response: Search results
+	RES_SEARCH = 0x1B
+	# Response: A document at a past version, or the changes between two versions
+	RES_HISTORY = 0x1C
+	# Response: Hashes of the document's hash tree (and chunks of the text)
+	RES_HASH = 0x1D
+	# Response: An author has moved their cursor (also an operation in a commit,
+	# a commit of nothing else only tells the others where the cursor is)
+	RES_CURSOR = 0x1E
+	# Response: A part of a longer response (split so that others can go in between)
+	RES_PART = 0x1F
+	# Response: A commit with some of the author's own operations in it
+	# (which of them, and an acknowledgement)
+	RES_COMMIT_OWN = 0x20
 
 	# Request to join the active document
 	REQ_JOIN = 0x21
 	# Request to leave
 	REQ_LEAVE = 0x22
+	# Request to follow all documents (or send one again), by a follower server
+	REQ_REPLICATE = 0x23
 
 	# Request for full text
 	REQ_TEXT = 0xE0
+	# Request for server metrics
+	REQ_STATS = 0xE1
+	# Request for a range of the text
+	REQ_RANGE = 0xE2
+	# Request for a page of the document catalog
+	REQ_LIST = 0xE3
+	# Request to search the documents for a text
+	REQ_SEARCH = 0xE4
+	# Request for a document at a past version (or the changes since another one)
+	REQ_HISTORY = 0xE5
+	# Request for hashes of the document's hash tree
+	REQ_HASH = 0xE6
 
 	# Internal close request
 	REQ_INT_CLOSE = 0xFF
 
+	# Full text request flag: send the text in chunks
+	TEXT_CHUNKED = 0x01
+	# Full text request flag: compress the text (unless sent in chunks)
+	TEXT_COMPRESSED = 0x02
+
+	# Characters per text chunk
+	TEXT_CHUNK_SIZE = 16384
+
+	# Range request flag: the range is given in lines, rather than characters
+	RANGE_LINES = 0x01
+
+	# Join flag: acknowledge requests by their (implicit) sequence numbers,
+	# rather than one by one. The join request is number 1.
+	JOIN_CUMULATIVE_ACKS = 0x01
+	# Join flag: only watch the document, commits are not accepted
+	JOIN_SPECTATOR = 0x02
+
+	# Replication request flag: follow the commits to the document, too
+	REPL_SUBSCRIBE = 0x01
+
+	# Catalog orders: by name, by the latest activity or by size (the latter descending)
+	LIST_BY_NAME = 0x00
+	LIST_BY_ACTIVITY = 0x01
+	LIST_BY_SIZE = 0x02
+
+	# History request flag: the changes from the base version, rather than the text
+	HISTORY_DIFF = 0x01
+
+	# Hash request level: the root of the tree, whatever its depth
+	HASH_ROOT = 0xFF
+	# Hash request flag: send the chunks of the text as well (of the lowest level)
+	HASH_TEXT = 0x01
+
+	# Part flag: the last part of the response
+	PART_LAST = 0x01
+
 	# Invalid document name error
 	ERR_INVALID_DOCNAME = 0x01
+	# The server is a read-only follower, commits are not accepted
+	ERR_READ_ONLY = 0x02
+	# Search query too short (at least 3 characters, unless within a document)
+	ERR_INVALID_QUERY = 0x03
+	# The version isn't in the document's history
+	ERR_INVALID_VERSION = 0x04
+	# A commit had operations out of the text's bounds, and was rejected
+	ERR_INVALID_OP = 0x05
+	# A commit had operations out of the text's bounds, and was applied cut to them
+	ERR_REPAIRED_OP = 0x06
 
 	@staticmethod
 	def res_ok(request_id):
@@ -107,18 +202,41 @@ class Protocol():
 		bnlen = len(bname)
 		res = struct.pack(
 				"<BIII{}s".format(bnlen),
-				Protocol.RES_INSERT,
-				bnlen + 4,
+				Protocol.RES_CURSOR,
+				bnlen + 8,
 				cursor,
 				bnlen, str(bname))
 		return res
 
 	@staticmethod
-	def res_commit(version, sequence):
+	def res_ack(seq):
+		"""
+		Cumulative acknowledgement of the requests up to number (seq).
+		"""
+		return struct.pack("<BII", Protocol.RES_ACK, 4, seq)
+
+	@staticmethod
+	def res_commit(version, sequence, ack=None):
 		"""
 		Commit response, consisting of a request or response sequence.
+		With (ack), the commit also acknowledges the requests up to it.
+		"""
+		body = Protocol.commit_body(version, sequence)
+		return Protocol.res_commit_header(len(body), ack) + body
+
+	@staticmethod
+	def commit_body(version, sequence):
+		"""
+		A commit without its header, i.e. the version and the operations.
+		The same body is sent to every author (with their own headers).
+		"""
+		return struct.pack("<I", version) + Protocol.encode_ops(sequence)
+
+	@staticmethod
+	def encode_ops(sequence):
+		"""
+		A binary of an operation sequence.
 		"""
-		# Build a binary of the operation sequence.
 		bseq = bytearray()
 		for op in sequence:
 			op_id = op["id"]
@@ -128,13 +246,30 @@ class Protocol():
 				bseq += Protocol.res_remove(op["name"], op["cursor"], op["length"])
 			elif op_id == Protocol.RES_CURSOR:
 				bseq += Protocol.res_cursor(op["name"], op["cursor"])
-		bslen = len(bseq)
-		
-		res = struct.pack(
-				"<BII{}s".format(bslen),
+		return str(bseq)
+
+	@staticmethod
+	def res_commit_header(blen, ack=None, own=None):
+		"""
+		Header of a commit response, followed by a (blen) bytes long commit body.
+		With (own), a list of (first, count) spans, those operations of the
+		commit are the recipient's own.
+		"""
+		if own != None:
+			spans = b"".join(struct.pack("<II", first, count) for first, count in own)
+			return struct.pack(
+					"<BIII",
+					Protocol.RES_COMMIT_OWN,
+					blen + 8 + len(spans), ack or 0, len(own)) + spans
+		if ack != None:
+			return struct.pack(
+					"<BII",
+					Protocol.RES_COMMIT_ACK,
+					blen + 4, ack)
+		return struct.pack(
+				"<BI",
 				Protocol.RES_COMMIT,
-				bslen + 4, version, str(bseq))
-		return res
+				blen)
 
 	@staticmethod
 	def res_text(version, cursor, text):
@@ -142,25 +277,225 @@ class Protocol():
 		Server says: "Here's thy doctrine"
 		Full text response.
 		"""
+		btext = text.encode("utf8")
+		return Protocol.res_text_header(version, cursor, len(btext)) + btext
+
+	@staticmethod
+	def res_text_header(version, cursor, blen):
+		"""
+		Header of a full text response, followed by (blen) bytes of UTF-8 text
+		(so that an already encoded text can be sent as it is).
+		"""
+		return struct.pack(
+				"<BIII",
+				Protocol.RES_TEXT,
+				blen + 8, version, cursor)
+
+	@staticmethod
+	def res_text_z_header(version, cursor, blen, zlen):
+		"""
+		Header of a compressed full text response: (zlen) bytes of
+		zlib compressed, (blen) bytes long UTF-8 text follow.
+		"""
+		return struct.pack(
+				"<BIIII",
+				Protocol.RES_TEXT_Z,
+				zlen + 12, version, cursor, blen)
+
+	@staticmethod
+	def res_text_begin(version, cursor, length):
+		"""
+		Full text response in chunks: (length) characters will follow.
+		"""
+		return struct.pack(
+				"<BIIII",
+				Protocol.RES_TEXT_BEGIN,
+				12, version, cursor, length)
+
+	@staticmethod
+	def res_text_chunk(offset, text):
+		"""
+		A chunk of the full text, starting at character (offset).
+		"""
+		btext = text.encode("utf8")
+		return struct.pack(
+				"<BII",
+				Protocol.RES_TEXT_CHUNK,
+				len(btext) + 4, offset) + btext
+
+	@staticmethod
+	def res_text_end(version, checksum):
+		"""
+		End of the full text, with the CRC32 of its UTF-8 encoding.
+		"""
+		return struct.pack(
+				"<BIII",
+				Protocol.RES_TEXT_END,
+				8, version, checksum)
+
+	@staticmethod
+	def text_chunks(text, size=None):
+		"""
+		Split a text into chunks (only one chunk is copied at a time).
+		"""
+		if size == None:
+			size = Protocol.TEXT_CHUNK_SIZE
+		for offset in range(0, len(text), size):
+			yield (offset, text[offset:offset + size])
+
+	@staticmethod
+	def checksum(btext, crc=0):
+		"""
+		Running CRC32 of UTF-8 encoded text.
+		"""
+		return zlib.crc32(btext, crc) & 0xFFFFFFFF
+
+	@staticmethod
+	def res_range(version, start, length, lines, text):
+		"""
+		A range of the text, starting at character (start), of a
+		document that is (length) characters and (lines) lines long.
+		"""
+		btext = text.encode("utf8")
+		return struct.pack(
+				"<BIIIII",
+				Protocol.RES_RANGE,
+				len(btext) + 16, version, start, length, lines) + btext
+
+	@staticmethod
+	def res_part(data, last):
+		"""
+		A part of a longer response (the (last) one, or not).
+		"""
+		return struct.pack(
+				"<BIB",
+				Protocol.RES_PART,
+				len(data) + 1,
+				Protocol.PART_LAST if last else 0) + data
+
+	@staticmethod
+	def split_frame(frame, size):
+		"""
+		Split a response into parts of (size) bytes at most.
+		"""
+		for offset in range(0, len(frame), size):
+			yield Protocol.res_part(frame[offset:offset + size], offset + size >= len(frame))
+
+	@staticmethod
+	def res_repl_text(docname, version, btext):
+		"""
+		Replication: document (docname) is at (version), with
+		the (already UTF-8 encoded) text (btext).
+		"""
+		bname = docname.encode("utf8")
+		return struct.pack(
+				"<BIII",
+				Protocol.RES_REPL_TEXT,
+				len(bname) + len(btext) + 8,
+				version, len(bname)) + bname + btext
+
+	@staticmethod
+	def res_repl_commit(docname, body):
+		"""
+		Replication: a commit to document (docname),
+		wrapping a commit response (with the commit body).
+		"""
+		bname = docname.encode("utf8")
+		bcommit = Protocol.res_commit_header(len(body)) + body
+		return struct.pack(
+				"<BII",
+				Protocol.RES_REPL_COMMIT,
+				len(bname) + len(bcommit) + 4,
+				len(bname)) + bname + bcommit
+
+	@staticmethod
+	def res_list(total, entries):
+		"""
+		A page of the document catalog, (total) documents matching
+		the filter. Every entry has the document's "name", "size",
+		"version", number of "authors" and latest "active" time.
+		"""
+		res = bytearray(struct.pack("<II", total, len(entries)))
+		for entry in entries:
+			bname = entry["name"].encode("utf8")
+			res += struct.pack("<IIIdI", entry["size"], entry["version"],
+					entry["authors"], entry["active"], len(bname))
+			res += bname
+		return struct.pack("<BI", Protocol.RES_LIST, len(res)) + str(res)
+
+	@staticmethod
+	def res_search(matches):
+		"""
+		Search results: every match has the "doc" it's in, its
+		character "offset" and "line", and the "context" (its line,
+		or a part of it).
+		"""
+		res = bytearray(struct.pack("<I", len(matches)))
+		for match in matches:
+			bdoc = match["doc"].encode("utf8")
+			bcontext = match["context"].encode("utf8")
+			res += struct.pack("<IIII", match["offset"], match["line"],
+					len(bdoc), len(bcontext))
+			res += bdoc + bcontext
+		return struct.pack("<BI", Protocol.RES_SEARCH, len(res)) + str(res)
+
+	@staticmethod
+	def res_history(version, base, flags, text=None, sequence=None):
+		"""
+		A document at (version): its (text), or (with HISTORY_DIFF)
+		the (sequence) of operations changing it from (base) to (version).
+		"""
+		if flags & Protocol.HISTORY_DIFF:
+			payload = Protocol.encode_ops(sequence)
+		else:
+			payload = text.encode("utf8")
+		return struct.pack(
+				"<BIIIB",
+				Protocol.RES_HISTORY,
+				len(payload) + 9, version, base, flags) + payload
+
+	@staticmethod
+	def res_hash(version, length, depth, level, flags, first, hashes, chunks=None):
+		"""
+		The (hashes) of a (level) of the hash tree, from (first) on,
+		of a document (length) characters long at (version), whose
+		tree has (depth) levels. With HASH_TEXT, the (chunks)
+		of the text under them follow.
+		"""
+		res = bytearray(struct.pack("<IIBBBII", version, length, depth, level, flags,
+			first, len(hashes)))
+		for h in hashes:
+			res += h
+		if flags & Protocol.HASH_TEXT:
+			for chunk in chunks:
+				bchunk = chunk.encode("utf8")
+				res += struct.pack("<I", len(bchunk)) + bchunk
+		return struct.pack("<BI", Protocol.RES_HASH, len(res)) + str(res)
+
+	@staticmethod
+	def res_stats(text):
+		"""
+		Server metrics dump (Prometheus text exposition format).
+		"""
 		btext = bytearray(text, "utf8")
 		blen = len(btext)
-		# TODO:: Should we have timestamp here, as well?
-		# Or some kind of a commit hash?
-		req = struct.pack(
-				"<BIII{}s".format(blen),
-				Protocol.RES_TEXT,
-				blen + 8, version, cursor,
-				str(btext))
-		return req
+		res = struct.pack(
+				"<BI{}s".format(blen),
+				Protocol.RES_STATS,
+				blen, str(btext))
+		return res
 
 	@staticmethod
-	def req_join(name, doc):
+	def req_join(name, doc, flags=0):
 		"""
 		Join request from the client.
+		The flags follow the document name, after a NUL.
 		"""
 		bname = bytearray(name, "utf8")
 		bnlen = len(bname)
 		bdoc = bytearray(doc, "utf8")
+		if flags != 0:
+			bdoc += b"\0" + struct.pack("<I", flags)
 		bdlen = len(bdoc)
 		req = struct.pack(
 				"<BII{}s{}s".format(bnlen, bdlen),
@@ -180,13 +515,102 @@ class Protocol():
 		return req
 
 	@staticmethod
-	def req_text():
+	def req_replicate(doc=u"", flags=0):
+		"""
+		Replication request from a follower server: send all documents
+		and the commits to them from now on. With (doc), only send
+		that document (again), and with REPL_SUBSCRIBE, its commits
+		from now on as well.
+		"""
+		bdoc = doc.encode("utf8")
+		return struct.pack(
+				"<BIB",
+				Protocol.REQ_REPLICATE,
+				len(bdoc) + 1, flags) + bdoc
+
+	@staticmethod
+	def req_text(flags=0):
 		"""
 		Request for the full text that is being edited by others.
+		With the TEXT_CHUNKED flag, the text is sent in chunks.
 		"""
+		if flags == 0:
+			return struct.pack("<BI", Protocol.REQ_TEXT, 0)
 		req = struct.pack(
-				"<BI", 
+				"<BIB", 
 				Protocol.REQ_TEXT, 
+				1, flags)
+		return req
+
+	@staticmethod
+	def req_range(start, end, flags=0):
+		"""
+		Request for the text from (start) up to (end),
+		either characters or (with RANGE_LINES) lines.
+		"""
+		req = struct.pack(
+				"<BIBII",
+				Protocol.REQ_RANGE,
+				9, flags, start, end)
+		return req
+
+	@staticmethod
+	def req_list(prefix=u"", offset=0, limit=100, order=0):
+		"""
+		Request for a page of the document catalog: (limit) documents
+		from (offset) on, with names starting with (prefix), in (order).
+		"""
+		bprefix = prefix.encode("utf8")
+		return struct.pack(
+				"<BIBII",
+				Protocol.REQ_LIST,
+				len(bprefix) + 9, order, offset, limit) + bprefix
+
+	@staticmethod
+	def req_search(query, doc=u"", limit=100):
+		"""
+		Request to search for (query), within document (doc) or in
+		all of them, for (limit) matches at most.
+		"""
+		bdoc = doc.encode("utf8")
+		bquery = query.encode("utf8")
+		return struct.pack(
+				"<BIII",
+				Protocol.REQ_SEARCH,
+				len(bdoc) + len(bquery) + 8, limit, len(bdoc)) + bdoc + bquery
+
+	@staticmethod
+	def req_history(version, base=0, flags=0, doc=u""):
+		"""
+		Request for document (doc) (or the joined one) at (version),
+		or with HISTORY_DIFF, for the changes from (base) to (version).
+		"""
+		bdoc = doc.encode("utf8")
+		return struct.pack(
+				"<BIBII",
+				Protocol.REQ_HISTORY,
+				len(bdoc) + 9, flags, version, base) + bdoc
+
+	@staticmethod
+	def req_hash(level=0xFF, first=0, count=1, flags=0):
+		"""
+		Request for (count) hashes of a (level) of the hash tree
+		(the leaves being level 0), from (first) on.
+		By default, for the root.
+		"""
+		return struct.pack(
+				"<BIBBII",
+				Protocol.REQ_HASH,
+				10, level, flags, first, count)
+
+	@staticmethod
+	def req_stats():
+		"""
+		Request for the server metrics.
+		"""
+		req = struct.pack(
+				"<BI",
+				Protocol.REQ_STATS,
 				0)
 		return req
 
@@ -269,16 +693,121 @@ class Protocol():
 			breq = breq[4:]
 			bname, = struct.unpack("<{}s".format(bnlen), breq[:bnlen])
 			d["name"] = bname.decode("utf-8")
-			# Extract document name
-			d["doc"] = breq[bnlen:].decode("utf-8")
+			# Extract document name, and flags (if any)
+			bdoc = breq[bnlen:]
+			d["flags"] = 0
+			end = bdoc.find(b"\0")
+			if end >= 0:
+				d["flags"], = struct.unpack("<I", bdoc[end + 1:end + 5])
+				bdoc = bdoc[:end]
+			d["doc"] = bdoc.decode("utf-8")
 		# Or leave?
 		elif r_id == Protocol.REQ_LEAVE:
 			# No arguments here.
 			pass
+		# Replication request?
+		elif r_id == Protocol.REQ_REPLICATE:
+			d["flags"] = breq[0]
+			d["doc"] = breq[1:].decode("utf-8")
 		# A full text request?
 		elif r_id == Protocol.REQ_TEXT:
+			# Optional flags
+			d["flags"] = breq[0] if len(breq) > 0 else 0
+		# A range request?
+		elif r_id == Protocol.REQ_RANGE:
+			flags, start, end = struct.unpack("<BII", breq[:9])
+			d["flags"] = flags
+			d["start"] = start
+			d["end"] = end
+		# A catalog request?
+		elif r_id == Protocol.REQ_LIST:
+			order, offset, limit = struct.unpack("<BII", breq[:9])
+			d["order"] = order
+			d["offset"] = offset
+			d["limit"] = limit
+			d["prefix"] = breq[9:].decode("utf-8")
+		# A search request?
+		elif r_id == Protocol.REQ_SEARCH:
+			limit, bdlen = struct.unpack("<II", breq[:8])
+			d["limit"] = limit
+			d["doc"] = breq[8:8 + bdlen].decode("utf-8")
+			d["query"] = breq[8 + bdlen:].decode("utf-8")
+		# A history request?
+		elif r_id == Protocol.REQ_HISTORY:
+			flags, version, base = struct.unpack("<BII", breq[:9])
+			d["flags"] = flags
+			d["version"] = version
+			d["base"] = base
+			d["doc"] = breq[9:].decode("utf-8")
+		# A hash tree request?
+		elif r_id == Protocol.REQ_HASH:
+			level, flags, first, count = struct.unpack("<BBII", breq[:10])
+			d["level"] = level
+			d["flags"] = flags
+			d["first"] = first
+			d["count"] = count
+		# A metrics request?
+		elif r_id == Protocol.REQ_STATS:
 			# No arguments
 			pass
+		elif r_id == Protocol.RES_STATS:
+			d["text"] = breq.decode("utf-8")
+		# Presence (the same as the operation)
+		elif r_id == Protocol.RES_CURSOR:
+			_, d = Protocol.unpack_op(breq_original)
+		elif r_id == Protocol.RES_SEARCH:
+			count, = struct.unpack("<I", breq[:4])
+			d["matches"] = []
+			pos = 4
+			for i in range(count):
+				offset, line, bdlen, bclen = struct.unpack("<IIII", breq[pos:pos + 16])
+				pos += 16
+				d["matches"].append({"offset": offset, "line": line,
+					"doc": breq[pos:pos + bdlen].decode("utf-8"),
+					"context": breq[pos + bdlen:pos + bdlen + bclen].decode("utf-8")})
+				pos += bdlen + bclen
+		elif r_id == Protocol.RES_HISTORY:
+			version, base, flags = struct.unpack("<IIB", breq[:9])
+			d["version"] = version
+			d["base"] = base
+			d["flags"] = flags
+			breq = breq[9:]
+			if flags & Protocol.HISTORY_DIFF:
+				d["sequence"] = []
+				while len(breq) > 0:
+					breq, dop = Protocol.unpack_op(breq)
+					d["sequence"].append(dop)
+			else:
+				d["text"] = breq.decode("utf-8")
+		elif r_id == Protocol.RES_HASH:
+			version, length, depth, level, flags, first, count = struct.unpack(
+				"<IIBBBII", breq[:19])
+			d["version"] = version
+			d["length"] = length
+			d["depth"] = depth
+			d["level"] = level
+			d["flags"] = flags
+			d["first"] = first
+			pos = 19
+			d["hashes"] = [bytes(breq[pos + i * 8:pos + (i + 1) * 8]) for i in range(count)]
+			pos += count * 8
+			if flags & Protocol.HASH_TEXT:
+				d["chunks"] = []
+				for i in range(count):
+					blen, = struct.unpack("<I", breq[pos:pos + 4])
+					d["chunks"].append(breq[pos + 4:pos + 4 + blen].decode("utf-8"))
+					pos += 4 + blen
+		elif r_id == Protocol.RES_LIST:
+			total, count = struct.unpack("<II", breq[:8])
+			d["total"] = total
+			d["entries"] = []
+			pos = 8
+			for i in range(count):
+				size, version, authors, active, bnlen = struct.unpack("<IIIdI", breq[pos:pos + 24])
+				pos += 24
+				d["entries"].append({"name": breq[pos:pos + bnlen].decode("utf-8"),
+					"size": size, "version": version, "authors": authors, "active": active})
+				pos += bnlen
 		elif r_id == Protocol.RES_TEXT:
 			# Extract version, cursor
 			version, cursor, = struct.unpack("<II", breq[:8])
@@ -286,8 +815,65 @@ class Protocol():
 			d["cursor"] = cursor
 			# Extract text
 			d["text"] = breq[8:].decode("utf-8")
+		elif r_id == Protocol.RES_TEXT_Z:
+			version, cursor, blen = struct.unpack("<III", breq[:12])
+			d["version"] = version
+			d["cursor"] = cursor
+			d["text"] = zlib.decompress(bytes(breq[12:])).decode("utf-8")
+		# Full text in chunks?
+		elif r_id == Protocol.RES_TEXT_BEGIN:
+			version, cursor, length = struct.unpack("<III", breq[:12])
+			d["version"] = version
+			d["cursor"] = cursor
+			d["length"] = length
+		elif r_id == Protocol.RES_TEXT_CHUNK:
+			offset, = struct.unpack("<I", breq[:4])
+			d["offset"] = offset
+			d["text"] = breq[4:].decode("utf-8")
+		elif r_id == Protocol.RES_TEXT_END:
+			version, checksum = struct.unpack("<II", breq[:8])
+			d["version"] = version
+			d["checksum"] = checksum
+		elif r_id == Protocol.RES_RANGE:
+			version, start, length, lines = struct.unpack("<IIII", breq[:16])
+			d["version"] = version
+			d["start"] = start
+			d["length"] = length
+			d["lines"] = lines
+			d["text"] = breq[16:].decode("utf-8")
+		elif r_id == Protocol.RES_PART:
+			d["flags"], = struct.unpack("<B", breq[:1])
+			d["data"] = bytes(breq[1:])
+		# Replication
+		elif r_id == Protocol.RES_REPL_TEXT:
+			version, bnlen = struct.unpack("<II", breq[:8])
+			d["version"] = version
+			d["doc"] = breq[8:8 + bnlen].decode("utf-8")
+			d["text"] = breq[8 + bnlen:].decode("utf-8")
+		elif r_id == Protocol.RES_REPL_COMMIT:
+			bnlen, = struct.unpack("<I", breq[:4])
+			# The commit itself is a whole response.
+			bcommit = breq[4 + bnlen:]
+			d = Protocol.unpack(bcommit)
+			d["id"] = r_id
+			# Relays pass the body on as it is.
+			d["body"] = bytes(bcommit[Protocol.MIN_REQ_LEN:])
+			d["doc"] = breq[4:4 + bnlen].decode("utf-8")
 		# Commit?
-		elif r_id == Protocol.RES_COMMIT:
+		elif r_id in [Protocol.RES_COMMIT, Protocol.RES_COMMIT_ACK, Protocol.RES_COMMIT_OWN]:
+			if r_id == Protocol.RES_COMMIT_ACK:
+				# Extract the acknowledgement, it's a commit otherwise.
+				d["ack"], = struct.unpack("<I", breq[:4])
+				d["id"] = Protocol.RES_COMMIT
+				breq = breq[4:]
+			elif r_id == Protocol.RES_COMMIT_OWN:
+				# The acknowledgement (if any), and which operations are ours.
+				ack, count = struct.unpack("<II", breq[:8])
+				if ack != 0:
+					d["ack"] = ack
+				d["own"] = [struct.unpack("<II", bytes(breq[8 + 8 * i:16 + 8 * i])) for i in range(count)]
+				d["id"] = Protocol.RES_COMMIT
+				breq = breq[8 + 8 * count:]
 			# Extract version
 			version, = struct.unpack("<I", breq[:4])
 			d["version"] = version
@@ -301,12 +887,34 @@ class Protocol():
 		elif r_id == Protocol.RES_OK:
 			req, = struct.unpack("<B", breq[:1])
 			d["req_id"] = req
+		# Cumulative acknowledgement
+		elif r_id == Protocol.RES_ACK:
+			d["seq"], = struct.unpack("<I", breq[:4])
 		# Error response
 		elif r_id == Protocol.RES_ERROR:
 			error, = struct.unpack("<I", breq[:4])
 			d["error"] = error
 		return d
 
+class Parts():
+	"""
+	Puts a response that has been split into parts back together.
+	"""
+	def __init__(self):
+		self.data = bytearray()
+
+	def add(self, d):
+		"""
+		Add a part (unpacked). Returns the whole response
+		once the last part has arrived, None until then.
+		"""
+		self.data += d["data"]
+		if not d["flags"] & Protocol.PART_LAST:
+			return None
+		frame = bytes(self.data)
+		self.data = bytearray()
+		return frame
+
 class Message():
 	"""
 	Class for describing the messages to be passed up & down the queues.
@@ -0,0 +1,160 @@
+"""
+Catalog of the documents on the server.
+
+A small SQLite database (apart from the documents themselves) with
+a row per document: its size, version, number of authors, and when
+it was created and last changed. It's updated with every commit, so
+listing the documents never needs to open (or even stat) them.
+"""
+import logging
+import sqlite3
+import time
+
+import ctxt.protocol as cp
+
+
+class Catalog():
+	"""
+	Document catalog, used from the server thread only.
+	"""
+	LOGNAME = "CT.Server.Catalog"
+
+	# Longest time (s) to keep updates in a transaction.
+	BATCH_INTERVAL = 0.1
+	# Most entries in a single page.
+	MAX_PAGE = 1000
+
+	SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS documents (
+			name TEXT PRIMARY KEY,
+			size INTEGER NOT NULL,
+			version INTEGER NOT NULL,
+			authors INTEGER NOT NULL,
+			created REAL NOT NULL,
+			active REAL NOT NULL)""",
+		"""CREATE INDEX IF NOT EXISTS documents_active ON documents (active)""",
+		"""CREATE INDEX IF NOT EXISTS documents_size ON documents (size)""",
+		"""CREATE TABLE IF NOT EXISTS authors (
+			doc TEXT NOT NULL,
+			name TEXT NOT NULL,
+			PRIMARY KEY (doc, name))""",
+	]
+
+	ORDERS = {
+		cp.Protocol.LIST_BY_NAME: "name",
+		cp.Protocol.LIST_BY_ACTIVITY: "active DESC, name",
+		cp.Protocol.LIST_BY_SIZE: "size DESC, name",
+	}
+
+	def __init__(self, path):
+		self.log = logging.getLogger(Catalog.LOGNAME)
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		for sql in Catalog.SCHEMA:
+			self.db.execute(sql)
+		self.db.commit()
+		self.t_begin = None
+		# Known authors of the documents that have been changed.
+		self.authors = {}
+
+	def sync(self, storage):
+		"""
+		Add the stored documents that aren't in the catalog yet
+		(e.g. when the catalog is new).
+		"""
+		known = set(name for name, in self.db.execute("SELECT name FROM documents"))
+		missing = [name for name in storage.list_names() if name not in known]
+		if len(missing) == 0:
+			return
+		self.log.info("Adding {} documents to the catalog".format(len(missing)))
+		for name in missing:
+			meta = storage.get_meta(name)
+			if meta != None:
+				self.db.execute(
+						"INSERT OR IGNORE INTO documents (name, size, version, authors, created, active) "
+						"VALUES (?, ?, ?, 0, ?, ?)",
+						(name, meta["size"], meta["version"], meta["modified"], meta["modified"]))
+		self.db.commit()
+
+	def add(self, doc):
+		"""
+		A document has been opened (or created).
+		"""
+		now = time.time()
+		self.db.execute(
+				"INSERT OR IGNORE INTO documents (name, size, version, authors, created, active) "
+				"VALUES (?, ?, ?, 0, ?, ?)",
+				(doc.get_name(), len(doc.get_whole()), doc.get_version(), now, now))
+		self.wrote()
+
+	def update(self, doc, names=()):
+		"""
+		A document has changed, by the authors of (names) (as their
+		connections joined, the names in the operations are up to
+		the clients).
+		"""
+		name = doc.get_name()
+		authors = self.get_authors(name)
+		added = 0
+		for author in names:
+			if author != None and author not in authors:
+				authors.add(author)
+				self.db.execute("INSERT OR IGNORE INTO authors (doc, name) VALUES (?, ?)",
+						(name, author))
+				added += 1
+		self.db.execute(
+				"UPDATE documents SET size = ?, version = ?, authors = authors + ?, active = ? "
+				"WHERE name = ?",
+				(len(doc.get_whole()), doc.get_version(), added, time.time(), name))
+		self.wrote()
+
+	def get_authors(self, name):
+		"""
+		The known authors of a document.
+		"""
+		if name not in self.authors:
+			self.authors[name] = set(author for author, in self.db.execute(
+				"SELECT name FROM authors WHERE doc = ?", (name,)))
+		return self.authors[name]
+
+	def wrote(self):
+		if self.t_begin == None:
+			self.t_begin = time.time()
+		self.flush()
+
+	def flush(self, force=False):
+		"""
+		Finish the transaction, if it's been open long enough (or forced).
+		"""
+		if self.t_begin == None:
+			return
+		if force or time.time() - self.t_begin >= Catalog.BATCH_INTERVAL:
+			self.db.commit()
+			self.t_begin = None
+
+	def list(self, prefix=u"", offset=0, limit=100, order=cp.Protocol.LIST_BY_NAME):
+		"""
+		A page of the catalog: (number of matching documents, entries).
+		"""
+		where = ""
+		args = []
+		if len(prefix) > 0:
+			# A range, so that the primary key index is used.
+			where = "WHERE name >= ? AND name < ?"
+			args = [prefix, prefix + u"\U0010FFFF"]
+		total, = self.db.execute("SELECT COUNT(*) FROM documents " + where, args).fetchone()
+		rows = self.db.execute(
+				"SELECT name, size, version, authors, active FROM documents {} "
+				"ORDER BY {} LIMIT ? OFFSET ?".format(where,
+					Catalog.ORDERS.get(order, "name")),
+				args + [min(limit, Catalog.MAX_PAGE), offset])
+		entries = []
+		for name, size, version, authors, active in rows:
+			entries.append({"name": name, "size": size, "version": version,
+				"authors": authors, "active": active})
+		return (total, entries)
+
+	def close(self):
+		self.flush(True)
+		self.db.close()
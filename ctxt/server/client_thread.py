@@ -2,12 +2,20 @@
 Client thread class for the server.
 """
 import Queue as queue
+import collections
 import errno
+import fcntl
 import logging
+import os
+import select
 import socket
 import threading
+import time
+import types
 
+import ctxt.metrics as cm
 import ctxt.protocol as cp
+from ctxt.server.rate_limit import RateLimit
 
 
 class ClientThread(threading.Thread):
@@ -23,7 +31,26 @@ class ClientThread(threading.Thread):
 	# Or mayhaps they've already left?
 	STAT_LEFT = 2
 
-	def __init__(self, uid, socket, source, queue_cs):
+	# How much to read from the socket at once.
+	RECV_SIZE = 65536
+	# How much to send with a single system call, at most.
+	FLUSH_BYTES = 262144
+	# How long an acknowledgement may wait for a commit to ride on (s).
+	ACK_DELAY = 0.02
+
+	# Priority classes of the responses: interactive (commits, and
+	# whatever must stay in order with them), presence (cursors)
+	# and bulk transfers (chunks of texts, ranges, history, search results).
+	PRIO_INTERACTIVE = 0
+	PRIO_PRESENCE = 1
+	PRIO_BULK = 2
+	# Most bytes of bulk transfers to have on the way at once,
+	# ahead of whatever interactive responses come next.
+	BULK_BYTES = 32768
+	# Longer bulk responses are split into parts of this size (bytes).
+	PART_BYTES = 32768
+
+	def __init__(self, uid, socket, source, queue_cs, limits=(0, 0)):
 		threading.Thread.__init__(self)
 
 		self.online = False
@@ -46,9 +73,69 @@ class ClientThread(threading.Thread):
 		self.queue_cs = queue_cs
 		# From Server to Client
 		self.queue_sc = queue.Queue()
+		# Wakes the thread up when there's something in the queue.
+		self.wake_r, self.wake_w = os.pipe()
+		for fd in [self.wake_r, self.wake_w]:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+		# Received data that doesn't make a complete request yet
+		# (or requests held back by the rate limit).
+		self.rx_buffer = bytearray()
+		# When the requests held back may go on (None if there are none).
+		self.rx_deferred = None
+		# Responses being sent, in order, and how much
+		# of the first one has been sent already.
+		self.tx_frames = collections.deque()
+		self.tx_offset = 0
+		self.tx_bytes = 0
+		# And the responses waiting to be, by priority class:
+		# interactive and bulk ones in order, the latest presence
+		# by author. Bulk ones are (frame, key, document, more parts
+		# to follow), see send(), the frame being possibly a generator
+		# of frames, built as they're sent.
+		self.tx_interactive = collections.deque()
+		self.tx_presence = collections.OrderedDict()
+		self.tx_bulk = collections.deque()
+		# Bulk responses waiting that the commits to a document
+		# must not overtake, by document name.
+		self.tx_ordered = {}
+		# Has a response been split into parts, and some of them
+		# are on the way already?
+		self.tx_partial = False
 
 		self.cursor_pos = 0
 
+		# Is the client a follower server, replicating documents?
+		self.replica = False
+		# Or a spectator, only watching a document?
+		self.spectator = False
+
+		# Acknowledge requests by sequence number, rather than one by one?
+		self.cumulative_acks = False
+		# Requests received since the join (the join being number 1).
+		self.rx_seq = 0
+		# Requests acknowledged so far.
+		self.acked_seq = 0
+		# When the pending acknowledgement must go out at the latest.
+		self.ack_due = None
+
+		# Per-connection metrics.
+		metrics = cm.get_registry()
+		self.bytes_in = metrics.counter("ctxt_connection_bytes_in",
+				"Bytes received from a connection", conn=self.uid)
+		self.bytes_out = metrics.counter("ctxt_connection_bytes_out",
+				"Bytes sent to a connection", conn=self.uid)
+		metrics.gauge("ctxt_queue_sc_depth",
+				"Messages waiting in a Server -> Client queue",
+				fn=self.queue_sc.qsize, conn=self.uid)
+		self.fanout_latency = metrics.histogram("ctxt_commit_fanout_seconds",
+				"Latency from receiving a commit to sending it to an author")
+		# Operations and bytes per second (limits), if limited.
+		self.limit = None
+		if limits[0] > 0 or limits[1] > 0:
+			self.limit = RateLimit(limits[0], limits[1], metrics.counter("ctxt_rate_limited",
+				"Times a rate limit has held requests back", scope="connection"))
+
 	def __repr__(self):
 		"""
 		Useful for logging with client source (helps to tell them apart).
@@ -59,94 +146,495 @@ class ClientThread(threading.Thread):
 	def run(self):
 		"""
 		Thread loop until the client is "online".
+		Sleeps until the socket has something for us (or can take
+		what we have), or the server has queued something.
 		"""
 		self.online = True
 		while self.online:
 			try:
+				timeout = None
+				due = [t for t in [self.ack_due, self.rx_deferred] if t != None]
+				if len(due) > 0:
+					timeout = max(0.0, min(due) - time.time())
+				# Over the rate limit, the requests wait in the socket
+				# (and the client is slowed down by TCP).
+				rlist = [self.wake_r]
+				if self.rx_deferred == None:
+					rlist.append(self.socket)
+				wlist = [self.socket] if self.has_pending() else []
+				readable, writable, _ = select.select(rlist, wlist, [], timeout)
+				if self.wake_r in readable:
+					self.drain_wakeups()
+
 				# Anything in the Server -> Client queue?
-				if not self.queue_sc.empty():
-					msg = self.queue_sc.get()
-					if msg.internal:
-						# Uh oh, gotta go..
-						if msg.id == cp.Protocol.REQ_INT_CLOSE:
-							self.online = False
-					else:
-						# Forward commits.
-						if msg.id == cp.Protocol.RES_COMMIT:
-							self.log.debug(u"Forwarding commit {}:{}".format(
-								msg.version, msg.sequence))
-							res = cp.Protocol.res_commit(msg.version, msg.sequence)
-							self.socket.sendall(res)
-						# Forward full text responses.
-						elif msg.id == cp.Protocol.RES_TEXT:
-							self.log.debug(u"Forwarding full text to {} ({})".format(msg.name, msg.uid))
-							res = cp.Protocol.res_text(msg.version, self.cursor_pos, unicode(msg.text))
-							self.socket.sendall(res)
-
-				# Receive request header
-				hdr = self.socket.recv(cp.Protocol.MIN_REQ_LEN)
-				if len(hdr) < cp.Protocol.MIN_REQ_LEN:
+				while not self.queue_sc.empty():
+					self.handle_message(self.queue_sc.get())
+				# Received requests?
+				if self.socket in readable:
+					self.receive()
+				# Or may the ones held back go on?
+				elif self.rx_deferred != None and time.time() >= self.rx_deferred:
+					self.handle_frames()
+
+				# No commit to carry the acknowledgement?
+				if self.ack_due != None and time.time() >= self.ack_due:
+					self.send(cp.Protocol.res_ack(self.take_ack()))
+				# Send everything gathered in this round at once.
+				self.flush()
+
+			except socket.error as e:
+				if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR]:
 					continue
-				# Extract payload length
-				r_len = cp.Protocol.get_len(hdr)
-				# Receive request payload
-				if r_len > 0:
-					data = self.socket.recv(r_len)
-					if len(data) < r_len:
-						self.log.warning("Dropped request. Should increase timeout?")
-						continue
+				if e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
+					self.log.debug("Received {}, closing socket".format(errno.errorcode[e.errno]))
 				else:
-					data = ''
-				# Unpack the request
-				d = cp.Protocol.unpack(hdr + data)
-				self.log.debug("Request: {}".format(d))
-				msg = cp.Message(d, False)
-				msg.source = (self.address, self.port)
-				msg.uid = self.uid
-
-				# Some requests can be acknowledged right away.
-				if msg.id == cp.Protocol.REQ_JOIN:
-					# Validate document name
-					if len(msg.doc) < 1 or len(msg.doc) > 128:
-						self.log.error("Invalid document name \"{}\", sending Nack.".format(msg.doc))
-						res = cp.Protocol.res_error(cp.Protocol.ERR_INVALID_DOCNAME)
-						self.socket.sendall(res)
-						continue
-
-					self.name = msg.name
-					self.docname = msg.doc
-					self.state += 1
-
-					# TODO:: Any auth?
-					# TODO:: Send the current version of the whole document.
-
-				# A commit, consisting of several operations.
-				elif msg.id in [cp.Protocol.REQ_COMMIT, cp.Protocol.REQ_TEXT]:
-					msg.name = self.name
-					msg.doc = self.docname
-				# Forward to the server
-				self.queue_cs.put(msg)
-
-				# Acknowledge the request.
-				self.log.debug("Sending Ack")
-				res = cp.Protocol.res_ok(msg.id)
-				self.socket.sendall(res)
-
-			except socket.timeout:
-				pass
-			except socket.error as e:
-				# Resource temporarily not available?
-				# Until next time, then.
-				if e.errno not in [errno.EWOULDBLOCK]:
 					self.log.exception(e)
-				if e.errno in (errno.ECONNRESET, errno.ECONNABORTED):
-					self.log.debug("Received {}, closing socket".format(errno.errorcode[e.errno]))
+				break
+			except select.error as e:
+				if e.args[0] != errno.EINTR:
+					self.log.exception(e)
 					break
 			except Exception as e:
 				# TODO:: Limit looped logs, somehow.
 				self.log.exception(e)
+		self.online = False
 		self.log.info("Closing socket")
 		self.socket.close()
+		self.forget_metrics()
+
+	def put(self, msg):
+		"""
+		Queue a message for the client (from the server thread),
+		and wake the thread up.
+		"""
+		self.queue_sc.put(msg)
+		try:
+			os.write(self.wake_w, b"x")
+		except OSError as e:
+			# The pipe is full, so the thread is going to wake up anyway.
+			if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				raise
+
+	def release(self):
+		"""
+		Close the wake-up pipe, once the thread has finished
+		(the server may still put messages until it notices).
+		"""
+		os.close(self.wake_r)
+		os.close(self.wake_w)
+
+	def drain_wakeups(self):
+		try:
+			while len(os.read(self.wake_r, 4096)) == 4096:
+				pass
+		except OSError as e:
+			if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+				raise
+
+	def handle_message(self, msg):
+		"""
+		Handle a message from the server.
+		"""
+		if msg.internal:
+			# Uh oh, gotta go..
+			if msg.id == cp.Protocol.REQ_INT_CLOSE:
+				self.online = False
+			return
+		# Forward commits (to a follower, for any document).
+		# The body is encoded once, for everyone.
+		if msg.id == cp.Protocol.RES_COMMIT and self.replica:
+			self.send_ordered(msg.doc, cp.Protocol.res_repl_commit(msg.doc, msg.body))
+		# Where the others' cursors are.
+		elif msg.id == cp.Protocol.RES_CURSOR:
+			self.send(cp.Protocol.res_cursor(msg.name, msg.cursor),
+				ClientThread.PRIO_PRESENCE, msg.name)
+		elif msg.id == cp.Protocol.RES_COMMIT:
+			self.log.debug(u"Forwarding commit {}:{}".format(
+				msg.version, msg.sequence))
+			# Our own operations in it are marked, for our mirror to tell
+			# them apart (the names in them are just nicknames).
+			own = getattr(msg, "own", {}).get(self.uid)
+			self.send_ordered(self.docname,
+				cp.Protocol.res_commit_header(len(msg.body), self.take_ack(), own), msg.body)
+			if hasattr(msg, "t_recv"):
+				self.fanout_latency.observe(time.time() - msg.t_recv)
+		# Forward range responses (the commits that
+		# follow them must wait for them).
+		elif msg.id == cp.Protocol.RES_RANGE:
+			res = cp.Protocol.res_range(msg.version, msg.start,
+					msg.length, msg.lines, msg.text)
+			self.send(res, ClientThread.PRIO_BULK, doc=self.docname)
+		# Forward full text responses.
+		elif msg.id == cp.Protocol.RES_TEXT:
+			self.log.debug(u"Forwarding full text to {} ({})".format(msg.name, msg.uid))
+			self.send_text(msg.snapshot, getattr(msg, "flags", 0))
+		# Search results.
+		elif msg.id == cp.Protocol.RES_SEARCH:
+			self.send(cp.Protocol.res_search(msg.matches), ClientThread.PRIO_BULK)
+		# Hashes of the document (to compare with the client's).
+		elif msg.id == cp.Protocol.RES_HASH:
+			self.send(cp.Protocol.res_hash(msg.version, msg.length, msg.depth, msg.level,
+				msg.flags, msg.first, msg.hashes, getattr(msg, "chunks", None)),
+				ClientThread.PRIO_BULK)
+		# A past version of a document.
+		elif msg.id == cp.Protocol.RES_HISTORY:
+			self.send(cp.Protocol.res_history(msg.version, msg.base, msg.flags,
+				getattr(msg, "text", None), getattr(msg, "sequence", None)),
+				ClientThread.PRIO_BULK)
+		# A page of the document catalog.
+		elif msg.id == cp.Protocol.RES_LIST:
+			self.send(cp.Protocol.res_list(msg.total, msg.entries), ClientThread.PRIO_BULK)
+		# Errors, e.g. a commit rejected by a follower server.
+		elif msg.id == cp.Protocol.RES_ERROR:
+			self.send(cp.Protocol.res_error(msg.error))
+		# Forward a whole document to a follower.
+		elif msg.id == cp.Protocol.RES_REPL_TEXT:
+			self.log.debug(u"Replicating \"{}\" ({:08X})".format(msg.doc, msg.snapshot.version))
+			self.send(cp.Protocol.res_repl_text(msg.doc,
+				msg.snapshot.version, msg.snapshot.get_encoded()),
+				ClientThread.PRIO_BULK, doc=msg.doc)
+
+	def receive(self):
+		"""
+		Receive whatever the socket has, and handle
+		every complete request.
+		"""
+		while True:
+			try:
+				data = self.socket.recv(ClientThread.RECV_SIZE)
+			except socket.error as e:
+				if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN]:
+					break
+				raise
+			if len(data) == 0:
+				self.log.info("Connection closed by the client")
+				self.online = False
+				break
+			self.bytes_in.inc(len(data))
+			self.rx_buffer += data
+			if len(data) < ClientThread.RECV_SIZE:
+				break
+		# Whatever the client sent before leaving isn't held back.
+		self.handle_frames(limited=self.online)
+
+	def handle_frames(self, limited=True):
+		"""
+		Handle every complete request received, unless (limited)
+		by the rate limit: the rest is then held back for a while.
+		"""
+		self.rx_deferred = None
+		while len(self.rx_buffer) >= cp.Protocol.MIN_REQ_LEN:
+			if limited and self.limit != None:
+				wait = self.limit.wait()
+				if wait > 0:
+					self.rx_deferred = time.time() + wait
+					break
+			# Extract payload length
+			r_len = cp.Protocol.get_len(self.rx_buffer[:cp.Protocol.MIN_REQ_LEN])
+			f_len = cp.Protocol.MIN_REQ_LEN + r_len
+			if len(self.rx_buffer) < f_len:
+				# The rest will arrive later.
+				break
+			frame = bytes(self.rx_buffer[:f_len])
+			del self.rx_buffer[:f_len]
+			# Unpack the request
+			d = cp.Protocol.unpack(frame)
+			d["size"] = f_len
+			if self.limit != None:
+				self.limit.take(max(1, len(d.get("sequence", ()))), f_len)
+			self.handle_request(d)
+
+	def handle_request(self, d):
+		"""
+		Handle a single request from the client.
+		"""
+		self.log.debug("Request: {}".format(d))
+		msg = cp.Message(d, False)
+		msg.source = (self.address, self.port)
+		msg.uid = self.uid
+		msg.t_recv = time.time()
+		self.rx_seq += 1
+		forward = True
+
+		# Some requests can be acknowledged right away.
+		if msg.id == cp.Protocol.REQ_JOIN:
+			# Validate document name
+			if len(msg.doc) < 1 or len(msg.doc) > 128:
+				self.log.error("Invalid document name \"{}\", sending Nack.".format(msg.doc))
+				res = cp.Protocol.res_error(cp.Protocol.ERR_INVALID_DOCNAME)
+				self.send(res)
+				return
+
+			self.name = msg.name
+			self.docname = msg.doc
+			self.state += 1
+
+			# TODO:: Any auth?
+			# TODO:: Send the current version of the whole document.
+
+			# The join is always acknowledged on its own,
+			# and starts the sequence numbers.
+			self.cumulative_acks = (msg.flags & cp.Protocol.JOIN_CUMULATIVE_ACKS) != 0
+			self.spectator = (msg.flags & cp.Protocol.JOIN_SPECTATOR) != 0
+			self.rx_seq = 1
+			self.acked_seq = 1
+			self.ack_due = None
+			self.queue_cs.put(msg)
+			self.send(cp.Protocol.res_ok(msg.id))
+			return
+
+		# Spectators only watch, their commits don't bother the server.
+		elif msg.id == cp.Protocol.REQ_COMMIT and self.spectator:
+			self.log.warning("Rejecting commit from spectator {}".format(self.name))
+			self.send(cp.Protocol.res_error(cp.Protocol.ERR_READ_ONLY))
+			forward = False
+		# A commit, consisting of several operations.
+		elif msg.id in [cp.Protocol.REQ_COMMIT, cp.Protocol.REQ_TEXT, cp.Protocol.REQ_RANGE,
+				cp.Protocol.REQ_HASH]:
+			msg.name = self.name
+			msg.doc = self.docname
+		# A past version of a document (the joined one, unless named).
+		elif msg.id == cp.Protocol.REQ_HISTORY:
+			msg.name = self.name
+			if len(msg.doc) == 0:
+				msg.doc = self.docname or u""
+		# Metrics don't need to bother the server (but are acknowledged all the same).
+		elif msg.id == cp.Protocol.REQ_STATS:
+			self.send(cp.Protocol.res_stats(cm.get_registry().render_text()), ClientThread.PRIO_BULK)
+			forward = False
+		# A follower server?
+		elif msg.id == cp.Protocol.REQ_REPLICATE:
+			self.replica = True
+		# Leaving?
+		elif msg.id == cp.Protocol.REQ_LEAVE:
+			self.state = ClientThread.STAT_LEFT
+		# Forward to the server
+		if forward:
+			self.queue_cs.put(msg)
+
+		# Acknowledge the request.
+		if self.cumulative_acks:
+			# Along with a commit, or a little later.
+			if self.ack_due == None:
+				self.ack_due = msg.t_recv + ClientThread.ACK_DELAY
+		else:
+			self.log.debug("Sending Ack")
+			res = cp.Protocol.res_ok(msg.id)
+			self.send(res)
+
+	def send(self, data, prio=PRIO_INTERACTIVE, key=None, doc=None):
+		"""
+		Queue a response to the client, in a priority class. Presence
+		is by (key), only the latest one being kept, bulk responses
+		may be dropped by their (key). Bulk responses longer than
+		PART_BYTES are split into parts, so that others can go
+		in between. The commits to a (doc)ument wait for bulk
+		responses about it, e.g. ranges of its text, which have no
+		other way to tell which commits they include. Bulk (data)
+		can also be a generator of frames, which are only built
+		when it's their turn to be sent.
+		Everything queued is sent together, with the next flush().
+		"""
+		if prio == ClientThread.PRIO_INTERACTIVE:
+			self.tx_interactive.append(data)
+		elif prio == ClientThread.PRIO_PRESENCE:
+			self.tx_presence.pop(key, None)
+			self.tx_presence[key] = data
+		elif isinstance(data, types.GeneratorType):
+			self.tx_bulk.append((data, key, doc, False))
+			if doc != None:
+				self.tx_ordered[doc] = self.tx_ordered.get(doc, 0) + 1
+		else:
+			entries = self.split_bulk(data, key, doc)
+			self.tx_bulk.extend(entries)
+			if doc != None:
+				self.tx_ordered[doc] = self.tx_ordered.get(doc, 0) + len(entries)
+
+	def split_bulk(self, data, key, doc):
+		"""
+		The bulk queue entries of a frame, in parts if it's
+		longer than PART_BYTES.
+		"""
+		if len(data) <= ClientThread.PART_BYTES:
+			return [(data, key, doc, False)]
+		parts = list(cp.Protocol.split_frame(data, ClientThread.PART_BYTES))
+		return [(part, key, doc, i + 1 < len(parts)) for i, part in enumerate(parts)]
+
+	def send_ordered(self, doc, *pieces):
+		"""
+		Queue a response about a document (in pieces, e.g. a commit
+		header and its shared body), in order with the bulk responses
+		about it: interactive, unless some are waiting.
+		"""
+		if self.tx_ordered.get(doc, 0) > 0:
+			self.send(b"".join(pieces), ClientThread.PRIO_BULK, doc=doc)
+			return
+		for piece in pieces:
+			self.send(piece)
+
+	def drop_bulk(self, key):
+		"""
+		Drop the bulk responses by (key) that aren't on the way yet
+		(but not the rest of one whose first parts are).
+		"""
+		entries = collections.deque()
+		continued = self.tx_partial
+		for entry in self.tx_bulk:
+			_, entry_key, doc, more = entry
+			if continued or entry_key != key:
+				entries.append(entry)
+				continued = more
+			else:
+				self.release_ordered(doc)
+		self.tx_bulk = entries
+
+	def release_ordered(self, doc):
+		"""
+		A bulk response about a document is on the way (or dropped).
+		"""
+		if doc == None:
+			return
+		self.tx_ordered[doc] -= 1
+		if self.tx_ordered[doc] == 0:
+			del self.tx_ordered[doc]
+
+	def has_pending(self):
+		"""
+		Is there anything to send?
+		"""
+		return len(self.tx_frames) > 0 or len(self.tx_interactive) > 0 or \
+			len(self.tx_presence) > 0 or len(self.tx_bulk) > 0
+
+	def schedule(self):
+		"""
+		Line the queued responses up to be sent: interactive ones
+		first, then presence, and bulk ones only a little at a time,
+		so that they never hold much else back.
+		"""
+		while len(self.tx_interactive) > 0:
+			frame = self.tx_interactive.popleft()
+			self.tx_frames.append(frame)
+			self.tx_bytes += len(frame)
+		while len(self.tx_presence) > 0:
+			_, frame = self.tx_presence.popitem(last=False)
+			self.tx_frames.append(frame)
+			self.tx_bytes += len(frame)
+		while len(self.tx_bulk) > 0 and self.tx_bytes < ClientThread.BULK_BYTES:
+			frame, key, doc, more = self.tx_bulk[0]
+			if isinstance(frame, types.GeneratorType):
+				# The next frame of a generator goes first.
+				data = next(frame, None)
+				if data == None:
+					self.tx_bulk.popleft()
+					self.release_ordered(doc)
+					continue
+				entries = self.split_bulk(data, key, doc)
+				self.tx_bulk.extendleft(reversed(entries))
+				if doc != None:
+					self.tx_ordered[doc] += len(entries)
+				continue
+			self.tx_bulk.popleft()
+			self.tx_frames.append(frame)
+			self.tx_bytes += len(frame)
+			self.tx_partial = more
+			self.release_ordered(doc)
+
+	def flush(self):
+		"""
+		Send as much of the queued responses as the socket takes,
+		gathered into as few system calls as possible.
+		"""
+		self.schedule()
+		while len(self.tx_frames) > 0:
+			# Gather the frames (the first one from where the previous
+			# send left off), up to a limit. The views don't copy them.
+			pieces = []
+			size = 0
+			offset = self.tx_offset
+			for frame in self.tx_frames:
+				n = min(len(frame) - offset, ClientThread.FLUSH_BYTES - size)
+				pieces.append(memoryview(frame)[offset:offset + n])
+				size += n
+				offset = 0
+				if size >= ClientThread.FLUSH_BYTES:
+					break
+			try:
+				if hasattr(self.socket, "sendmsg"):
+					sent = self.socket.sendmsg(pieces)
+				elif len(pieces) == 1:
+					sent = self.socket.send(pieces[0])
+				else:
+					# No vectored sends (Python 2), concatenate the pieces
+					# instead (only FLUSH_BYTES are copied, at most).
+					sent = self.socket.send(b"".join(piece.tobytes() for piece in pieces))
+			except socket.error as e:
+				if e.errno in [errno.EWOULDBLOCK, errno.EAGAIN]:
+					# Wait until the socket is writable.
+					return
+				raise
+			self.bytes_out.inc(sent)
+			self.tx_bytes -= sent
+			# Drop what's been sent.
+			done = self.tx_offset + sent
+			while len(self.tx_frames) > 0 and done >= len(self.tx_frames[0]):
+				done -= len(self.tx_frames.popleft())
+			self.tx_offset = done
+			if sent < size:
+				# The socket didn't take it all.
+				return
+			# More bulk responses, now that these are on the way.
+			self.schedule()
+
+	def send_text(self, snapshot, flags):
+		"""
+		Send the full text of a document snapshot, either in chunks
+		(finished with a checksum), compressed, or as it is, as the
+		client asked. Only the chunks are bulk transfers: a text in a
+		single frame stays in order with the commits, however long.
+		The encodings in a single frame are shared with the other
+		clients, only the headers are built for every client. The
+		chunks are built for every client, a few at a time, as they
+		are sent.
+		"""
+		version = snapshot.version
+		# A new text makes whatever is left of the previous one useless.
+		self.drop_bulk(snapshot.docname)
+		if flags & cp.Protocol.TEXT_CHUNKED:
+			# The chunks are sent in bulk, commits can go in between
+			# (the client applies them after the text).
+			self.send_ordered(snapshot.docname,
+				cp.Protocol.res_text_begin(version, self.cursor_pos, len(snapshot.text)))
+			# Built as they go, and then the checksum.
+			self.send(snapshot.get_chunks(), ClientThread.PRIO_BULK, snapshot.docname)
+		elif flags & cp.Protocol.TEXT_COMPRESSED:
+			btext = snapshot.get_encoded()
+			ztext = snapshot.get_compressed()
+			self.send_ordered(snapshot.docname,
+				cp.Protocol.res_text_z_header(version, self.cursor_pos, len(btext), len(ztext)), ztext)
+		else:
+			btext = snapshot.get_encoded()
+			self.send_ordered(snapshot.docname,
+				cp.Protocol.res_text_header(version, self.cursor_pos, len(btext)), btext)
+
+	def take_ack(self):
+		"""
+		Get the sequence number to acknowledge, if there's
+		anything new to acknowledge (None otherwise).
+		"""
+		if not self.cumulative_acks or self.rx_seq == self.acked_seq:
+			return None
+		self.acked_seq = self.rx_seq
+		self.ack_due = None
+		return self.acked_seq
+
+	def forget_metrics(self):
+		"""
+		Drop the per-connection metrics of a closed connection.
+		"""
+		metrics = cm.get_registry()
+		metrics.remove("ctxt_connection_bytes_in", conn=self.uid)
+		metrics.remove("ctxt_connection_bytes_out", conn=self.uid)
+		metrics.remove("ctxt_queue_sc_depth", conn=self.uid)
 
 	def get_name(self):
 		"""
@@ -0,0 +1,62 @@
+"""
+Group commit timing.
+
+Commits for a document are queued and applied (and stored, and
+spread to the authors) together. How long to wait for more of them
+adapts to the load: a document that gets a commit every now and
+then has it applied right away, a busy one collects the commits
+arriving within a short window.
+"""
+
+
+class GroupCommit():
+	"""
+	Decides when the queued commits of a document are due.
+	"""
+	# Weight of the latest interval between commits in the average.
+	ALPHA = 0.2
+
+	def __init__(self, window):
+		# The longest time (s) to wait for more commits.
+		self.window = window
+		# When the first queued commit arrived (None if there are none).
+		self.t_first = None
+		self.t_last = None
+		# Average time between commits.
+		self.interval = None
+
+	def add(self, now):
+		"""
+		A commit has been queued.
+		"""
+		if self.t_first == None:
+			self.t_first = now
+		if self.t_last != None:
+			interval = now - self.t_last
+			if self.interval == None:
+				self.interval = interval
+			else:
+				self.interval += GroupCommit.ALPHA * (interval - self.interval)
+		self.t_last = now
+
+	def get_window(self):
+		"""
+		How long to wait: only if more commits are likely to arrive
+		within the window, otherwise waiting would only add latency.
+		"""
+		if self.interval == None or self.interval > self.window:
+			return 0.0
+		return self.window
+
+	def is_pending(self):
+		return self.t_first != None
+
+	def is_due(self, now):
+		return self.t_first != None and now - self.t_first >= self.get_window()
+
+	def flushed(self, now=None):
+		"""
+		The queued commits have been applied (or some of them, the
+		others being due from (now) on).
+		"""
+		self.t_first = now
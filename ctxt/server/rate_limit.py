@@ -0,0 +1,81 @@
+"""
+Rate limits, with token buckets.
+
+A bucket holds up to a second's worth of tokens, and gains (rate)
+tokens per second. Requests take their tokens whatever is left, so
+a bucket can go into debt (a large request isn't held back forever),
+and nothing more is let through until it has been paid off.
+Nothing is dropped: what is over the limit waits.
+"""
+import time
+
+
+class TokenBucket():
+	"""
+	A token bucket, (rate) tokens per second (0 being unlimited).
+	"""
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = self.rate if burst == None else float(burst)
+		self.tokens = self.burst
+		self.t_refill = time.time()
+
+	def refill(self, now):
+		if now > self.t_refill:
+			self.tokens = min(self.burst, self.tokens + (now - self.t_refill) * self.rate)
+		self.t_refill = now
+
+	def take(self, n, now):
+		"""
+		Take (n) tokens (possibly going into debt).
+		"""
+		if self.rate <= 0:
+			return
+		self.refill(now)
+		self.tokens -= n
+
+	def wait(self, now):
+		"""
+		How long (s) until the debt has been paid off.
+		"""
+		if self.rate <= 0:
+			return 0.0
+		self.refill(now)
+		if self.tokens >= 0:
+			return 0.0
+		return -self.tokens / self.rate
+
+
+class RateLimit():
+	"""
+	Limits on operations and bytes per second (either 0 being unlimited),
+	and a counter of how often they've held something back.
+	"""
+	def __init__(self, ops_rate, bytes_rate, counter=None):
+		self.ops = TokenBucket(ops_rate)
+		self.bytes = TokenBucket(bytes_rate)
+		self.counter = counter
+		# Is something being held back?
+		self.limited = False
+
+	def take(self, ops, nbytes, now=None):
+		"""
+		(ops) operations and (nbytes) bytes have been let through.
+		"""
+		if now == None:
+			now = time.time()
+		self.ops.take(ops, now)
+		self.bytes.take(nbytes, now)
+
+	def wait(self, now=None):
+		"""
+		How long (s) anything more has to wait. Every time the limit
+		starts holding something back is counted.
+		"""
+		if now == None:
+			now = time.time()
+		wait = max(self.ops.wait(now), self.bytes.wait(now))
+		if wait > 0 and not self.limited and self.counter != None:
+			self.counter.inc()
+		self.limited = wait > 0
+		return wait
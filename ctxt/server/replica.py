@@ -0,0 +1,186 @@
+"""
+Replication link of a follower server.
+
+A follower connects to its primary like a client does, and asks for
+all documents (REQ_REPLICATE). The primary sends the whole text of
+every document, then every commit it applies. The follower applies
+them to its own documents (and storage), and serves read-only joins,
+so that it can take over should the primary fail.
+
+A relay only asks for the documents its clients are watching, one by
+one, and keeps them in memory. The primary sends every commit once
+per relay, however many spectators the relay serves.
+"""
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+
+import ctxt.metrics as cm
+import ctxt.protocol as cp
+
+
+class ReplicaLink(threading.Thread):
+	"""
+	A thread receiving the replication stream from the primary,
+	and passing it on to the (follower) server as messages.
+	"""
+	LOGNAME = "CT.Server.Replica"
+
+	# How long to wait before connecting again (s).
+	RETRY_DELAY = 1.0
+	# How much to read from the socket at once.
+	RECV_SIZE = 65536
+
+	def __init__(self, address, port, queue_cs, relay=False):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.log = logging.getLogger(ReplicaLink.LOGNAME)
+
+		self.address = address
+		self.port = port
+		# Replicated documents and commits go to the server.
+		self.queue_cs = queue_cs
+
+		# Follow only some documents (as a relay)?
+		self.relay = relay
+		self.subscriptions = set()
+
+		self.online = False
+		self.socket = None
+		self.lock = threading.Lock()
+		self.rx_buffer = bytearray()
+		# Parts of a response received so far.
+		self.parts = cp.Parts()
+
+		metrics = cm.get_registry()
+		self.connected = False
+		metrics.gauge("ctxt_replica_connected",
+				"Is the follower connected to its primary",
+				fn=lambda: 1 if self.connected else 0)
+		self.commits_in = metrics.counter("ctxt_replica_commits",
+				"Commits received from the primary")
+		self.texts_in = metrics.counter("ctxt_replica_texts",
+				"Whole documents received from the primary")
+
+	def run(self):
+		"""
+		Follow the primary, connecting again if the connection is lost.
+		"""
+		self.online = True
+		while self.online:
+			try:
+				self.connect()
+				self.receive()
+			except socket.error as e:
+				self.log.warning("Replication from {}:{} failed: {}".format(
+					self.address, self.port, e))
+			except Exception as e:
+				self.log.exception(e)
+			self.disconnect()
+			if self.online:
+				time.sleep(ReplicaLink.RETRY_DELAY)
+
+	def connect(self):
+		"""
+		Connect to the primary, and ask for everything.
+		"""
+		self.log.info("Following {}:{}".format(self.address, self.port))
+		sock = socket.create_connection((self.address, self.port))
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.rx_buffer = bytearray()
+		self.parts = cp.Parts()
+		with self.lock:
+			self.socket = sock
+			if not self.relay:
+				self.socket.sendall(cp.Protocol.req_replicate())
+			for docname in self.subscriptions:
+				self.socket.sendall(cp.Protocol.req_replicate(docname, cp.Protocol.REPL_SUBSCRIBE))
+		self.connected = True
+
+	def disconnect(self):
+		self.connected = False
+		with self.lock:
+			if self.socket != None:
+				self.socket.close()
+				self.socket = None
+
+	def receive(self):
+		"""
+		Receive the replication stream until the connection closes.
+		"""
+		while self.online:
+			readable, _, _ = select.select([self.socket], [], [], ReplicaLink.RETRY_DELAY)
+			if len(readable) == 0:
+				continue
+			data = self.socket.recv(ReplicaLink.RECV_SIZE)
+			if len(data) == 0:
+				self.log.warning("Primary closed the connection")
+				return
+			self.rx_buffer += data
+
+			while len(self.rx_buffer) >= cp.Protocol.MIN_REQ_LEN:
+				r_len = cp.Protocol.get_len(self.rx_buffer[:cp.Protocol.MIN_REQ_LEN])
+				f_len = cp.Protocol.MIN_REQ_LEN + r_len
+				if len(self.rx_buffer) < f_len:
+					break
+				frame = bytes(self.rx_buffer[:f_len])
+				del self.rx_buffer[:f_len]
+				self.handle(cp.Protocol.unpack(frame))
+
+	def handle(self, d):
+		"""
+		Pass the replicated documents and commits on to the server.
+		"""
+		# A part of a longer response (a document, usually)?
+		if d["id"] == cp.Protocol.RES_PART:
+			frame = self.parts.add(d)
+			if frame != None:
+				self.handle(cp.Protocol.unpack(frame))
+			return
+		if d["id"] == cp.Protocol.RES_REPL_TEXT:
+			self.log.info(u"Received document \"{}\" ({:08X})".format(d["doc"], d["version"]))
+			self.texts_in.inc()
+		elif d["id"] == cp.Protocol.RES_REPL_COMMIT:
+			self.commits_in.inc()
+		else:
+			# Acknowledgements.
+			return
+		msg = cp.Message(d)
+		msg.t_recv = time.time()
+		self.queue_cs.put(msg)
+
+	def subscribe(self, docname):
+		"""
+		Follow a document (as a relay).
+		"""
+		with self.lock:
+			self.subscriptions.add(docname)
+		self.send(cp.Protocol.req_replicate(docname, cp.Protocol.REPL_SUBSCRIBE))
+
+	def resync(self, docname):
+		"""
+		Ask the primary for the whole text of a document again
+		(after missing some of its commits).
+		"""
+		self.send(cp.Protocol.req_replicate(docname))
+
+	def send(self, req):
+		with self.lock:
+			if self.socket == None:
+				# It's all sent again on connecting.
+				return
+			try:
+				self.socket.sendall(req)
+			except socket.error as e:
+				if e.errno not in [errno.EPIPE, errno.ECONNRESET]:
+					raise
+
+	def close(self):
+		"""
+		Stop following.
+		"""
+		self.online = False
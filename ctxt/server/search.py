@@ -0,0 +1,172 @@
+"""
+Full-text search index of the documents.
+
+A trigram index in a small SQLite database, next to the document
+storage: which documents contain which trigrams. The documents
+keep count of their trigrams as they change (see
+ctxt.shared_document.trigrams), and only the trigrams that have
+appeared or vanished are written. A search looks up the documents
+having every trigram of the query, and then finds the matches
+in their texts.
+
+Whether the index still matches a document's text is told by a
+checksum, only taken when the document is loaded (and indexed) and
+on closing: as it changes, just its version is written.
+"""
+import logging
+import sqlite3
+import time
+
+import ctxt.protocol as cp
+
+
+class SearchIndex():
+	"""
+	Trigram index of the documents, used from the server thread only.
+	"""
+	LOGNAME = "CT.Server.Search"
+
+	# Longest time (s) to keep updates in a transaction.
+	BATCH_INTERVAL = 0.1
+
+	SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS postings (
+			trigram TEXT NOT NULL,
+			doc TEXT NOT NULL,
+			PRIMARY KEY (trigram, doc)) WITHOUT ROWID""",
+		"""CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)""",
+		"""CREATE TABLE IF NOT EXISTS indexed (
+			doc TEXT PRIMARY KEY,
+			version INTEGER NOT NULL,
+			checked INTEGER NOT NULL,
+			checksum INTEGER NOT NULL)""",
+	]
+
+	def __init__(self, path):
+		self.log = logging.getLogger(SearchIndex.LOGNAME)
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		for sql in SearchIndex.SCHEMA:
+			self.db.execute(sql)
+		self.db.commit()
+		self.t_begin = None
+		# Documents with changes not written yet, by name.
+		self.dirty = {}
+		# The latest (version, checksum of its text) of the documents, by name.
+		self.checked = {}
+		# The open documents, to checksum them on closing.
+		self.docs = {}
+
+	def open_doc(self, doc):
+		"""
+		A document has been opened: keep its trigrams up to date,
+		and index it all over again if the index doesn't match its text.
+		"""
+		name = doc.get_name()
+		row = self.db.execute("SELECT version, checked, checksum FROM indexed WHERE doc = ?",
+				(name,)).fetchone()
+		checksum = self.get_checksum(doc)
+		# Only a checksum of the latest version indexed tells (otherwise
+		# the server didn't close cleanly).
+		counted = row != None and row[0] == row[1] and row[2] == checksum
+		if not counted:
+			self.log.info(u"Indexing \"{}\"".format(name))
+		doc.enable_trigrams(counted)
+		self.checked[name] = (doc.get_version(), checksum)
+		self.docs[name] = doc
+		if not counted:
+			self.update(doc)
+
+	def get_checksum(self, doc):
+		return cp.Protocol.checksum(doc.get_whole().encode("utf8"))
+
+	def update(self, doc):
+		"""
+		A document has changed.
+		"""
+		trigrams = doc.trigrams
+		if trigrams == None:
+			return
+		name = doc.get_name()
+		rebuilt, changed = trigrams.take_changed()
+		if rebuilt:
+			self.db.execute("DELETE FROM postings WHERE doc = ?", (name,))
+		for trigram in changed:
+			if trigrams.contains(trigram):
+				self.db.execute("INSERT OR IGNORE INTO postings (trigram, doc) VALUES (?, ?)",
+						(trigram, name))
+			elif not rebuilt:
+				self.db.execute("DELETE FROM postings WHERE trigram = ? AND doc = ?",
+						(trigram, name))
+		self.dirty[name] = doc
+		if self.t_begin == None:
+			self.t_begin = time.time()
+		self.flush()
+
+	def flush(self, force=False):
+		"""
+		Finish the transaction, if it's been open long enough (or forced).
+		Only the versions indexed are written, with the latest checksums
+		(most likely of earlier versions).
+		"""
+		if self.t_begin == None:
+			return
+		if force or time.time() - self.t_begin >= SearchIndex.BATCH_INTERVAL:
+			for name, doc in self.dirty.items():
+				checked, checksum = self.checked.get(name, (-1, 0))
+				self.db.execute(
+						"INSERT OR REPLACE INTO indexed (doc, version, checked, checksum) VALUES (?, ?, ?, ?)",
+						(name, doc.get_version(), checked, checksum))
+			self.dirty = {}
+			self.db.commit()
+			self.t_begin = None
+
+	def sync(self, names, load):
+		"""
+		Index the documents (from storage) that aren't indexed yet,
+		e.g. when the index is new. (load) loads a document by its name.
+		"""
+		indexed = set(name for name, in self.db.execute("SELECT doc FROM indexed"))
+		missing = [name for name in names if name not in indexed]
+		if len(missing) == 0:
+			return
+		self.log.info("Indexing {} documents".format(len(missing)))
+		for name in missing:
+			doc = load(name)
+			doc.enable_trigrams()
+			self.checked[name] = (doc.get_version(), self.get_checksum(doc))
+			self.update(doc)
+		self.flush(True)
+		# They aren't open.
+		for name in missing:
+			del self.checked[name]
+
+	def candidates(self, query):
+		"""
+		Names of the documents having every trigram of (query),
+		which has to be at least 3 characters long.
+		"""
+		self.flush(True)
+		trigrams = set(query[i:i + 3] for i in range(len(query) - 2))
+		docs = None
+		for trigram in trigrams:
+			found = set(doc for doc, in self.db.execute(
+				"SELECT doc FROM postings WHERE trigram = ?", (trigram,)))
+			docs = found if docs == None else docs & found
+			if len(docs) == 0:
+				break
+		return sorted(docs or [])
+
+	def close(self):
+		"""
+		Checksum the documents changed since they were loaded, and close.
+		"""
+		for name, doc in self.docs.items():
+			if self.checked[name][0] != doc.get_version():
+				self.checked[name] = (doc.get_version(), self.get_checksum(doc))
+				self.dirty[name] = doc
+				if self.t_begin == None:
+					self.t_begin = time.time()
+		self.flush(True)
+		self.db.close()
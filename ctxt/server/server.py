@@ -3,12 +3,24 @@ import Queue as queue
 import argparse
 import errno
 import logging
+import os
 import signal
 import socket
+import time
 
 import ctxt.shared_document.document as cd
+import ctxt.shared_document.history as ch
+import ctxt.shared_document.storage as cs
+from ctxt.server.catalog import Catalog
 from ctxt.server.client_thread import ClientThread
-
+from ctxt.server.group_commit import GroupCommit
+from ctxt.server.rate_limit import RateLimit
+from ctxt.server.replica import ReplicaLink
+from ctxt.server.search import SearchIndex
+from ctxt.server.snapshot import SnapshotCache
+from ctxt.server.stats import StatsServer
+
+import ctxt.metrics as cm
 import ctxt.protocol as cp
 from ctxt.borg import Borg
 
@@ -19,6 +31,23 @@ class Server(Borg):
 	Anyways, it's a singleton.
 	"""
 	TCP_CLIENTS_QUEUE_LEN = 10
+	# Maximum number of characters in a range response.
+	MAX_RANGE = 1048576
+	# Longest time (s) to collect the commits for a document
+	# before applying them together.
+	GROUP_WINDOW = 0.003
+	# Default database file of the SQLite storage.
+	SQLITE_PATH = "storage.db"
+	# Default catalog, search index and history files, after the storage path.
+	CATALOG_SUFFIX = ".catalog"
+	SEARCH_SUFFIX = ".search"
+	HISTORY_SUFFIX = ".history"
+	# Most matches in a search response.
+	MAX_MATCHES = 1000
+	# Characters of context around a match.
+	MATCH_CONTEXT = 40
+	# Most hashes (or chunks) in a hash response.
+	MAX_HASHES = 256
 	LOGNAME = "CT.Server"
 
 	@staticmethod
@@ -41,18 +70,91 @@ class Server(Borg):
 
 		# Dict of documents by name.
 		self.documents = {}
+		# Encoded full texts of the documents.
+		self.snapshots = SnapshotCache()
+		# Catalog of the documents, if any.
+		self.catalog = None
+		# Search index of the documents, if any.
+		self.search = None
+		# Version history of the documents, if kept.
+		self.history = None
+		# Group commit timing by document name.
+		self.groups = {}
+		self.group_window = Server.GROUP_WINDOW
+		# Cut operations out of the text's bounds to it (rather than rejecting the commit)?
+		self.clamp_ops = False
+		# Operations and bytes per second (0 being unlimited) per connection
+		# and per document, and the rate limits of the documents by name.
+		self.client_limits = (0, 0)
+		self.doc_limits = (0, 0)
+		self.limits = {}
+
+		# Client IDs of the follower servers replicating our documents.
+		self.replicas = set()
+		# The primary we follow ourselves, if any (we're read-only then).
+		self.primary = None
+		# Documents waiting for their whole text from the primary.
+		self.resyncing = set()
+		# Or a relay, following only the documents it's asked for.
+		self.relay = False
+		# Requests waiting for the first text of a document, by its name.
+		self.waiting = {}
+		# Relays (and followers) subscribed to a document, by its name.
+		self.subscribers = {}
 
 		# Queue for Client -> Server messages.
 		self.queue_cs = queue.Queue()
+
+		self.metrics = cm.get_registry()
+		self.metrics.gauge("ctxt_queue_cs_depth",
+				"Messages waiting in the Client -> Server queue",
+				fn=self.queue_cs.qsize)
+		self.metrics.gauge("ctxt_clients",
+				"Number of client threads",
+				fn=lambda: len(self.clients))
+		self.ops_per_commit = self.metrics.histogram("ctxt_commit_ops",
+				"Number of operations per commit", buckets=cm.COUNT_BUCKETS)
+		self.invalid_commits = self.metrics.counter("ctxt_invalid_commits",
+				"Commits with operations out of the text's bounds")
+		self.commits_per_group = self.metrics.histogram("ctxt_commit_group_size",
+				"Number of commits applied together", buckets=cm.COUNT_BUCKETS)
 	
-	def get_doc(self, docname):
+	def get_doc(self, docname, replicate=True):
 		"""
 		Get reference to a document by its name.
 		"""
 		if docname not in self.documents:
-			self.documents[docname] = cd.Document.get_doc(docname)
+			if self.relay:
+				# Relays only keep the documents they're watching
+				# (in memory), fetching them from the primary.
+				doc = cd.Document(docname, persistent=False)
+				self.waiting[docname] = []
+				self.primary.subscribe(docname)
+			else:
+				doc = cd.Document.get_doc(docname)
+				# The history may go on from a later version.
+				if self.history != None:
+					self.history.open_doc(doc)
+				if self.catalog != None:
+					self.catalog.add(doc)
+				if self.search != None:
+					self.search.open_doc(doc)
+			self.documents[docname] = doc
+			# A new document for the followers?
+			if replicate:
+				self.replicate_doc(doc)
 		return self.documents[docname]
 
+	def follow(self, address, port, relay=False):
+		"""
+		Follow a primary server: replicate its documents,
+		and only accept read-only clients. A relay only
+		follows the documents its clients are watching.
+		"""
+		self.relay = relay
+		self.primary = ReplicaLink(address, port, self.queue_cs, relay)
+		self.primary.start()
+
 	def listen(self, address='127.0.0.1', port=7777):
 		"""
 		Start listening for incoming connections.
@@ -74,49 +176,40 @@ class Server(Borg):
 			try:
 				# Separate threads for merging the document?
 				while not self.queue_cs.empty():
-					msg = self.queue_cs.get()
-
 					# TODO:: Figure out a solution with a periodic timer
 					# This would also avoid the busy-loop CPU lock
-					
-					doc = None
-					if hasattr(msg, "doc"):
-						doc = self.get_doc(msg.doc)
-					if doc != None:
-						# A commit?
-						if msg.id == cp.Protocol.REQ_COMMIT:
-							self.log.info("Processing commit {:08X} from {} ({})".format(
-								msg.version, msg.name, msg.uid))
-							doc.process_commit(msg)
-						# Request for the whole text?
-						elif msg.id == cp.Protocol.REQ_TEXT:
-							self.log.info("Sending whole text ({:08X}) to {} ({})".format(
-								doc.get_version(), msg.name, msg.uid))
-
-							msg.id = cp.Protocol.RES_TEXT
-							msg.text = doc.get_whole()
-							msg.version = doc.get_version()
-
-							self.send_to(msg)
-
-						# Update
-						commit = doc.update()
-						if commit != None:
-							commit.id = cp.Protocol.RES_COMMIT
-							commit.doc = doc.get_name()
-							self.log.info("Spreading commit {:08X}".format(commit.version))
-							# We have a commit to spread to clients.
-							self.share_to_all(commit)
+					self.handle(self.queue_cs.get())
+
+				# Apply the groups of commits that are due.
+				now = time.time()
+				# Over its rate limit, a document's commits wait (and are
+				# applied a few at a time, as the limit lets them through).
+				for docname, group in self.groups.items():
+					if group.is_due(now) and not self.is_limited(docname, now):
+						self.update_doc(self.documents[docname])
+				# Finish the storage transaction, if it's been open long enough.
+				cd.Document.get_storage().flush()
+				if self.catalog != None:
+					self.catalog.flush()
+				if self.search != None:
+					self.search.flush()
+				if self.history != None:
+					self.history.flush()
 
 				# New clients?
 				client_socket, source = self.socket.accept()
+				# Responses are gathered and sent together by the client
+				# thread, there's no need for Nagle's algorithm to delay them.
+				client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 				self.last_uid += 1
 				self.log.info("Client {} connected from {}".format(self.last_uid, source))
 
 				# Spawn a thread to serve the client.
-				t = ClientThread(self.last_uid, client_socket, source, self.queue_cs)
+				t = ClientThread(self.last_uid, client_socket, source, self.queue_cs,
+						self.client_limits)
 				t.start()
 				self.clients.append([source, t])
+				self.prune_clients()
 
 			except socket.error as e:
 				if e.errno not in [errno.EWOULDBLOCK]:
@@ -125,6 +218,19 @@ class Server(Borg):
 				if self.online:
 					self.log.exception(e)
 
+		# Apply whatever is left.
+		for doc in self.documents.values():
+			self.update_doc(doc, True)
+		if self.primary != None:
+			self.primary.close()
+		cd.Document.get_storage().close()
+		if self.catalog != None:
+			self.catalog.close()
+		if self.search != None:
+			self.search.close()
+		if self.history != None:
+			self.history.close()
+
 		# Close the socket, if any.
 		if self.socket != None:
 			self.log.info("Closing socket")
@@ -142,11 +248,457 @@ class Server(Borg):
 				if len(client) == 2:
 					t = client[1]
 					self.log.info("Joining {}".format(client))
-					t.queue_sc.put(msg)
+					t.put(msg)
 					t.join()
+					t.release()
 		else:
 			self.log.info("No client threads to join")
 
+	def handle(self, msg):
+		"""
+		Handle a message from a client thread (or from the primary).
+		"""
+		# A follower server?
+		if msg.id == cp.Protocol.REQ_REPLICATE:
+			self.add_replica(msg)
+			return
+		# A page of the catalog?
+		if msg.id == cp.Protocol.REQ_LIST:
+			self.send_list(msg)
+			return
+		# A search (possibly within a document)?
+		if msg.id == cp.Protocol.REQ_SEARCH:
+			self.send_search(msg)
+			return
+		# A past version of a document?
+		if msg.id == cp.Protocol.REQ_HISTORY:
+			self.send_history(msg)
+			return
+
+		doc = None
+		if hasattr(msg, "doc"):
+			doc = self.get_doc(msg.doc)
+		if doc == None:
+			return
+		# A relay waits for the text from the primary first.
+		if doc.get_name() in self.waiting and msg.id in [cp.Protocol.REQ_TEXT, cp.Protocol.REQ_RANGE,
+				cp.Protocol.REQ_HASH]:
+			self.waiting[doc.get_name()].append(msg)
+			return
+
+		# Only where the author's cursor is? That's no new version.
+		if msg.id == cp.Protocol.REQ_COMMIT and Server.is_presence(msg.sequence):
+			self.share_presence(doc, msg)
+		# A commit? It's applied with the others of its group.
+		elif msg.id == cp.Protocol.REQ_COMMIT and self.primary != None:
+			self.log.warning("Rejecting commit from {} ({}), following a primary".format(
+				msg.name, msg.uid))
+			self.send_to(cp.Message({"id": cp.Protocol.RES_ERROR,
+				"error": cp.Protocol.ERR_READ_ONLY, "uid": msg.uid}))
+		elif msg.id == cp.Protocol.REQ_COMMIT:
+			self.log.info("Queueing commit {:08X} from {} ({})".format(
+				msg.version, msg.name, msg.uid))
+			if not doc.queue_commit(msg, self.clamp_ops):
+				self.log.warning("Commit {:08X} from {} ({}) is out of bounds, {}".format(
+					msg.version, msg.name, msg.uid,
+					"cut to the text" if self.clamp_ops else "rejected"))
+				self.invalid_commits.inc()
+				self.send_to(cp.Message({"id": cp.Protocol.RES_ERROR, "uid": msg.uid,
+					"error": cp.Protocol.ERR_REPAIRED_OP if self.clamp_ops else cp.Protocol.ERR_INVALID_OP}))
+				if not self.clamp_ops:
+					return
+			self.get_group(doc).add(msg.t_recv)
+			self.metrics.meter("ctxt_commits",
+					"Commits processed per document", doc=doc.get_name()).inc()
+			self.ops_per_commit.observe(len(msg.sequence))
+		# Request for the whole text?
+		elif msg.id == cp.Protocol.REQ_TEXT:
+			# The text must not include commits that
+			# haven't been spread yet.
+			self.update_doc(doc)
+			self.log.info("Sending whole text ({:08X}) to {} ({})".format(
+				doc.get_version(), msg.name, msg.uid))
+
+			msg.id = cp.Protocol.RES_TEXT
+			msg.snapshot = self.snapshots.get(doc)
+			msg.version = msg.snapshot.version
+
+			self.send_to(msg)
+		# Request for a range of the text?
+		elif msg.id == cp.Protocol.REQ_RANGE:
+			self.update_doc(doc)
+			self.send_range(doc, msg)
+		# Request for hashes of the text?
+		elif msg.id == cp.Protocol.REQ_HASH:
+			self.update_doc(doc)
+			self.send_hashes(doc, msg)
+		# Replicated from the primary?
+		elif msg.id == cp.Protocol.RES_REPL_TEXT:
+			self.apply_replicated_text(doc, msg)
+		elif msg.id == cp.Protocol.RES_REPL_COMMIT:
+			self.apply_replicated_commit(doc, msg)
+
+	def prune_clients(self):
+		"""
+		Forget the clients that have gone.
+		"""
+		clients = []
+		for client in self.clients:
+			if len(client) == 2 and not client[1].is_alive():
+				client[1].release()
+				self.replicas.discard(client[1].get_uid())
+				for uids in self.subscribers.values():
+					uids.discard(client[1].get_uid())
+			else:
+				clients.append(client)
+		self.clients = clients
+
+	def get_group(self, doc):
+		"""
+		Get the group commit timing of a document.
+		"""
+		name = doc.get_name()
+		if name not in self.groups:
+			self.groups[name] = GroupCommit(self.group_window)
+		return self.groups[name]
+
+	@staticmethod
+	def is_presence(sequence):
+		"""
+		Does a commit only move the author's cursor?
+		"""
+		return len(sequence) > 0 and all(op["id"] == cp.Protocol.RES_CURSOR for op in sequence)
+
+	def share_presence(self, doc, msg):
+		"""
+		Tell the others where an author's cursor is (in the text
+		with the queued commits applied).
+		"""
+		length = doc.queued_length if doc.has_commits() else len(doc.get_whole())
+		sequence, _, _ = cd.Document.validate_ops(msg.sequence, length, clamp=True)
+		if len(sequence) == 0:
+			return
+		self.share_to_others(cp.Message({"id": cp.Protocol.RES_CURSOR, "doc": doc.get_name(),
+			"uid": msg.uid, "name": msg.name, "cursor": sequence[-1]["cursor"]}))
+
+	def get_limit(self, docname):
+		"""
+		Get the rate limit of a document, if they're limited.
+		"""
+		if self.doc_limits[0] <= 0 and self.doc_limits[1] <= 0:
+			return None
+		if docname not in self.limits:
+			self.limits[docname] = RateLimit(self.doc_limits[0], self.doc_limits[1],
+				self.metrics.counter("ctxt_rate_limited",
+					"Times a rate limit has held requests back", scope="document"))
+		return self.limits[docname]
+
+	def is_limited(self, docname, now):
+		"""
+		Must the commits to a document wait (for its rate limit)?
+		"""
+		limit = self.get_limit(docname)
+		return limit != None and limit.wait(now) > 0
+
+	def update_doc(self, doc, everything=False):
+		"""
+		Apply the queued commits of a document as one, and spread
+		the merged commit to its authors. Only as many of them as its
+		rate limit lets through are applied (at least one), the others
+		wait for the next time, unless (everything) is to be applied.
+		"""
+		if not doc.has_commits():
+			return
+		now = time.time()
+		count = None
+		limit = self.get_limit(doc.get_name())
+		if limit != None:
+			count = 0
+			for queued in doc.active_commits:
+				count += 1
+				limit.take(len(queued.sequence), getattr(queued, "size", 0), now)
+				if not everything and limit.wait(now) > 0:
+					break
+		commit = doc.update(count)
+		self.get_group(doc).flushed(now if doc.has_commits() else None)
+		self.snapshots.invalidate(doc.get_name())
+		if self.catalog != None:
+			self.catalog.update(doc, [getattr(c, "name", None) for c in commit.commits])
+		if self.search != None:
+			self.search.update(doc)
+		if self.history != None:
+			self.history.record(doc, commit)
+		self.commits_per_group.observe(len(commit.commits))
+
+		commit.id = cp.Protocol.RES_COMMIT
+		commit.doc = doc.get_name()
+		commit.t_recv = commit.commits[0].t_recv
+		self.log.info("Spreading commit {:08X} ({} commits)".format(
+			commit.version, len(commit.commits)))
+		# We have a commit to spread to clients.
+		self.share_to_doc(commit)
+		self.share_to_replicas(commit)
+
+	def add_replica(self, msg):
+		"""
+		A follower wants all documents (and their commits from now
+		on), or only one of them again.
+		"""
+		if len(msg.doc) > 0:
+			self.log.info(u"Sending \"{}\" to follower {}".format(msg.doc, msg.uid))
+			self.replicate_doc(self.get_doc(msg.doc), msg.uid)
+			if msg.flags & cp.Protocol.REPL_SUBSCRIBE:
+				self.subscribers.setdefault(msg.doc, set()).add(msg.uid)
+			return
+		self.log.info("Follower {} connected from {}".format(msg.uid, msg.source))
+		names = set(cd.Document.list_stored()) | set(self.documents.keys())
+		for name in sorted(names):
+			self.replicate_doc(self.get_doc(name, replicate=False), msg.uid)
+		# The commits from now on follow the texts.
+		self.replicas.add(msg.uid)
+
+	def replicate_doc(self, doc, uid=None):
+		"""
+		Send the whole text of a document to a follower
+		(or to all of them).
+		"""
+		if uid == None and len(self.replicas) == 0 and doc.get_name() not in self.subscribers:
+			return
+		# Commits not applied yet are sent as commits.
+		self.update_doc(doc)
+		msg = cp.Message({"id": cp.Protocol.RES_REPL_TEXT, "doc": doc.get_name(),
+			"snapshot": self.snapshots.get(doc)})
+		if uid == None:
+			self.share_to_replicas(msg)
+		else:
+			msg.uid = uid
+			self.send_to(msg)
+
+	def apply_replicated_text(self, doc, msg):
+		"""
+		The whole text of a document from the primary.
+		"""
+		name = doc.get_name()
+		self.log.info(u"Replicated \"{}\" ({:08X})".format(name, msg.version))
+		doc.set_whole(msg.version, msg.text)
+		doc.store()
+		self.snapshots.invalidate(name)
+		if self.catalog != None and doc.persistent:
+			self.catalog.update(doc)
+		if self.search != None:
+			self.search.update(doc)
+		if self.history != None and doc.persistent:
+			self.history.reset(doc)
+		self.resyncing.discard(name)
+		if name in self.waiting:
+			# Our clients have been waiting for it.
+			for req in self.waiting.pop(name):
+				self.handle(req)
+		else:
+			# Start our clients over with the new text.
+			res = cp.Message({"id": cp.Protocol.RES_TEXT, "doc": name,
+				"name": u"", "uid": None, "flags": 0})
+			res.snapshot = self.snapshots.get(doc)
+			res.version = res.snapshot.version
+			self.share_to_doc(res)
+		# And our followers, if any.
+		self.replicate_doc(doc)
+
+	def apply_replicated_commit(self, doc, msg):
+		"""
+		A commit from the primary. Commits must arrive in order,
+		when one goes missing, the whole text is fetched again.
+		"""
+		name = doc.get_name()
+		if name in self.resyncing or msg.version <= doc.get_version():
+			# Already in the text (or about to be).
+			return
+		if msg.version != doc.get_version() + 1:
+			self.log.warning(u"Missed commits to \"{}\" ({:08X} after {:08X}), fetching it again".format(
+				name, msg.version, doc.get_version()))
+			self.resyncing.add(name)
+			self.primary.resync(name)
+			return
+		commit = cp.Message({"id": cp.Protocol.REQ_COMMIT, "version": doc.get_version(),
+			"sequence": msg.sequence})
+		doc.process_commit(commit)
+		# Same version, same commit: pass on the primary's encoding.
+		commit.body = msg.body
+		doc.store(commit)
+		self.snapshots.invalidate(name)
+		# The primary knows who the authors are (we only have their nicknames).
+		if self.catalog != None and doc.persistent:
+			self.catalog.update(doc)
+		if self.search != None:
+			self.search.update(doc)
+		if self.history != None and doc.persistent:
+			self.history.record(doc, commit)
+
+		commit.id = cp.Protocol.RES_COMMIT
+		commit.doc = name
+		commit.t_recv = msg.t_recv
+		self.share_to_doc(commit)
+		self.share_to_replicas(commit)
+
+	def send_list(self, msg):
+		"""
+		Send a page of the document catalog to a client.
+		"""
+		if self.catalog == None:
+			total, entries = (0, [])
+		else:
+			total, entries = self.catalog.list(msg.prefix, msg.offset, msg.limit, msg.order)
+		self.log.info(u"Sending {} of {} catalog entries to {}".format(
+			len(entries), total, msg.uid))
+		msg.id = cp.Protocol.RES_LIST
+		msg.total = total
+		msg.entries = entries
+		self.send_to(msg)
+
+	def send_search(self, msg):
+		"""
+		Search for a text in a document, or in all of them
+		(those having all of its trigrams), and send the matches.
+		"""
+		query = msg.query
+		storage = cd.Document.get_storage()
+		if len(msg.doc) > 0:
+			if msg.doc not in self.documents and storage.get_meta(msg.doc) == None:
+				names = []
+			else:
+				names = [msg.doc]
+		elif len(query) < 3:
+			names = None
+		elif self.search != None:
+			names = self.search.candidates(query)
+		else:
+			names = sorted(storage.list_names())
+		if len(query) == 0 or names == None:
+			self.send_to(cp.Message({"id": cp.Protocol.RES_ERROR,
+				"error": cp.Protocol.ERR_INVALID_QUERY, "uid": msg.uid}))
+			return
+
+		limit = min(msg.limit, Server.MAX_MATCHES)
+		matches = []
+		for name in names:
+			if name in self.documents:
+				doc = self.documents[name]
+				self.update_doc(doc)
+			else:
+				# Only for the search, don't keep it open.
+				doc = cd.Document.get_doc(name)
+			matches += self.find_matches(doc, query, limit - len(matches))
+			if len(matches) >= limit:
+				break
+		self.log.info(u"Found {} matches of \"{}\" in {} documents for {}".format(
+			len(matches), query, len(names), msg.uid))
+		msg.id = cp.Protocol.RES_SEARCH
+		msg.matches = matches
+		self.send_to(msg)
+
+	def send_history(self, msg):
+		"""
+		Send a document at a past version, or the changes
+		between two of its versions (line by line).
+		"""
+		if len(msg.doc) == 0:
+			self.send_to(cp.Message({"id": cp.Protocol.RES_ERROR,
+				"error": cp.Protocol.ERR_INVALID_DOCNAME, "uid": msg.uid}))
+			return
+		if msg.doc in self.documents:
+			# The latest commits must be in the history.
+			self.update_doc(self.documents[msg.doc])
+		text = None
+		base = None
+		if self.history != None:
+			text = self.history.get_text(msg.doc, msg.version)
+			if msg.flags & cp.Protocol.HISTORY_DIFF:
+				base = self.history.get_text(msg.doc, msg.base)
+		if text == None or (msg.flags & cp.Protocol.HISTORY_DIFF and base == None):
+			self.log.info(u"No version {:08X} of \"{}\" for {}".format(
+				msg.version, msg.doc, msg.uid))
+			self.send_to(cp.Message({"id": cp.Protocol.RES_ERROR,
+				"error": cp.Protocol.ERR_INVALID_VERSION, "uid": msg.uid}))
+			return
+		msg.id = cp.Protocol.RES_HISTORY
+		if msg.flags & cp.Protocol.HISTORY_DIFF:
+			self.log.info(u"Sending changes of \"{}\" from {:08X} to {:08X} to {}".format(
+				msg.doc, msg.base, msg.version, msg.uid))
+			msg.sequence = ch.diff_lines(base, text)
+		else:
+			self.log.info(u"Sending \"{}\" at {:08X} to {}".format(
+				msg.doc, msg.version, msg.uid))
+			msg.text = text
+		self.send_to(msg)
+
+	def find_matches(self, doc, query, limit):
+		"""
+		Find (limit) matches of (query) in a document, at most.
+		"""
+		text = doc.get_whole()
+		matches = []
+		offset = text.find(query)
+		while offset >= 0 and len(matches) < limit:
+			end = offset + len(query)
+			# The line of the match, or a part of it.
+			start = max(text.rfind(u"\n", 0, offset) + 1, offset - Server.MATCH_CONTEXT)
+			line_end = text.find(u"\n", end)
+			if line_end < 0:
+				line_end = len(text)
+			matches.append({"doc": doc.get_name(), "offset": offset,
+				"line": doc.offset_to_line(offset),
+				"context": text[start:min(line_end, end + Server.MATCH_CONTEXT)]})
+			offset = text.find(query, offset + 1)
+		return matches
+
+	def send_range(self, doc, msg):
+		"""
+		Send a range of a document's text to a client.
+		"""
+		if msg.flags & cp.Protocol.RANGE_LINES:
+			start, text = doc.get_lines(msg.start, msg.end)
+		else:
+			start = min(msg.start, len(doc.get_whole()))
+			text = doc.get_range(start, msg.end)
+		# Keep the responses reasonably sized.
+		text = text[:Server.MAX_RANGE]
+		self.log.info("Sending range {}+{} ({:08X}) to {} ({})".format(
+			start, len(text), doc.get_version(), msg.name, msg.uid))
+
+		msg.id = cp.Protocol.RES_RANGE
+		msg.start = start
+		msg.text = text
+		msg.length = len(doc.get_whole())
+		msg.lines = doc.get_line_count()
+		msg.version = doc.get_version()
+		self.send_to(msg)
+
+	def send_hashes(self, doc, msg):
+		"""
+		Send hashes of a document's hash tree to a client,
+		with the chunks of the text under them, if asked.
+		"""
+		tree = doc.get_hash_tree()
+		level = msg.level
+		if level == cp.Protocol.HASH_ROOT:
+			level = tree.depth() - 1
+		count = min(msg.count, Server.MAX_HASHES)
+		msg.hashes = tree.get(level, msg.first, count)
+		if msg.flags & cp.Protocol.HASH_TEXT:
+			# The chunks under the hashes, of the lowest level only.
+			if level != 0:
+				msg.hashes = []
+			msg.chunks = tree.get_chunks(doc.get_whole(), msg.first, len(msg.hashes))
+		self.log.debug("Sending {} hashes of level {} ({:08X}) to {} ({})".format(
+			len(msg.hashes), level, doc.get_version(), msg.name, msg.uid))
+
+		msg.id = cp.Protocol.RES_HASH
+		msg.version = doc.get_version()
+		msg.length = len(doc.get_whole())
+		msg.depth = tree.depth()
+		msg.level = level
+		self.send_to(msg)
+
 	def share_to_all(self, msg):
 		"""
 		Share a message to everyone.
@@ -156,7 +708,30 @@ class Server(Borg):
 		for client in self.clients:
 			if client != None and len(client) == 2:
 				t = client[1]
-				t.queue_sc.put(msg)
+				t.put(msg)
+
+	def share_to_doc(self, msg):
+		"""
+		Share a message to everyone who has the document open.
+		"""
+		for client in self.clients:
+			if client != None and len(client) == 2:
+				t = client[1]
+				if t.get_doc() == msg.doc:
+					t.put(msg)
+
+	def share_to_replicas(self, msg):
+		"""
+		Share a message to the followers.
+		"""
+		uids = self.replicas | self.subscribers.get(msg.doc, set())
+		if len(uids) == 0:
+			return
+		for client in self.clients:
+			if client != None and len(client) == 2:
+				t = client[1]
+				if t.get_uid() in uids:
+					t.put(msg)
 
 	def share_to_others(self, msg):
 		"""
@@ -169,7 +744,7 @@ class Server(Borg):
 				t = client[1]
 				# Avoid forwarding messages to their author.
 				if t.get_doc() == msg.doc and t.get_uid() != msg.uid:
-					t.queue_sc.put(msg)
+					t.put(msg)
 
 	def send_to(self, msg):
 		"""
@@ -180,7 +755,7 @@ class Server(Borg):
 			if client != None and len(client) == 2:
 				t = client[1]
 				if t.get_uid() == msg.uid:
-					t.queue_sc.put(msg)
+					t.put(msg)
 					return
 
 	def close(self):
@@ -232,11 +807,77 @@ def main():
 
 	parser = argparse.ArgumentParser(description="Collaborative Text Editor")
 	parser.add_argument("--port", dest="port", type=int, default=7777, help="Port to listen on")
+	parser.add_argument("--stats-port", dest="stats_port", type=int, default=0,
+			help="Local port for the Prometheus metrics endpoint (0 disables it)")
+	parser.add_argument("--group-window", dest="group_window", type=float,
+			default=Server.GROUP_WINDOW * 1000.0,
+			help="Longest time (ms) to collect commits to apply together")
+	parser.add_argument("--client-ops-rate", dest="client_ops_rate", type=float, default=0,
+			help="Operations per second a connection may send (0: unlimited), the rest waits")
+	parser.add_argument("--client-bytes-rate", dest="client_bytes_rate", type=float, default=0,
+			help="Bytes per second a connection may send (0: unlimited)")
+	parser.add_argument("--doc-ops-rate", dest="doc_ops_rate", type=float, default=0,
+			help="Operations per second applied to a document (0: unlimited), "
+			"the rest is applied later, as a single commit")
+	parser.add_argument("--doc-bytes-rate", dest="doc_bytes_rate", type=float, default=0,
+			help="Bytes of commits per second applied to a document (0: unlimited)")
+	parser.add_argument("--invalid-ops", dest="invalid_ops", default="reject",
+			choices=["reject", "clamp"],
+			help="Reject commits with operations out of the text's bounds, or cut them to it")
+	parser.add_argument("--follow", dest="follow", default=None, metavar="HOST:PORT",
+			help="Follow a primary server, replicating its documents (read-only)")
+	parser.add_argument("--relay", dest="relay", default=None, metavar="HOST:PORT",
+			help="Relay the documents watched by our (read-only) clients from a primary server")
+	parser.add_argument("--storage", dest="storage", default=None,
+			help="Directory to store the documents in, or the database file with "
+			"SQLite (default: {} or {})".format(cd.Document.STORAGE_PATH, Server.SQLITE_PATH))
+	parser.add_argument("--catalog", dest="catalog", default=None,
+			help="Database file of the document catalog (default: next to the storage)")
+	parser.add_argument("--search-index", dest="search_index", default=None,
+			help="Database file of the search index (default: next to the storage)")
+	parser.add_argument("--history", dest="history", default=None,
+			help="Database file of the version history (default: next to the storage)")
+	parser.add_argument("--storage-backend", dest="storage_backend", default="file",
+			choices=["file", "sqlite"], help="How to store the documents")
 
 	args = parser.parse_args()
 
 	log = init_logging()
+	if args.stats_port != 0:
+		stats = StatsServer(port=args.stats_port)
+		stats.start()
 	server = Server()
+	server.group_window = args.group_window / 1000.0
+	server.clamp_ops = args.invalid_ops == "clamp"
+	server.client_limits = (args.client_ops_rate, args.client_bytes_rate)
+	server.doc_limits = (args.doc_ops_rate, args.doc_bytes_rate)
+	storage = args.storage
+	if storage == None:
+		if args.storage_backend == "sqlite":
+			storage = Server.SQLITE_PATH
+		else:
+			storage = cd.Document.STORAGE_PATH
+	cd.Document.STORAGE = cs.open_storage(args.storage_backend, storage)
+	catalog = args.catalog
+	if catalog == None:
+		catalog = os.path.normpath(storage) + Server.CATALOG_SUFFIX
+	history = args.history
+	if history == None:
+		history = os.path.normpath(storage) + Server.HISTORY_SUFFIX
+	server.history = ch.History(history)
+	server.catalog = Catalog(catalog)
+	server.catalog.sync(cd.Document.STORAGE)
+	search_index = args.search_index
+	if search_index == None:
+		search_index = os.path.normpath(storage) + Server.SEARCH_SUFFIX
+	server.search = SearchIndex(search_index)
+	server.search.sync(cd.Document.STORAGE.list_names(), cd.Document.get_doc)
+	if args.follow != None:
+		address, port = args.follow.rsplit(":", 1)
+		server.follow(address, int(port))
+	elif args.relay != None:
+		address, port = args.relay.rsplit(":", 1)
+		server.follow(address, int(port), relay=True)
 	server.listen(port=args.port)
 
 
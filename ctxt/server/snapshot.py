@@ -0,0 +1,109 @@
+"""
+Encoded full-text snapshots of the documents.
+
+Every version of a document is encoded at most once (for every
+kind of full text response in a single frame), however many clients
+ask for it. Chunked texts are encoded a chunk at a time instead.
+"""
+import threading
+import zlib
+
+import ctxt.metrics as cm
+import ctxt.protocol as cp
+
+
+class Snapshot():
+	"""
+	A single version of a document's text, with its encodings
+	built on demand. Client threads asking for the same encoding
+	at the same time wait for a single build.
+	"""
+	def __init__(self, docname, version, text):
+		self.docname = docname
+		self.version = version
+		# The text is immutable, so the snapshot can't change under us.
+		self.text = text
+		self.lock = threading.Lock()
+		self.encoded = None
+		self.compressed = None
+
+		metrics = cm.get_registry()
+		self.builds = metrics.counter("ctxt_snapshot_builds",
+				"Full text encodings built")
+		self.hits = metrics.counter("ctxt_snapshot_hits",
+				"Full text responses served from an existing encoding")
+
+	def get_encoded(self):
+		"""
+		The text in UTF-8.
+		"""
+		with self.lock:
+			if self.encoded == None:
+				self.builds.inc()
+				self.encoded = self.text.encode("utf8")
+			else:
+				self.hits.inc()
+			return self.encoded
+
+	def get_compressed(self):
+		"""
+		The text in UTF-8, compressed with zlib.
+		"""
+		with self.lock:
+			if self.compressed != None:
+				self.hits.inc()
+				return self.compressed
+		encoded = self.get_encoded()
+		with self.lock:
+			if self.compressed == None:
+				self.builds.inc()
+				self.compressed = zlib.compress(encoded, SnapshotCache.COMPRESS_LEVEL)
+			return self.compressed
+
+	def get_chunks(self):
+		"""
+		The text chunk frames, and then the end frame with the checksum
+		of the text, built one at a time as they're sent (a generator),
+		so that a long text is never held encoded as a whole.
+		"""
+		self.builds.inc()
+		crc = 0
+		for offset, chunk in cp.Protocol.text_chunks(self.text):
+			res = cp.Protocol.res_text_chunk(offset, chunk)
+			# Checksum of the encoded text (after the frame header).
+			crc = cp.Protocol.checksum(buffer(res, 9), crc)
+			yield res
+		yield cp.Protocol.res_text_end(self.version, crc)
+
+
+class SnapshotCache():
+	"""
+	The latest snapshot of every document.
+	"""
+	# zlib compression level of compressed full text responses.
+	COMPRESS_LEVEL = 6
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.snapshots = {}
+
+	def get(self, doc):
+		"""
+		Get the snapshot of the current version of a document.
+		"""
+		name = doc.get_name()
+		version = doc.get_version()
+		with self.lock:
+			snapshot = self.snapshots.get(name)
+			if snapshot == None or snapshot.version != version:
+				snapshot = Snapshot(name, version, doc.get_whole())
+				self.snapshots[name] = snapshot
+			return snapshot
+
+	def invalidate(self, docname):
+		"""
+		The document has changed, forget its snapshot.
+		(Threads still sending it can finish.)
+		"""
+		with self.lock:
+			self.snapshots.pop(docname, None)
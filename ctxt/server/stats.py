@@ -0,0 +1,59 @@
+"""
+A local HTTP endpoint for dumping server metrics.
+"""
+import BaseHTTPServer
+import logging
+import threading
+
+import ctxt.metrics as cm
+
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Serves the metrics registry in the Prometheus text format.
+	"""
+	CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+	def do_GET(self):
+		if self.path.split("?")[0] not in ["/", "/metrics"]:
+			self.send_error(404)
+			return
+		body = cm.get_registry().render_text().encode("utf8")
+		self.send_response(200)
+		self.send_header("Content-Type", StatsHandler.CONTENT_TYPE)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, fmt, *args):
+		"""
+		Keep the scrapes out of stderr.
+		"""
+		logging.getLogger(StatsServer.LOGNAME).debug(fmt % args)
+
+
+class StatsServer(threading.Thread):
+	"""
+	A daemon thread serving the metrics endpoint.
+	Binds to the loopback interface by default, as the
+	metrics are not meant for the outside world.
+	"""
+	LOGNAME = "CT.Server.Stats"
+
+	def __init__(self, address="127.0.0.1", port=7778):
+		threading.Thread.__init__(self)
+		self.daemon = True
+
+		self.log = logging.getLogger(StatsServer.LOGNAME)
+		self.httpd = BaseHTTPServer.HTTPServer((address, port), StatsHandler)
+
+	def run(self):
+		self.log.info("Serving metrics on http://{}:{}/metrics".format(
+			*self.httpd.server_address))
+		self.httpd.serve_forever()
+
+	def close(self):
+		"""
+		Stop serving.
+		"""
+		self.httpd.shutdown()
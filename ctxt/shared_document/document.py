@@ -3,36 +3,75 @@ Document class.
 """
 
 import logging
-import base64
-import os
+import ctxt.metrics as cm
 import ctxt.protocol as cp
 import ctxt.util as cu
+from ctxt.shared_document.hash_tree import HashTree
+from ctxt.shared_document.line_index import LineIndex
+from ctxt.shared_document.storage import FileStorage
+from ctxt.shared_document.trigrams import Trigrams
 
 class Document:
 	STORAGE_PATH = "storage/"
+	# Storage backend (files in STORAGE_PATH, unless set otherwise).
+	STORAGE = None
 
 	"""
 	A document class to handle insertions.
-	TODO:: Perhaps figure out, how to use it for the GUI as well
-	(would avoid duplication of code on client and server).
+	Used by the server, as well as by the clients for their local
+	mirrors (see ctxt.shared_document.mirror).
 	"""
-	def __init__(self, docname):
+	def __init__(self, docname, persistent=True):
 		self.log = logging.getLogger("CT.Document")
 
 		self.docname = docname
 		self.text = u""
-		self.active_commit = {}
+		# Commits waiting to be applied together, and
+		# the length of the text once they have been.
+		self.active_commits = []
+		self.queued_length = 0
+		# Incremented with every commit.
+		self.version = 0
 
+		# Should the document be stored at all?
+		# (Client-side mirrors are not.)
+		self.persistent = persistent
 		self.unsaved_changes = True
-		# TODO:: Should we have the same class on the client
-		# side as well?
+
+		self.store_latency = cm.get_registry().histogram("ctxt_store_seconds",
+				"Time spent writing documents to storage")
+
+		# Line index, built on first use. It's only valid for
+		# the text it was built (and kept up to date) for.
+		self.index = None
+		self.index_text = None
+		# Hash tree, likewise built on first use.
+		self.hashes = None
+		self.hashes_text = None
+
+		# Trigram counts for the search index, if it's enabled
+		# (counted on the first change).
+		self.trigrams_enabled = False
+		self.trigrams = None
 
 	def insert(self, version, cursor, text):
 		"""
 		Insert text at a specific cursor position.
 		"""
+		indexed = self.index_text is self.text
+		hashed = self.hashes_text is self.text
+		old = self.text
+		trigrams = self.get_trigrams()
 		self.text = self.text[:cursor] + text + self.text[cursor:]
-		self.store()
+		if indexed:
+			self.index.insert(cursor, text, self.text)
+			self.index_text = self.text
+		if hashed:
+			self.hashes.insert(cursor, len(text))
+			self.hashes_text = self.text
+		if trigrams != None:
+			trigrams.update(old, self.text, cursor, cursor, cursor + len(text))
+		self.unsaved_changes = True
 
 		# TODO:: Return something for updating client cursors.
 	
@@ -40,29 +79,126 @@ class Document:
 		"""
 		Remove a selection of text at a specific cursor position.
 		"""
+		indexed = self.index_text is self.text
+		hashed = self.hashes_text is self.text
+		length = max(0, min(length, len(self.text) - cursor))
+		old = self.text
+		trigrams = self.get_trigrams()
 		self.text = self.text[:cursor] + self.text[(cursor+length):]
-		self.store()
+		if indexed:
+			self.index.remove(cursor, length, self.text)
+			self.index_text = self.text
+		if hashed:
+			self.hashes.remove(cursor, length)
+			self.hashes_text = self.text
+		if trigrams != None:
+			trigrams.update(old, self.text, cursor, cursor + length, cursor)
+		self.unsaved_changes = True
 
 		# TODO:: Return something for updating client cursors.
 	
 	def process_commit(self, commit):
-		print "Commit: {}".format(commit)
+		"""
+		Apply a commit, which then carries the new version.
+		"""
+		self.log.debug("Commit: {}".format(commit))
+		self.version += 1
 		for op in commit.sequence:
 			if op["id"] == cp.Protocol.RES_INSERT:
-				self.insert(commit.version, op["cursor"], op["text"])
+				self.insert(self.version, op["cursor"], op["text"])
 			elif op["id"] == cp.Protocol.RES_REMOVE:
-				self.remove(commit.version, op["cursor"], op["length"])
-		self.active_commit = commit
+				self.remove(self.version, op["cursor"], op["length"])
+		commit.version = self.version
+
+	def queue_commit(self, commit, clamp=False):
+		"""
+		Queue a commit, to be applied with the next update(),
+		once its operations have been validated against the text
+		as it will be by then. Returns whether they were all valid:
+		an invalid commit isn't queued, unless (clamp)ed to the text.
+		"""
+		if len(self.active_commits) == 0:
+			self.queued_length = len(self.text)
+		sequence, length, valid = Document.validate_ops(commit.sequence,
+				self.queued_length, clamp)
+		if sequence == None:
+			return False
+		commit.sequence = sequence
+		self.queued_length = length
+		self.active_commits.append(commit)
+		return valid
+
+	@staticmethod
+	def validate_ops(sequence, length, clamp=False):
+		"""
+		Check a sequence of operations against a text (length) characters
+		long, in constant time per operation (only the length is needed).
+		Returns (sequence, length of the text after it, were they all valid).
+		An invalid sequence is None, unless (clamp)ed: the operations
+		are then cut to the text. Those left empty are kept, as no-ops:
+		the author's mirror counts on every operation coming back.
+		"""
+		valid = True
+		checked = []
+		for op in sequence:
+			op_id = op["id"]
+			cursor = op.get("cursor", -1)
+			if op_id == cp.Protocol.RES_REMOVE:
+				ok = cursor >= 0 and op["length"] >= 0 and cursor + op["length"] <= length
+			elif op_id in [cp.Protocol.RES_INSERT, cp.Protocol.RES_CURSOR]:
+				ok = cursor >= 0 and cursor <= length
+			else:
+				# Not an operation at all.
+				ok = False
+			if not ok:
+				if not clamp:
+					return (None, length, False)
+				valid = False
+				if op_id not in [cp.Protocol.RES_INSERT, cp.Protocol.RES_REMOVE, cp.Protocol.RES_CURSOR]:
+					continue
+				cursor = min(max(cursor, 0), length)
+				op = dict(op, cursor=cursor)
+				if op_id == cp.Protocol.RES_REMOVE:
+					op["length"] = max(0, min(op["length"], length - cursor))
+			if op_id == cp.Protocol.RES_INSERT:
+				length += len(op["text"])
+			elif op_id == cp.Protocol.RES_REMOVE:
+				length -= op["length"]
+			checked.append(op)
+		return (checked, length, valid)
 
-	def update(self):
+	def has_commits(self):
+		return len(self.active_commits) > 0
+
+	def update(self, count=None):
 		"""
-		Merge commits.
+		Merge the queued commits (the first (count) of them, if given,
+		the others staying queued): apply them as a single commit
+		(a single new version), and store the document once.
+		Returns the merged commit, with the original ones in (commits),
+		which of its operations came from which connection in (own)
+		(lists of (first, count) spans by uid) and its encoding in (body).
 		"""
-		commit = self.active_commit
-		if commit == {}:
+		commits = self.active_commits[:count]
+		if len(commits) == 0:
 			return None
-		self.active_commit = {}
-		return commit
+		self.active_commits = self.active_commits[len(commits):]
+		sequence = []
+		own = {}
+		for commit in commits:
+			spans = own.setdefault(getattr(commit, "uid", None), [])
+			if len(spans) > 0 and sum(spans[-1]) == len(sequence):
+				spans[-1] = (spans[-1][0], spans[-1][1] + len(commit.sequence))
+			else:
+				spans.append((len(sequence), len(commit.sequence)))
+			sequence += commit.sequence
+		merged = cp.Message({"id": cp.Protocol.REQ_COMMIT, "version": self.version,
+			"sequence": sequence, "commits": commits, "own": own})
+		self.process_commit(merged)
+		# Encoded once, for the storage and for all the client threads.
+		merged.body = cp.Protocol.commit_body(merged.version, sequence)
+		self.store(merged)
+		return merged
 
 	def get_whole(self):
 		"""
@@ -70,38 +206,135 @@ class Document:
 		"""
 		return self.text
 
+	def enable_trigrams(self, counted=False):
+		"""
+		Keep count of the trigrams of the text (for the search index).
+		With (counted), the index already has the trigrams of the
+		current text, so they're only counted on the first change.
+		"""
+		self.trigrams_enabled = True
+		if not counted:
+			self.trigrams = Trigrams(self.text)
+
+	def get_trigrams(self):
+		"""
+		Get the trigram counts, if enabled.
+		"""
+		if self.trigrams_enabled and self.trigrams == None:
+			self.trigrams = Trigrams(self.text, rebuilt=False)
+		return self.trigrams
+
+	def get_index(self):
+		"""
+		Get the line index of the text.
+		"""
+		if self.index_text is not self.text:
+			# The text has been replaced as a whole.
+			self.index = LineIndex(self.text)
+			self.index_text = self.text
+		return self.index
+
+	def get_hash_tree(self):
+		"""
+		Get the hash tree of the text, up to date.
+		"""
+		if self.hashes_text is not self.text:
+			# The text has been replaced as a whole.
+			self.hashes = HashTree()
+			self.hashes_text = self.text
+		self.hashes.update(self.text)
+		return self.hashes
+
+	def get_line_count(self):
+		return self.get_index().line_count()
+
+	def line_to_offset(self, line):
+		"""
+		Offset of the start of a line.
+		"""
+		return self.get_index().line_start(line)
+
+	def offset_to_line(self, offset):
+		"""
+		The line an offset is on.
+		"""
+		return self.get_index().line_of(offset)
+
+	def offset_to_utf8(self, offset):
+		"""
+		Convert a character offset to a UTF-8 byte offset.
+		"""
+		return self.get_index().convert(self.text, offset, LineIndex.CHARS, LineIndex.UTF8)
+
+	def utf8_to_offset(self, offset):
+		return self.get_index().convert(self.text, offset, LineIndex.UTF8, LineIndex.CHARS)
+
+	def offset_to_utf16(self, offset):
+		"""
+		Convert a character offset to a UTF-16 offset (as used by Qt).
+		"""
+		return self.get_index().convert(self.text, offset, LineIndex.CHARS, LineIndex.UTF16)
+
+	def utf16_to_offset(self, offset):
+		return self.get_index().convert(self.text, offset, LineIndex.UTF16, LineIndex.CHARS)
+
+	def get_range(self, start, end):
+		"""
+		Gets the text between two offsets.
+		"""
+		return self.text[start:end]
+
+	def get_lines(self, first, last):
+		"""
+		Gets the text of lines (first) up to (last), with the
+		offset where it starts.
+		"""
+		index = self.get_index()
+		start = index.line_start(first)
+		return (start, self.text[start:index.line_start(last)])
+
 	def get_version(self):
-		return 0
+		return self.version
 
-	def store(self):
+	def set_whole(self, version, text):
 		"""
-		Stores the document in a file.
+		Replace the whole text (at a specific version),
+		e.g. with the text a follower gets from its primary.
 		"""
+		self.text = text
+		self.version = version
+		self.unsaved_changes = True
+		if self.trigrams_enabled:
+			self.trigrams = Trigrams(text)
+
+	def store(self, commit=None):
+		"""
+		Stores the document, which has just been changed by (commit), if given
+		(so that the storage can only log the commit).
+		"""
+		if not self.persistent:
+			return
 		try:
 			if self.unsaved_changes:
-				self.log.info("Writing to file..")
-				with open(self.get_filepath(), "wt") as f:
-					text = self.get_whole()
-					f.write(text.encode("utf8"))
+				self.log.info("Writing to storage..")
+				with self.store_latency.time():
+					Document.get_storage().store(self, commit)
+				self.unsaved_changes = False
 		except Exception as e:
 			self.log.exception(e)
 
-	def get_filepath(self):
-		"""
-		Produce a base64 filepath from document name.
-		"""
-		fname = base64.urlsafe_b64encode(self.docname)
-		return os.path.join(Document.STORAGE_PATH, fname)
-
 	def retrieve(self):
 		"""
 		Load the document.
 		"""
-		fpath = self.get_filepath()
-		# Open the file for reading and create it if
-		# it doesn't exist yet.
-		with open(fpath, "a+") as fi:
-			self.text = fi.read().decode("utf8")
+		version, text, log = Document.get_storage().load(self.docname)
+		self.text = text
+		self.version = version
+		# Commits made since the stored text.
+		for sequence in log:
+			self.process_commit(cp.Message({"id": cp.Protocol.REQ_COMMIT,
+				"version": self.version, "sequence": sequence}))
+		self.unsaved_changes = False
 
 	def get_name(self):
 		"""
@@ -109,6 +342,22 @@ class Document:
 		"""
 		return self.docname
 
+	@staticmethod
+	def get_storage():
+		"""
+		Get the storage backend.
+		"""
+		if Document.STORAGE == None:
+			Document.STORAGE = FileStorage(Document.STORAGE_PATH)
+		return Document.STORAGE
+
+	@staticmethod
+	def list_stored():
+		"""
+		Names of the documents in storage.
+		"""
+		return Document.get_storage().list_names()
+
 	@staticmethod
 	def get_doc(docname):
 		"""
@@ -0,0 +1,268 @@
+"""
+Hash tree (Merkle tree) over the chunks of a text.
+
+The text is split into chunks, every chunk is hashed, and every FANOUT
+hashes are hashed together, up to a single root. Two texts with the
+same root are the same; when the roots differ, walking down the tree
+along the differing hashes finds the chunks that differ, without
+sending the rest of the text.
+
+Chunks end after lines picked by their content (about one character
+in CHUNK_SIZE ends a chunk, see split()), or at CHUNK_MAX characters,
+so the same text is split the same way wherever it comes from, and a
+change only moves the boundaries around it: the chunks after it are
+shifted, not hashed again. Changes only mark the chunks they touch,
+which are split and hashed again when the tree is next used, along
+with their parents.
+"""
+import hashlib
+import zlib
+
+from ctxt.shared_document.line_index import Fenwick
+
+
+def digest(data):
+	"""
+	Hash of a chunk (or of the hashes below a node).
+	"""
+	return hashlib.sha1(data).digest()[:8]
+
+
+class HashTree():
+	"""
+	Hash tree of a text, kept up to date with its changes.
+	"""
+	# Characters per chunk, on average.
+	CHUNK_SIZE = 4096
+	# Characters per chunk, at most.
+	CHUNK_MAX = 16384
+	# Hashes under a node.
+	FANOUT = 16
+	# Bytes per hash.
+	HASH_SIZE = 8
+
+	def __init__(self):
+		# The hashes of every level, from the chunks (0) up to the root.
+		self.levels = []
+		# Lengths of the chunks (and their sums), and the chunks
+		# changed since they were hashed.
+		self.lengths = None
+		self.offsets = None
+		self.stale = None
+		self.dirty = True
+		# The parents of the chunks from this one on are to be
+		# hashed again (the chunks have moved).
+		self.shifted = 0
+
+	@staticmethod
+	def split(text, start):
+		"""
+		Lengths of the chunks of (text) from (start), which is where a
+		chunk starts. A chunk ends after a line (or a part of a line cut
+		at CHUNK_MAX) whose CRC, modulo CHUNK_SIZE, is below its UTF-8
+		length, which only depends on the line itself.
+		"""
+		end = len(text)
+		chunk = start
+		pos = start
+		while pos < end:
+			cut = chunk + HashTree.CHUNK_MAX
+			nl = text.find(u"\n", pos, cut)
+			if nl == -1:
+				if cut >= end:
+					break
+				# A long line, cut where the chunk is at its longest.
+				yield cut - chunk
+				chunk = pos = cut
+				continue
+			line = text[pos:nl + 1].encode("utf8")
+			pos = nl + 1
+			if zlib.crc32(line) % HashTree.CHUNK_SIZE < len(line):
+				yield pos - chunk
+				chunk = pos
+		if chunk < end:
+			yield end - chunk
+
+	def insert(self, offset, length):
+		"""
+		(length) characters have been inserted at (offset).
+		"""
+		if self.lengths == None or length == 0:
+			self.dirty = True
+			return
+		k = self.find(offset)
+		self.lengths[k] += length
+		self.offsets.add(k, length)
+		self.stale[k] = True
+		self.dirty = True
+
+	def remove(self, offset, length):
+		"""
+		(length) characters have been removed from (offset).
+		"""
+		if self.lengths == None or length == 0:
+			self.dirty = True
+			return
+		k = self.find(offset)
+		last = self.find(offset + length - 1)
+		if last == k:
+			self.lengths[k] -= length
+			self.offsets.add(k, -length)
+		else:
+			# What's left of the chunks makes a single one, for now.
+			self.lengths[k] = sum(self.lengths[k:last + 1]) - length
+			del self.lengths[k + 1:last + 1]
+			del self.levels[0][k + 1:last + 1]
+			del self.stale[k + 1:last + 1]
+			self.offsets = Fenwick(self.lengths)
+			self.shifted = min(self.shifted, k)
+		self.stale[k] = True
+		self.dirty = True
+
+	def find(self, offset):
+		"""
+		The chunk an offset is in (the last one, past the end).
+		"""
+		k, _ = self.offsets.search(offset)
+		return min(k, len(self.lengths) - 1)
+
+	def update(self, text):
+		"""
+		Split and hash the chunks of (text) that have changed, and their parents.
+		"""
+		if not self.dirty:
+			return
+		self.dirty = False
+		if self.lengths == None:
+			self.build(text)
+			return
+		# Chunks hashed again, and where the chunks start to
+		# have moved to other indices (and so their parents).
+		changed = []
+		k = 0
+		while True:
+			try:
+				k = self.stale.index(True, k)
+			except ValueError:
+				break
+			# Split again from the start of the chunk, until a chunk
+			# ends where one did before (the rest is split the same).
+			start = self.offsets.prefix(k)
+			last = k
+			old_end = start + self.lengths[k]
+			lengths = []
+			pos = start
+			for n in HashTree.split(text, start):
+				lengths.append(n)
+				pos += n
+				while old_end < pos and last + 1 < len(self.lengths):
+					last += 1
+					old_end += self.lengths[last]
+				if old_end == pos:
+					break
+			if len(lengths) == 0 and last + 1 - k == len(self.lengths):
+				# An empty text is a single empty chunk.
+				lengths = [0]
+			hashes = []
+			pos = start
+			for n in lengths:
+				hashes.append(digest(text[pos:pos + n].encode("utf8")))
+				pos += n
+			self.levels[0][k:last + 1] = hashes
+			self.stale[k:last + 1] = [False] * len(lengths)
+			if len(lengths) != last + 1 - k:
+				self.lengths[k:last + 1] = lengths
+				self.offsets = Fenwick(self.lengths)
+				self.shifted = min(self.shifted, k)
+			else:
+				for i, n in enumerate(lengths):
+					self.offsets.add(k + i, n - self.lengths[k + i])
+					self.lengths[k + i] = n
+			changed.append((k, len(lengths)))
+			k += len(lengths)
+		self.hash_parents(changed)
+
+	def build(self, text):
+		"""
+		Split and hash a whole text.
+		"""
+		self.lengths = list(HashTree.split(text, 0)) or [0]
+		self.offsets = Fenwick(self.lengths)
+		self.stale = [False] * len(self.lengths)
+		hashes = []
+		pos = 0
+		for n in self.lengths:
+			hashes.append(digest(text[pos:pos + n].encode("utf8")))
+			pos += n
+		self.levels = [hashes]
+		self.shifted = 0
+		self.hash_parents([])
+
+	def hash_parents(self, changed):
+		"""
+		Hash the parents of the (changed) hashes (first, count), and of
+		all of them from where they have shifted on, level by level.
+		"""
+		fanout = HashTree.FANOUT
+		dirty = set()
+		for first, count in changed:
+			dirty.update(xrange(first, first + count))
+		shifted = self.shifted
+		level = 0
+		while len(self.levels[level]) > 1:
+			below = self.levels[level]
+			if level + 1 == len(self.levels):
+				self.levels.append([])
+			nodes = self.levels[level + 1]
+			count = (len(below) + fanout - 1) // fanout
+			shifted = min(shifted // fanout, len(nodes), count)
+			dirty = set(i // fanout for i in dirty if i // fanout < shifted)
+			del nodes[count:]
+			for i in sorted(dirty) + range(shifted, count):
+				node = digest(b"".join(below[i * fanout:(i + 1) * fanout]))
+				if i < len(nodes):
+					nodes[i] = node
+				else:
+					nodes.append(node)
+			level += 1
+		# The text may have become shorter.
+		del self.levels[level + 1:]
+		self.shifted = len(self.lengths)
+
+	def depth(self):
+		"""
+		Number of levels, the root being at (depth - 1).
+		"""
+		return len(self.levels)
+
+	def get(self, level, first, count):
+		"""
+		(count) hashes of a level from (first) on (fewer at its end).
+		"""
+		if level >= len(self.levels):
+			return []
+		return self.levels[level][first:first + count]
+
+	def get_range(self, first, count):
+		"""
+		Where (count) chunks from (first) on are in the text
+		(start, end), fewer at its end.
+		"""
+		first = min(first, len(self.lengths))
+		last = min(first + count, len(self.lengths))
+		start = self.offsets.prefix(first)
+		return (start, start + sum(self.lengths[first:last]))
+
+	def get_chunks(self, text, first, count):
+		"""
+		The text of (count) chunks from (first) on.
+		"""
+		start, end = self.get_range(first, count)
+		chunks = []
+		for n in self.lengths[first:first + count]:
+			chunks.append(text[start:start + n])
+			start += n
+		return chunks
+
+	def get_root(self):
+		return self.levels[-1][0]
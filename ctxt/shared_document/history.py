@@ -0,0 +1,262 @@
+"""
+Version history of the documents.
+
+Every commit is kept (its encoded operations, by version) in a small
+SQLite database, along with checkpoints: the whole text of a document
+at some of its versions. A checkpoint is taken once CHECKPOINT_OPS
+operations have been committed since the previous one, so the text
+at any version is the nearest checkpoint before it, with fewer than
+CHECKPOINT_OPS operations replayed on top, however long the history.
+
+The latest version is kept as well, so that a document whose storage
+doesn't keep versions (files) goes on from where its history left off
+after a restart. The text is only checksummed at checkpoints and on
+closing (not on every commit): if the latest version is a later one,
+the text is checked against the history replayed up to it.
+"""
+import difflib
+import logging
+import sqlite3
+import time
+
+import ctxt.protocol as cp
+
+
+def diff_lines(old, new, name=u""):
+	"""
+	Operations (by author (name)) changing text (old) into (new),
+	line by line. They're to be applied in order, the last
+	change comes first, so that the offsets stay valid.
+	"""
+	old_lines = old.splitlines(True)
+	new_lines = new.splitlines(True)
+	# Offsets of the old lines.
+	offsets = [0]
+	for line in old_lines:
+		offsets.append(offsets[-1] + len(line))
+	matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+	sequence = []
+	for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+		if tag in ["replace", "delete"]:
+			sequence.append({"id": cp.Protocol.RES_REMOVE, "name": name,
+				"cursor": offsets[i1], "length": offsets[i2] - offsets[i1]})
+		if tag in ["replace", "insert"]:
+			sequence.append({"id": cp.Protocol.RES_INSERT, "name": name,
+				"cursor": offsets[i1], "text": u"".join(new_lines[j1:j2])})
+	return sequence
+
+
+def apply_ops(text, sequence):
+	"""
+	Apply a sequence of operations to a text.
+	"""
+	for op in sequence:
+		cursor = op["cursor"]
+		if op["id"] == cp.Protocol.RES_INSERT:
+			text = text[:cursor] + op["text"] + text[cursor:]
+		elif op["id"] == cp.Protocol.RES_REMOVE:
+			text = text[:cursor] + text[cursor + op["length"]:]
+	return text
+
+
+class History():
+	"""
+	Version history of the documents, used from the server thread only.
+	"""
+	LOGNAME = "CT.History"
+
+	# Most operations replayed to get any version of a document.
+	CHECKPOINT_OPS = 128
+	# Longest time (s) to keep writes in a transaction.
+	BATCH_INTERVAL = 0.1
+
+	SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS commits (
+			doc TEXT NOT NULL,
+			version INTEGER NOT NULL,
+			ops INTEGER NOT NULL,
+			body BLOB NOT NULL,
+			PRIMARY KEY (doc, version))""",
+		"""CREATE TABLE IF NOT EXISTS checkpoints (
+			doc TEXT NOT NULL,
+			version INTEGER NOT NULL,
+			text TEXT NOT NULL,
+			PRIMARY KEY (doc, version))""",
+		"""CREATE TABLE IF NOT EXISTS heads (
+			doc TEXT PRIMARY KEY,
+			version INTEGER NOT NULL,
+			checked INTEGER NOT NULL,
+			checksum INTEGER NOT NULL)""",
+	]
+
+	def __init__(self, path):
+		self.log = logging.getLogger(History.LOGNAME)
+		self.db = sqlite3.connect(path)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		for sql in History.SCHEMA:
+			self.db.execute(sql)
+		self.db.commit()
+		self.t_begin = None
+		# Operations committed since the latest checkpoint, by document name.
+		self.ops_since = {}
+		# Documents with their latest version not written yet, by name.
+		self.dirty = {}
+		# The latest (version, checksum of its text) of every document, by name.
+		self.checked = {}
+		# Every document we've seen, to checksum them on closing.
+		self.docs = {}
+
+	def open_doc(self, doc):
+		"""
+		A document has been opened: go on with its history. If the
+		text isn't the one the history ended with, it has been changed
+		outside of it, and that's a new version (with a checkpoint).
+		"""
+		name = doc.get_name()
+		row = self.db.execute("SELECT version, checked, checksum FROM heads WHERE doc = ?",
+				(name,)).fetchone()
+		if row == None:
+			self.checkpoint(doc)
+			return
+		version, checked, checksum = row
+		if version >= doc.get_version() and self.is_head(doc, version, checked, checksum):
+			if version != doc.get_version():
+				self.log.info(u"\"{}\" goes on from version {:08X}".format(name, version))
+				doc.version = version
+			self.checked[name] = (checked, checksum)
+			self.docs[name] = doc
+			latest, = self.db.execute(
+					"SELECT MAX(version) FROM checkpoints WHERE doc = ?", (name,)).fetchone()
+			ops, = self.db.execute(
+					"SELECT TOTAL(ops) FROM commits WHERE doc = ? AND version > ?",
+					(name, latest if latest != None else -1)).fetchone()
+			self.ops_since[name] = int(ops)
+			return
+		if doc.get_version() <= version:
+			self.log.warning(u"\"{}\" has changed outside of its history".format(name))
+			doc.version = version + 1
+			# Stored with the version it's known by now.
+			doc.unsaved_changes = True
+			doc.store()
+		self.checkpoint(doc)
+
+	def is_head(self, doc, version, checked, checksum):
+		"""
+		Is the text of a document the one its history ended with (at
+		(version), the text at version (checked) having (checksum))?
+		"""
+		if checked == version:
+			return checksum == self.get_checksum(doc)
+		# Not closed since: the history has the text.
+		return self.get_text(doc.get_name(), version) == doc.get_whole()
+
+	def get_checksum(self, doc):
+		return cp.Protocol.checksum(doc.get_whole().encode("utf8"))
+
+	def record(self, doc, commit):
+		"""
+		A document has been changed by (commit), with its encoding in (body).
+		"""
+		name = doc.get_name()
+		ops = len(commit.sequence)
+		self.db.execute(
+				"INSERT OR REPLACE INTO commits (doc, version, ops, body) VALUES (?, ?, ?, ?)",
+				(name, commit.version, ops, sqlite3.Binary(commit.body)))
+		self.ops_since[name] = self.ops_since.get(name, 0) + ops
+		if self.ops_since[name] >= History.CHECKPOINT_OPS:
+			self.checkpoint(doc)
+		else:
+			self.wrote(doc)
+
+	def reset(self, doc):
+		"""
+		A document has been replaced as a whole (at its version),
+		e.g. by the text from the primary. Whatever our history
+		had from that version on is gone.
+		"""
+		name = doc.get_name()
+		self.db.execute("DELETE FROM commits WHERE doc = ? AND version > ?",
+				(name, doc.get_version()))
+		self.db.execute("DELETE FROM checkpoints WHERE doc = ? AND version > ?",
+				(name, doc.get_version()))
+		self.checkpoint(doc)
+
+	def checkpoint(self, doc):
+		"""
+		Keep the whole text of a document at its current version.
+		"""
+		name = doc.get_name()
+		self.log.debug(u"Checkpoint of \"{}\" ({:08X})".format(name, doc.get_version()))
+		self.db.execute(
+				"INSERT OR REPLACE INTO checkpoints (doc, version, text) VALUES (?, ?, ?)",
+				(name, doc.get_version(), doc.get_whole()))
+		self.ops_since[name] = 0
+		self.checked[name] = (doc.get_version(), self.get_checksum(doc))
+		self.wrote(doc)
+
+	def wrote(self, doc):
+		self.dirty[doc.get_name()] = doc
+		self.docs[doc.get_name()] = doc
+		if self.t_begin == None:
+			self.t_begin = time.time()
+		self.flush()
+
+	def flush(self, force=False):
+		"""
+		Finish the transaction, if it's been open long enough (or forced).
+		Only the latest versions are written, with the latest checksums
+		(of the checkpoints, most likely earlier versions).
+		"""
+		if self.t_begin == None:
+			return
+		if force or time.time() - self.t_begin >= History.BATCH_INTERVAL:
+			for name, doc in self.dirty.items():
+				checked, checksum = self.checked.get(name, (-1, 0))
+				self.db.execute(
+						"INSERT OR REPLACE INTO heads (doc, version, checked, checksum) VALUES (?, ?, ?, ?)",
+						(name, doc.get_version(), checked, checksum))
+			self.dirty = {}
+			self.db.commit()
+			self.t_begin = None
+
+	def get_text(self, docname, version):
+		"""
+		The text of a document at (version), or None if
+		the history doesn't have it.
+		"""
+		row = self.db.execute(
+				"SELECT version, text FROM checkpoints WHERE doc = ? AND version <= ? "
+				"ORDER BY version DESC LIMIT 1",
+				(docname, version)).fetchone()
+		if row == None:
+			return None
+		at, text = row
+		for v, body in self.db.execute(
+				"SELECT version, body FROM commits WHERE doc = ? AND version > ? AND version <= ? "
+				"ORDER BY version",
+				(docname, at, version)):
+			if v != at + 1:
+				# Commits missing from the history.
+				return None
+			body = bytes(body)
+			d = cp.Protocol.unpack(cp.Protocol.res_commit_header(len(body)) + body)
+			text = apply_ops(text, d["sequence"])
+			at = v
+		if at != version:
+			return None
+		return text
+
+	def close(self):
+		"""
+		Checksum the latest versions (so that opening the documents
+		again doesn't need the history replayed), and close.
+		"""
+		for name, doc in self.docs.items():
+			if self.checked.get(name, (-1, 0))[0] != doc.get_version():
+				self.checked[name] = (doc.get_version(), self.get_checksum(doc))
+				self.dirty[name] = doc
+				if self.t_begin == None:
+					self.t_begin = time.time()
+		self.flush(True)
+		self.db.close()
@@ -0,0 +1,289 @@
+"""
+Line index of a text: line lengths in characters (code points),
+UTF-8 bytes and UTF-16 code units (as Qt counts them).
+
+The lines are kept in blocks, with a Fenwick tree over the block
+sums of every measure, so that both updates and lookups (offset
+to line, line to offset, and offsets between encodings) take
+O(log n) plus a walk over a single block. Only the line being
+edited is measured again, never the whole text.
+"""
+import array
+
+
+class Fenwick():
+	"""
+	Fenwick (binary indexed) tree of prefix sums.
+	"""
+	def __init__(self, values=()):
+		self.build(values)
+
+	def build(self, values):
+		n = len(values)
+		tree = [0] + list(values)
+		for i in range(1, n + 1):
+			j = i + (i & -i)
+			if j <= n:
+				tree[j] += tree[i]
+		self.tree = tree
+		self.n = n
+		self.total = sum(values)
+
+	def add(self, i, delta):
+		"""
+		Add (delta) to item (i).
+		"""
+		self.total += delta
+		i += 1
+		tree = self.tree
+		while i <= self.n:
+			tree[i] += delta
+			i += i & -i
+
+	def prefix(self, i):
+		"""
+		Sum of the first (i) items.
+		"""
+		s = 0
+		tree = self.tree
+		while i > 0:
+			s += tree[i]
+			i -= i & -i
+		return s
+
+	def search(self, value):
+		"""
+		Find the item where the running sum exceeds (value).
+		Returns (item, value - sum of the items before it);
+		the item is n, if the total doesn't exceed the value.
+		"""
+		pos = 0
+		step = 1
+		while step * 2 <= self.n:
+			step *= 2
+		tree = self.tree
+		while step > 0:
+			nxt = pos + step
+			if nxt <= self.n and tree[nxt] <= value:
+				pos = nxt
+				value -= tree[nxt]
+			step //= 2
+		return (pos, value)
+
+
+def utf16_len(text):
+	return len(text.encode("utf-16-le")) // 2
+
+def measure(line):
+	"""
+	Measures of a line: (characters, UTF-8 bytes, UTF-16 units).
+	"""
+	n = len(line)
+	b = len(line.encode("utf8"))
+	if b == n:
+		# Plain ASCII.
+		return (n, n, n)
+	return (n, b, utf16_len(line))
+
+def split_lines(text):
+	"""
+	Split a text into lines, keeping the line ends.
+	"""
+	lines = text.split(u"\n")
+	for i in range(len(lines) - 1):
+		lines[i] += u"\n"
+	return lines
+
+
+class LineIndex():
+	"""
+	Blocked index of line measures. Every block holds an array
+	per measure, with an item per line.
+	"""
+	# Lines per block (blocks are split at twice the size).
+	BLOCK = 128
+
+	# Measures
+	CHARS = 0
+	UTF8 = 1
+	UTF16 = 2
+
+	def __init__(self, text=u""):
+		self.reset(text)
+
+	def reset(self, text):
+		"""
+		Index a whole text from scratch.
+		"""
+		# Measure all lines at once, rather than encoding them one by one.
+		# (The line ends count, too, but the last line has none.)
+		lines = text.split(u"\n")
+		chars = array.array("i", [n + 1 for n in map(len, lines)])
+		chars[-1] -= 1
+		utf8 = array.array("i", [n + 1 for n in map(len, text.encode("utf8").split(b"\n"))])
+		utf8[-1] -= 1
+		# Only characters beyond the BMP take two UTF-16 units (with a
+		# narrow Python build, they take two characters just as well).
+		if sum(utf8) != len(text) and utf16_len(text) != len(text):
+			utf16 = array.array("i", [n + 1 for n in map(utf16_len, lines)])
+			utf16[-1] -= 1
+		else:
+			utf16 = array.array("i", chars)
+		self.blocks = []
+		for i in range(0, len(chars), LineIndex.BLOCK):
+			j = i + LineIndex.BLOCK
+			self.blocks.append([chars[i:j], utf8[i:j], utf16[i:j]])
+		self.rebuild()
+
+	def rebuild(self):
+		"""
+		Rebuild the trees over the block sums.
+		"""
+		# Line counts, then the sums of every measure.
+		self.trees = [Fenwick([len(block[0]) for block in self.blocks])]
+		for m in range(3):
+			self.trees.append(Fenwick([sum(block[m]) for block in self.blocks]))
+
+	def replace(self, b, i, j, lines):
+		"""
+		Replace lines (i) to (j) of block (b) with the measures of (lines).
+		"""
+		block = self.blocks[b]
+		for m in range(3):
+			column = array.array("i", [line[m] for line in lines])
+			old = sum(block[m][i:j])
+			block[m][i:j] = column
+			delta = sum(column) - old
+			if delta != 0:
+				self.trees[m + 1].add(b, delta)
+		self.trees[0].add(b, len(lines) - (j - i))
+		if len(block[0]) > 2 * LineIndex.BLOCK:
+			# Split it in two.
+			half = len(block[0]) // 2
+			self.blocks[b:b + 1] = [
+					[column[:half] for column in block],
+					[column[half:] for column in block]]
+			self.rebuild()
+
+	def find(self, m, value):
+		"""
+		Find the line where a position (in measure m) is.
+		Returns (block, line in block, position within the line).
+		Positions past the end are on the last line.
+		"""
+		tree = self.trees[m + 1]
+		if value >= tree.total:
+			b = len(self.blocks) - 1
+			column = self.blocks[b][m]
+			i = len(column) - 1
+			return (b, i, value - (tree.total - column[i]))
+		b, value = tree.search(value)
+		column = self.blocks[b][m]
+		i = 0
+		while value >= column[i]:
+			value -= column[i]
+			i += 1
+		return (b, i, value)
+
+	def locate(self, line):
+		"""
+		Find a line by its number: (block, line in block).
+		"""
+		b, i = self.trees[0].search(line)
+		return (b, i)
+
+	def start(self, m, b, i):
+		"""
+		Start of line (i) of block (b), in measure (m).
+		"""
+		return self.trees[m + 1].prefix(b) + sum(self.blocks[b][m][:i])
+
+	def is_last(self, b, i):
+		return b == len(self.blocks) - 1 and i == len(self.blocks[b][0]) - 1
+
+	def insert(self, offset, text, new_text):
+		"""
+		(text) has been inserted at (offset), giving (new_text).
+		"""
+		n = len(text)
+		if n == 0:
+			return
+		b, i, r = self.find(LineIndex.CHARS, offset)
+		length = self.blocks[b][LineIndex.CHARS][i]
+		start = offset - r
+		lines = [measure(line) for line in
+				split_lines(new_text[start:start + length + n])]
+		if not self.is_last(b, i):
+			# Split after the line end, which isn't the end of the text.
+			lines.pop()
+		self.replace(b, i, i + 1, lines)
+
+	def remove(self, offset, length, new_text):
+		"""
+		(length) characters have been removed from (offset), giving (new_text).
+		"""
+		if length <= 0:
+			return
+		b1, i1, r1 = self.find(LineIndex.CHARS, offset)
+		b2, i2, r2 = self.find(LineIndex.CHARS, offset + length)
+		start = offset - r1
+		# What's left of the first and the last line make up a single line.
+		end = offset + length - r2 + self.blocks[b2][LineIndex.CHARS][i2]
+		merged = measure(new_text[start:end - length])
+		if b1 == b2:
+			self.replace(b1, i1, i2 + 1, [merged])
+			return
+		# Across blocks.
+		for m in range(3):
+			self.blocks[b1][m][i1:] = array.array("i", [merged[m]])
+			del self.blocks[b2][m][:i2 + 1]
+		del self.blocks[b1 + 1:b2]
+		self.blocks = [block for block in self.blocks if len(block[0]) > 0]
+		self.rebuild()
+
+	def line_count(self):
+		return self.trees[0].total
+
+	def length(self, m=0):
+		"""
+		Length of the text (in measure m).
+		"""
+		return self.trees[m + 1].total
+
+	def line_start(self, line):
+		"""
+		Offset of the start of a line (the end of the text past the last line).
+		"""
+		if line < 0:
+			return 0
+		if line >= self.line_count():
+			return self.length()
+		b, i = self.locate(line)
+		return self.start(LineIndex.CHARS, b, i)
+
+	def line_of(self, offset):
+		"""
+		The line an offset is on.
+		"""
+		b, i, r = self.find(LineIndex.CHARS, offset)
+		return self.trees[0].prefix(b) + i
+
+	def convert(self, text, value, src, dst):
+		"""
+		Convert a position in (text) from one measure to another.
+		"""
+		if src == dst:
+			return value
+		b, i, r = self.find(src, value)
+		# Start of the line in both measures.
+		length = self.blocks[b][LineIndex.CHARS][i]
+		start = self.start(LineIndex.CHARS, b, i)
+		res = self.start(dst, b, i)
+		# Within the line.
+		if src == LineIndex.CHARS:
+			part = text[start:start + r]
+		elif src == LineIndex.UTF8:
+			part = text[start:start + length].encode("utf8")[:r].decode("utf8", "ignore")
+		else:
+			part = text[start:start + length].encode("utf-16-le")[:2 * r].decode("utf-16-le", "ignore")
+		return res + measure(part)[dst]
@@ -0,0 +1,596 @@
+"""
+Client-side mirror of a shared document.
+
+Keeps two Documents: the server's state (every commit applied
+exactly as the server has applied it) and the view (what the
+user sees, i.e. the server state with our pending operations
+on top). Remote operations are rebased over the pending ones
+in pure Python, and the result tells the GUI which minimal
+changes to make to its widget.
+"""
+
+import os
+
+import ctxt.protocol as cp
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.hash_tree import HashTree
+
+
+def op_end(op):
+	"""
+	End of the range an operation covers in the state it applies to.
+	"""
+	if op["id"] == cp.Protocol.RES_REMOVE:
+		return op["cursor"] + op["length"]
+	return op["cursor"]
+
+def shifted(op, cursor, length=None):
+	"""
+	Copy of an operation with a new cursor (and length).
+	"""
+	op = dict(op)
+	op["cursor"] = cursor
+	if length != None:
+		op["length"] = length
+	return op
+
+def transform(op, other, op_first=False):
+	"""
+	Transform (op) to apply after (other), both having been made
+	against the same state. When both insert at the same position,
+	(op_first) tells whose text ends up first.
+	Returns a list of 0, 1 or 2 operations.
+	"""
+	o_id = other["id"]
+	if o_id not in [cp.Protocol.RES_INSERT, cp.Protocol.RES_REMOVE]:
+		return [op]
+	pos = op["cursor"]
+	o_pos = other["cursor"]
+
+	if op["id"] == cp.Protocol.RES_INSERT:
+		if o_id == cp.Protocol.RES_INSERT:
+			if o_pos < pos or (o_pos == pos and not op_first):
+				return [shifted(op, pos + len(other["text"]))]
+			return [op]
+		# Against a removal.
+		o_end = op_end(other)
+		if pos <= o_pos:
+			return [op]
+		if pos >= o_end:
+			return [shifted(op, pos - other["length"])]
+		# Inserting into removed text: insert where the removal was.
+		return [shifted(op, o_pos)]
+
+	elif op["id"] == cp.Protocol.RES_REMOVE:
+		end = op_end(op)
+		if o_id == cp.Protocol.RES_INSERT:
+			o_len = len(other["text"])
+			if o_pos <= pos:
+				return [shifted(op, pos + o_len)]
+			if o_pos >= end:
+				return [op]
+			# Text was inserted into the removed range, keep it
+			# (the second removal applies after the first one).
+			return [
+					shifted(op, pos, o_pos - pos),
+					shifted(op, pos + o_len, end - o_pos)]
+		# Against a removal.
+		o_end = op_end(other)
+		if end <= o_pos:
+			return [op]
+		if pos >= o_end:
+			return [shifted(op, pos - other["length"])]
+		# Overlapping removals: only remove what's left.
+		overlap = min(end, o_end) - max(pos, o_pos)
+		length = op["length"] - overlap
+		if length <= 0:
+			return []
+		return [shifted(op, min(pos, o_pos), length)]
+
+	return [op]
+
+def transform_ops(ops, others, ops_first=False):
+	"""
+	Transform two concurrent operation sequences against each other.
+	Returns (ops after others, others after ops).
+	"""
+	res_ops = []
+	for op in ops:
+		op_list = [op]
+		res_others = []
+		for other in others:
+			if len(op_list) == 1:
+				a = op_list[0]
+				op_list = transform(a, other, ops_first)
+				res_others += transform(other, a, not ops_first)
+			else:
+				# The op was split in two (or removed altogether).
+				other_list, op_list = transform_ops([other], op_list, not ops_first)
+				res_others += other_list
+		res_ops += op_list
+		others = res_others
+	return (res_ops, others)
+
+def rebase_history(history, op):
+	"""
+	Rebase the edits of an undo (or redo) history, the latest one
+	last, over an operation made after all of them.
+	"""
+	ops = [op]
+	for i in reversed(range(len(history))):
+		history[i], ops = transform_ops(history[i], ops)
+		if len(ops) == 0:
+			break
+
+def apply_op(doc, op, version=0):
+	"""
+	Apply a single operation to a Document.
+	"""
+	if op["id"] == cp.Protocol.RES_INSERT:
+		doc.insert(version, op["cursor"], op["text"])
+	elif op["id"] == cp.Protocol.RES_REMOVE:
+		doc.remove(version, op["cursor"], op["length"])
+
+def diff_ops(old, new, name):
+	"""
+	Minimal single-range change turning (old) into (new):
+	at most one removal and one insertion.
+	"""
+	if old == new:
+		return []
+	prefix = len(os.path.commonprefix([old, new]))
+	max_suffix = min(len(old), len(new)) - prefix
+	suffix = 0
+	# Compare the ends in growing blocks, rather than char by char.
+	block = 64
+	while suffix < max_suffix:
+		n = min(block, max_suffix - suffix)
+		a = old[len(old) - suffix - n:len(old) - suffix]
+		b = new[len(new) - suffix - n:len(new) - suffix]
+		if a == b:
+			suffix += n
+			block *= 2
+			continue
+		# Find the exact spot within the block.
+		common = len(os.path.commonprefix([a[::-1], b[::-1]]))
+		suffix += common
+		break
+	ops = []
+	removed = len(old) - prefix - suffix
+	if removed > 0:
+		ops.append({"id": cp.Protocol.RES_REMOVE, "cursor": prefix,
+			"length": removed, "name": name})
+	added = new[prefix:len(new) - suffix]
+	if len(added) > 0:
+		ops.append({"id": cp.Protocol.RES_INSERT, "cursor": prefix,
+			"text": added, "name": name})
+	return ops
+
+
+class Mirror():
+	"""
+	Local mirror of a shared document.
+	The text may also be loaded lazily, range by range: the mirror
+	then holds the beginning of the document, and ignores whatever
+	happens past it (the ranges loaded later include it).
+	"""
+	# Characters to ask for at once, when loading lazily.
+	# Ranges grow with the text loaded so far, so that appending
+	# to the text doesn't get quadratic.
+	RANGE_MIN = 65536
+	RANGE_MAX = 4194304
+	# Most hashes to ask for at once.
+	HASHES_MAX = 256
+	# Most edits to keep, to undo.
+	UNDO_MAX = 100
+
+	def __init__(self, docname, nickname, utf16=False):
+		self.nickname = nickname
+		# Note the UTF-16 positions of the changes to the view
+		# (cursor16, length16), for widgets that count in UTF-16?
+		self.utf16 = utf16
+		# The document as the server has it.
+		self.server = Document(docname, persistent=False)
+		# The document as the user sees it.
+		self.view = Document(docname, persistent=False)
+		self.version = 0
+		# Our operations sent, but not yet seen back from the server.
+		# Every sent operation is a list, as rebasing may split it.
+		self.pending = []
+		# Our operations not sent yet.
+		self.unsent = []
+		# Chunks of a full text being received, if any, not written
+		# into the documents yet (and their length).
+		self.chunks = None
+		self.chunked = 0
+		# Commits received in the middle of a full text.
+		self.deferred = []
+		# Length of the whole document, while only a part of it is loaded.
+		self.total = None
+		# Our edits to undo and redo, the latest last: every edit is
+		# the operations undoing it, in the view as it is now (the
+		# others' operations are rebased under them, not undone).
+		self.undo_stack = []
+		self.redo_stack = []
+		# The operations undoing an edit being undone or redone.
+		self.replaying = None
+
+	def set_text(self, version, text):
+		"""
+		Start over from a full text.
+		"""
+		self.server.text = text
+		self.view.text = text
+		self.version = version
+		self.pending = []
+		self.unsent = []
+		self.total = None
+		self.undo_stack = []
+		self.redo_stack = []
+
+	def add_range(self, version, start, length, text):
+		"""
+		A range of the text from the server, the document being
+		(length) characters long. Only the part continuing the text
+		loaded so far is used. Returns the text added to the end.
+		"""
+		loaded = self.loaded_end()
+		if start > loaded:
+			# The text before the range has changed since we asked.
+			return u""
+		added = text[loaded - start:]
+		if len(added) > 0:
+			self.server.text += added
+			self.view.text += added
+		self.version = version
+		if start + len(text) >= length:
+			self.total = None
+		else:
+			self.total = length
+		return added
+
+	def is_partial(self):
+		"""
+		Is only the beginning of the document loaded?
+		"""
+		return self.total != None
+
+	def loaded_end(self):
+		"""
+		Where the loaded text ends in the server's document.
+		"""
+		return len(self.server.text)
+
+	def next_range(self):
+		"""
+		The next range to load (start, end), if any.
+		"""
+		if not self.is_partial():
+			return None
+		start = self.loaded_end()
+		size = min(max(Mirror.RANGE_MIN, start), Mirror.RANGE_MAX)
+		return (start, start + size)
+
+	def apply_view(self, op, version):
+		"""
+		Apply a remote operation to the view (and rebase our
+		edits to undo and redo over it).
+		"""
+		rebase_history(self.undo_stack, op)
+		rebase_history(self.redo_stack, op)
+		self.note_utf16(op)
+		apply_op(self.view, op, version)
+
+	def note_utf16(self, op):
+		"""
+		Note the UTF-16 position of an operation on the view, if asked to.
+		"""
+		if self.utf16:
+			op["cursor16"] = self.view.offset_to_utf16(op["cursor"])
+			if op["id"] == cp.Protocol.RES_REMOVE:
+				op["length16"] = self.view.offset_to_utf16(op_end(op)) - op["cursor16"]
+
+	def clip(self, op):
+		"""
+		The part of a remote operation within the loaded text, if any.
+		"""
+		loaded = self.loaded_end()
+		if op["id"] == cp.Protocol.RES_INSERT:
+			if op["cursor"] > loaded:
+				self.total += len(op["text"])
+				return None
+			return op
+		if op["cursor"] >= loaded:
+			self.total -= op["length"]
+			return None
+		if op_end(op) > loaded:
+			self.total -= op_end(op) - loaded
+			return shifted(op, op["cursor"], loaded - op["cursor"])
+		return op
+
+	def begin_text(self, version):
+		"""
+		Start over from a full text that arrives in chunks.
+		"""
+		self.set_text(version, u"")
+		self.chunks = []
+		self.chunked = 0
+		self.deferred = []
+
+	def append_text(self, text):
+		"""
+		Another chunk of the full text. The chunks are written into
+		the documents as they arrive, once there are as many as there
+		is text already, so that appending doesn't get quadratic.
+		"""
+		self.chunks.append(text)
+		self.chunked += len(text)
+		if self.chunked >= len(self.server.text):
+			self.write_chunks()
+
+	def write_chunks(self):
+		text = self.server.text + u"".join(self.chunks)
+		self.server.text = text
+		self.view.text = text
+		self.chunks = []
+		self.chunked = 0
+
+	def is_loading(self):
+		return self.chunks != None
+
+	def end_text(self):
+		"""
+		All chunks have arrived. Applies the commits that arrived
+		in the meantime, returns the changes they make.
+		"""
+		self.write_chunks()
+		self.set_text(self.version, self.server.text)
+		self.chunks = None
+		changes = []
+		deferred, self.deferred = self.deferred, []
+		for commit in deferred:
+			changes += self.apply_commit(commit)
+		return changes
+
+	def abort_text(self):
+		"""
+		The full text didn't arrive intact, forget the chunks
+		(and keep deferring commits until it's sent again).
+		"""
+		self.set_text(self.version, u"")
+		self.chunks = []
+		self.chunked = 0
+		self.deferred = []
+
+	def can_verify(self):
+		"""
+		Can our text be compared with the server's, i.e. is all of it
+		loaded, and are none of our operations on the way?
+		"""
+		return not self.is_partial() and not self.is_loading() and \
+			len(self.pending) == 0 and len(self.unsent) == 0
+
+	def verify(self, msg):
+		"""
+		Compare hashes of the server's hash tree with ours. Returns the
+		hash requests (level, first, count, flags) to walk down the tree
+		along the ones that differ: for the chunks of the text
+		themselves (HASH_TEXT), once at the lowest level.
+		Nothing to ask for, if they match (or can't be compared).
+		"""
+		if msg.version != self.version or not self.can_verify():
+			return []
+		# A node covers the same chunks in both trees, however deep
+		# they are (and ours may not have the node at all).
+		ours = self.server.get_hash_tree().get(msg.level, msg.first, len(msg.hashes))
+		differs = [msg.first + i for i, h in enumerate(msg.hashes)
+			if i >= len(ours) or ours[i] != h]
+		if len(differs) == 0:
+			if msg.level == 0 and len(msg.hashes) > 0 and len(self.server.text) > msg.length and \
+					self.server.get_hash_tree().get_range(msg.first, len(msg.hashes))[1] == msg.length:
+				# The server's text ends with these chunks, and ours goes on.
+				return [(0, msg.first + len(msg.hashes) - 1, 1, cp.Protocol.HASH_TEXT)]
+			return []
+		if msg.level == 0:
+			# The chunks themselves, in runs.
+			requests = []
+			for i in differs:
+				if len(requests) > 0 and requests[-1][1] + requests[-1][2] == i and \
+						requests[-1][2] < Mirror.HASHES_MAX:
+					requests[-1] = (0, requests[-1][1], requests[-1][2] + 1, cp.Protocol.HASH_TEXT)
+				else:
+					requests.append((0, i, 1, cp.Protocol.HASH_TEXT))
+			return requests
+		return [(msg.level - 1, i * HashTree.FANOUT, HashTree.FANOUT, 0) for i in differs]
+
+	def repair(self, msg):
+		"""
+		Replace the chunks of our text that differ from the server's
+		with its chunks (a hash response with HASH_TEXT).
+		Returns the operations to make in the view to match.
+		"""
+		if msg.version != self.version or not self.can_verify() or len(msg.chunks) == 0:
+			return []
+		text = self.server.text
+		start, end = self.server.get_hash_tree().get_range(msg.first, len(msg.chunks))
+		chunks = u"".join(msg.chunks)
+		# The rest is ours, unless the server's text ends with these chunks.
+		rest = u"" if start + len(chunks) >= msg.length else text[end:]
+		self.server.text = text[:start] + chunks + rest
+		changes = diff_ops(self.view.text, self.server.text, self.nickname)
+		for op in changes:
+			self.apply_view(op, self.version)
+		return changes
+
+	def get_text(self):
+		"""
+		The text as the user sees it.
+		"""
+		return self.view.get_whole()
+
+	def insert(self, cursor, text):
+		"""
+		A local insertion (already made in the view, if there's a widget).
+		"""
+		op = {"id": cp.Protocol.RES_INSERT, "cursor": cursor,
+				"text": text, "name": self.nickname}
+		apply_op(self.view, op, self.version)
+		self.record({"id": cp.Protocol.RES_REMOVE, "cursor": cursor,
+				"length": len(text), "name": self.nickname})
+		# Keep on typing into the previous insertion, if we can.
+		if len(self.unsent) > 0:
+			last = self.unsent[-1]
+			if last["id"] == cp.Protocol.RES_INSERT and last["cursor"] + len(last["text"]) == cursor:
+				last["text"] += text
+				return
+		self.unsent.append(op)
+
+	def remove(self, cursor, length):
+		"""
+		A local removal.
+		"""
+		op = {"id": cp.Protocol.RES_REMOVE, "cursor": cursor,
+				"length": length, "name": self.nickname}
+		removed = self.view.get_range(cursor, cursor + length)
+		apply_op(self.view, op, self.version)
+		self.record({"id": cp.Protocol.RES_INSERT, "cursor": cursor,
+				"text": removed, "name": self.nickname})
+		self.unsent.append(op)
+
+	def record(self, inverse):
+		"""
+		Keep the operation undoing a local one. Typing on from the
+		latest edit, or removing along it, adds to that edit.
+		"""
+		if inverse.get("length") == 0 or inverse.get("text") == u"":
+			return
+		if self.replaying != None:
+			self.replaying.insert(0, inverse)
+			return
+		self.redo_stack = []
+		last = None
+		if len(self.undo_stack) > 0 and len(self.undo_stack[-1]) > 0:
+			last = self.undo_stack[-1][0]
+		if last != None and last["id"] == inverse["id"]:
+			cursor = inverse["cursor"]
+			if inverse["id"] == cp.Protocol.RES_REMOVE and op_end(last) == cursor:
+				last["length"] += inverse["length"]
+				return
+			if inverse["id"] == cp.Protocol.RES_INSERT and last["cursor"] == cursor:
+				last["text"] += inverse["text"]
+				return
+			if inverse["id"] == cp.Protocol.RES_INSERT and cursor + len(inverse["text"]) == last["cursor"]:
+				last["cursor"] = cursor
+				last["text"] = inverse["text"] + last["text"]
+				return
+		elif last != None and inverse["id"] == cp.Protocol.RES_REMOVE and last["cursor"] == inverse["cursor"]:
+			# Replacing what was just removed.
+			self.undo_stack[-1].insert(0, inverse)
+			return
+		self.undo_stack.append([inverse])
+		del self.undo_stack[:-Mirror.UNDO_MAX]
+
+	def undo(self):
+		"""
+		Undo our latest edit (that's still there), leaving
+		the others' operations made since alone.
+		Returns the operations to make in the view to match.
+		"""
+		return self.replay(self.undo_stack, self.redo_stack)
+
+	def redo(self):
+		"""
+		Redo our latest undone edit.
+		"""
+		return self.replay(self.redo_stack, self.undo_stack)
+
+	def replay(self, stack, other):
+		"""
+		Make the operations of the latest edit of a history (stack) as
+		local ones, keeping the ones undoing them in the (other) one.
+		"""
+		changes = []
+		while len(stack) > 0 and len(changes) == 0:
+			self.replaying = []
+			try:
+				for op in stack.pop():
+					op = dict(op)
+					self.note_utf16(op)
+					if op["id"] == cp.Protocol.RES_INSERT:
+						self.insert(op["cursor"], op["text"])
+					else:
+						self.remove(op["cursor"], op["length"])
+					changes.append(op)
+			finally:
+				if len(self.replaying) > 0:
+					other.append(self.replaying)
+				self.replaying = None
+		return changes
+
+	def has_unsent(self):
+		return len(self.unsent) > 0
+
+	def take_unsent(self):
+		"""
+		Get the operations to send, they become pending.
+		"""
+		ops = self.unsent
+		self.unsent = []
+		self.pending += [[op] for op in ops]
+		return ops
+
+	def apply_commit(self, commit):
+		"""
+		Apply a commit from the server. Which of its operations are
+		our own, the server tells in (own), as (first, count) spans
+		(nicknames aren't unique, they can't tell).
+		Returns the operations to make in the view (widget) to match.
+		"""
+		if self.is_loading():
+			# The text so far is incomplete, apply it later.
+			self.deferred.append(commit)
+			return []
+		changes = []
+		echoed = False
+		self.version = commit.version
+		own = set()
+		for first, count in getattr(commit, "own", None) or []:
+			own.update(range(first, first + count))
+		for i, op in enumerate(commit.sequence):
+			if op["id"] not in [cp.Protocol.RES_INSERT, cp.Protocol.RES_REMOVE]:
+				continue
+			if i in own and len(self.pending) > 0:
+				# Our own operation, already in the view.
+				apply_op(self.server, op, commit.version)
+				self.pending.pop(0)
+				echoed = True
+				continue
+			if self.is_partial():
+				# Past the text loaded so far?
+				op = self.clip(op)
+				if op == None:
+					continue
+			apply_op(self.server, op, commit.version)
+			# Rebase the remote operation over our local ones
+			# (and ours over the remote one).
+			remote = [op]
+			pending = []
+			for group in self.pending:
+				remote, group = transform_ops(remote, group)
+				pending.append(group)
+			self.pending = pending
+			remote, self.unsent = transform_ops(remote, self.unsent)
+			for r in remote:
+				self.apply_view(r, commit.version)
+			changes += remote
+
+		# Nothing of ours in flight anymore: the view should now
+		# match the server. If it doesn't (e.g. the server applied our
+		# operations over changes we hadn't seen), patch the view.
+		if echoed and len(self.pending) == 0 and len(self.unsent) == 0:
+			repair = diff_ops(self.view.text, self.server.text, self.nickname)
+			if len(repair) > 0:
+				for r in repair:
+					self.apply_view(r, commit.version)
+				changes += repair
+		return changes
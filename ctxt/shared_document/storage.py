@@ -0,0 +1,247 @@
+"""
+Document storage backends.
+
+Either a file per document (named by the base64 of the document
+name) in a single directory, or a single SQLite database, with
+a table of document snapshots and a table of the commits made
+since them (the op log). With SQLite, a commit only appends to the
+log, the whole text is written every SNAPSHOT_OPS commits, and the
+writes of many commits share a transaction.
+"""
+import base64
+import logging
+import os
+import sqlite3
+import time
+
+import ctxt.protocol as cp
+
+
+class Storage():
+	"""
+	Storage backend interface.
+	"""
+	def load(self, docname):
+		"""
+		Load a document: (version, text, log), where log is a list of
+		the commits (operation sequences) to apply to the text, if any.
+		A missing document is created (empty).
+		"""
+		raise NotImplementedError()
+
+	def store(self, doc, commit=None):
+		"""
+		Store a document, which has just been changed by (commit), if given
+		(with the commit encoded in its body).
+		"""
+		raise NotImplementedError()
+
+	def list_names(self):
+		"""
+		Names of the stored documents.
+		"""
+		raise NotImplementedError()
+
+	def get_meta(self, docname):
+		"""
+		Metadata of a stored document, without loading its text:
+		a dict with the "version", "size" and "modified" (Unix time),
+		or None if there's no such document.
+		"""
+		raise NotImplementedError()
+
+	def flush(self, force=False):
+		"""
+		Write out whatever is waiting to be written, if it's due (or forced).
+		"""
+		pass
+
+	def close(self):
+		self.flush(True)
+
+
+class FileStorage(Storage):
+	"""
+	A file per document, all in one directory. The files only hold
+	the text, so versions start from 0 again after a restart, and
+	the size is in UTF-8 bytes.
+	"""
+	def __init__(self, path):
+		self.path = path
+
+	def get_filepath(self, docname):
+		"""
+		Produce a base64 filepath from document name.
+		"""
+		fname = base64.urlsafe_b64encode(docname.encode("utf8"))
+		return os.path.join(self.path, fname)
+
+	def load(self, docname):
+		# Open the file for reading and create it if
+		# it doesn't exist yet.
+		with open(self.get_filepath(docname), "a+") as fi:
+			fi.seek(0)
+			text = fi.read().decode("utf8")
+		return (0, text, [])
+
+	def store(self, doc, commit=None):
+		with open(self.get_filepath(doc.get_name()), "wt") as f:
+			f.write(doc.get_whole().encode("utf8"))
+
+	def list_names(self):
+		names = []
+		for fname in os.listdir(self.path):
+			try:
+				names.append(base64.urlsafe_b64decode(fname).decode("utf8"))
+			except (TypeError, UnicodeDecodeError):
+				# Not a document.
+				pass
+		return names
+
+	def get_meta(self, docname):
+		try:
+			st = os.stat(self.get_filepath(docname))
+		except OSError:
+			return None
+		return {"version": 0, "size": st.st_size, "modified": st.st_mtime}
+
+
+class SQLiteStorage(Storage):
+	"""
+	All documents in a single SQLite database (in WAL mode).
+	"""
+	LOGNAME = "CT.Storage.SQLite"
+
+	# Commits logged before the whole text is written again.
+	SNAPSHOT_OPS = 256
+	# Longest time (s) to keep writes in a transaction, and most writes in one.
+	BATCH_INTERVAL = 0.1
+	BATCH_SIZE = 1024
+	# Prepared statements kept by the connection.
+	STATEMENT_CACHE = 64
+
+	SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS snapshots (
+			name TEXT PRIMARY KEY,
+			version INTEGER NOT NULL,
+			size INTEGER NOT NULL,
+			modified REAL NOT NULL,
+			snapshot_version INTEGER NOT NULL,
+			text TEXT NOT NULL)""",
+		"""CREATE TABLE IF NOT EXISTS oplog (
+			name TEXT NOT NULL,
+			version INTEGER NOT NULL,
+			body BLOB NOT NULL,
+			PRIMARY KEY (name, version))""",
+	]
+
+	def __init__(self, path):
+		self.log = logging.getLogger(SQLiteStorage.LOGNAME)
+		self.path = path
+		self.db = sqlite3.connect(path, cached_statements=SQLiteStorage.STATEMENT_CACHE)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		# With WAL, a crash can lose the latest transactions,
+		# but never corrupts the database.
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		for sql in SQLiteStorage.SCHEMA:
+			self.db.execute(sql)
+		self.db.commit()
+
+		# Writes in the open transaction, and when it began.
+		self.pending = 0
+		self.t_begin = None
+		# Commits logged since the last snapshot, by document name.
+		self.logged = {}
+
+	def load(self, docname):
+		row = self.db.execute(
+				"SELECT snapshot_version, text FROM snapshots WHERE name = ?",
+				(docname,)).fetchone()
+		if row == None:
+			self.db.execute(
+					"INSERT INTO snapshots (name, version, size, modified, snapshot_version, text) "
+					"VALUES (?, 0, 0, ?, 0, '')",
+					(docname, time.time()))
+			self.wrote()
+			return (0, u"", [])
+		version, text = row
+		log = []
+		for body, in self.db.execute(
+				"SELECT body FROM oplog WHERE name = ? AND version > ? ORDER BY version",
+				(docname, version)):
+			body = bytes(body)
+			d = cp.Protocol.unpack(cp.Protocol.res_commit_header(len(body)) + body)
+			log.append(d["sequence"])
+		self.logged[docname] = len(log)
+		return (version, text, log)
+
+	def store(self, doc, commit=None):
+		name = doc.get_name()
+		now = time.time()
+		logged = self.logged.get(name, 0)
+		if commit != None and logged < SQLiteStorage.SNAPSHOT_OPS:
+			# Only log the commit.
+			self.db.execute(
+					"INSERT OR REPLACE INTO oplog (name, version, body) VALUES (?, ?, ?)",
+					(name, commit.version, sqlite3.Binary(commit.body)))
+			self.db.execute(
+					"UPDATE snapshots SET version = ?, size = ?, modified = ? WHERE name = ?",
+					(doc.get_version(), len(doc.get_whole()), now, name))
+			self.logged[name] = logged + 1
+		else:
+			# Write the whole text, the log up to it isn't needed anymore.
+			version = doc.get_version()
+			text = doc.get_whole()
+			self.log.debug(u"Snapshot of \"{}\" ({:08X})".format(name, version))
+			self.db.execute(
+					"INSERT OR REPLACE INTO snapshots (name, version, size, modified, snapshot_version, text) "
+					"VALUES (?, ?, ?, ?, ?, ?)",
+					(name, version, len(text), now, version, text))
+			self.db.execute("DELETE FROM oplog WHERE name = ?", (name,))
+			self.logged[name] = 0
+		self.wrote()
+
+	def wrote(self):
+		"""
+		A write has been made in the current transaction.
+		"""
+		if self.t_begin == None:
+			self.t_begin = time.time()
+		self.pending += 1
+		self.flush()
+
+	def flush(self, force=False):
+		if self.pending == 0:
+			return
+		if force or self.pending >= SQLiteStorage.BATCH_SIZE or \
+				time.time() - self.t_begin >= SQLiteStorage.BATCH_INTERVAL:
+			self.db.commit()
+			self.pending = 0
+			self.t_begin = None
+
+	def list_names(self):
+		return [name for name, in self.db.execute("SELECT name FROM snapshots")]
+
+	def get_meta(self, docname):
+		row = self.db.execute(
+				"SELECT version, size, modified FROM snapshots WHERE name = ?",
+				(docname,)).fetchone()
+		if row == None:
+			return None
+		return {"version": row[0], "size": row[1], "modified": row[2]}
+
+	def close(self):
+		self.flush(True)
+		self.db.close()
+
+
+def open_storage(backend, path):
+	"""
+	Open a storage backend ("file" or "sqlite") at (path):
+	a directory for files, a database file for SQLite.
+	"""
+	if backend == "sqlite":
+		return SQLiteStorage(path)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	return FileStorage(path)
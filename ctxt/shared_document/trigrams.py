@@ -0,0 +1,71 @@
+"""
+Trigram counts of a text, for the search index.
+
+Kept up to date with every insertion and removal, by counting
+again only the trigrams around the change (the two characters
+before and after it included), never the whole text.
+"""
+import collections
+
+
+def count(text):
+	"""
+	Count the trigrams of a text.
+	"""
+	return collections.Counter(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+class Trigrams():
+	"""
+	Trigram counts of a document, and the trigrams whose counts
+	have changed since they were last taken.
+	"""
+	def __init__(self, text, rebuilt=True):
+		self.counts = count(text)
+		# Are the counts new altogether (rather than changed)?
+		self.rebuilt = rebuilt
+		self.changed = set()
+
+	def reset(self, text):
+		"""
+		Count a whole (new) text.
+		"""
+		self.counts = count(text)
+		self.rebuilt = True
+		self.changed = set()
+
+	def update(self, old, new, start, old_end, new_end):
+		"""
+		(old) has been changed to (new), by replacing what was between
+		(start) and (old_end) with what is between (start) and (new_end).
+		"""
+		counts = self.counts
+		start = max(0, start - 2)
+		for i in xrange(start, min(old_end, len(old) - 2)):
+			trigram = old[i:i + 3]
+			n = counts[trigram] - 1
+			if n > 0:
+				counts[trigram] = n
+			else:
+				del counts[trigram]
+			self.changed.add(trigram)
+		for i in xrange(start, min(new_end, len(new) - 2)):
+			trigram = new[i:i + 3]
+			counts[trigram] += 1
+			self.changed.add(trigram)
+
+	def contains(self, trigram):
+		return trigram in self.counts
+
+	def take_changed(self):
+		"""
+		Get the trigrams that may have appeared or vanished
+		(all of them, if the counts have been rebuilt).
+		"""
+		if self.rebuilt:
+			self.rebuilt = False
+			self.changed = set()
+			return (True, set(self.counts))
+		changed = self.changed
+		self.changed = set()
+		return (False, changed)
@@ -28,6 +28,8 @@ setup(
         'console_scripts': [
             'ctxt_server=ctxt.server.server:main',
             'ctxt_client=ctxt.client.client:main',
+            'ctxt_bench_load=ctxt.bench.load:main',
+            'ctxt_bench_micro=ctxt.bench.micro:main',
         ],
     },
 )
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""
+Tests of the client's outbound buffer (the socket is non-blocking).
+"""
+import socket
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.client.client import Client
+
+
+class SendTest(unittest.TestCase):
+	def setUp(self):
+		self.client = Client()
+		self.client.socket, self.server = socket.socketpair()
+		self.client.socket.setblocking(0)
+		self.client.online = True
+
+	def tearDown(self):
+		self.client.socket.close()
+		self.server.close()
+
+	def receive(self):
+		"""
+		Read what the client has written, as frames.
+		"""
+		self.server.setblocking(0)
+		data = bytearray()
+		while True:
+			try:
+				chunk = self.server.recv(65536)
+			except socket.error:
+				break
+			if len(chunk) == 0:
+				break
+			data += chunk
+		frames = []
+		while len(data) >= cp.Protocol.MIN_REQ_LEN:
+			f_len = cp.Protocol.MIN_REQ_LEN + cp.Protocol.get_len(data[:cp.Protocol.MIN_REQ_LEN])
+			self.assertTrue(len(data) >= f_len)
+			frames.append(cp.Protocol.unpack(bytes(data[:f_len])))
+			del data[:f_len]
+		self.assertEqual(len(data), 0)
+		return frames
+
+	def test_full_socket(self):
+		# Send until the socket doesn't take any more.
+		text = u"x" * 10000
+		while not self.client.wants_write():
+			self.client.search(text)
+		count = self.client.tx_seq
+		self.client.search(text)
+		self.client.search(text)
+		self.assertEqual(self.client.tx_seq, count + 2)
+		frames = []
+		while self.client.flush_tx():
+			frames += self.receive()
+		frames += self.receive()
+		# Every request whole, none lost.
+		self.assertEqual(len(frames), count + 2)
+		for d in frames:
+			self.assertEqual(d["id"], cp.Protocol.REQ_SEARCH)
+			self.assertEqual(d["query"], text)
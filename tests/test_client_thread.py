@@ -0,0 +1,39 @@
+"""
+Tests of the requests' acknowledgements by the client threads.
+"""
+import Queue as queue
+import os
+import socket
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.server.client_thread import ClientThread
+
+
+class AckTest(unittest.TestCase):
+	def setUp(self):
+		self.socket, self.other = socket.socketpair()
+		self.thread = ClientThread(1, self.socket, ("127.0.0.1", 0), queue.Queue())
+
+	def tearDown(self):
+		for fd in [self.thread.wake_r, self.thread.wake_w]:
+			os.close(fd)
+		self.socket.close()
+		self.other.close()
+
+	def join(self, flags):
+		self.thread.handle_request(cp.Protocol.unpack(cp.Protocol.req_join("A", "d", flags)))
+
+	def test_stats_acked(self):
+		self.join(0)
+		self.thread.handle_request(cp.Protocol.unpack(cp.Protocol.req_stats()))
+		self.assertEqual(list(self.thread.tx_interactive)[-1], cp.Protocol.res_ok(cp.Protocol.REQ_STATS))
+		# Answered, but not forwarded to the server.
+		self.assertEqual(self.thread.queue_cs.qsize(), 1)
+
+	def test_stats_acked_cumulatively(self):
+		self.join(cp.Protocol.JOIN_CUMULATIVE_ACKS)
+		self.thread.handle_request(cp.Protocol.unpack(cp.Protocol.req_stats()))
+		# Due a little later (if no commit takes it along).
+		self.assertNotEqual(self.thread.ack_due, None)
+		self.assertEqual(self.thread.take_ack(), 2)
@@ -0,0 +1,102 @@
+"""
+Tests of the shared Document: operation validation and queued commits.
+"""
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.mirror import Mirror
+
+
+def insert(cursor, text, name="A"):
+	return {"id": cp.Protocol.RES_INSERT, "cursor": cursor, "text": text, "name": name}
+
+def remove(cursor, length, name="A"):
+	return {"id": cp.Protocol.RES_REMOVE, "cursor": cursor, "length": length, "name": name}
+
+def commit(version, sequence, uid=None):
+	return cp.Message({"id": cp.Protocol.REQ_COMMIT, "version": version, "sequence": sequence,
+		"uid": uid})
+
+def echo(merged, uid=None):
+	"""
+	The commit as the client (uid) gets it back.
+	"""
+	return cp.Message({"id": cp.Protocol.RES_COMMIT, "version": merged.version,
+		"sequence": [dict(op) for op in merged.sequence], "own": merged.own.get(uid)})
+
+
+class ValidateOpsTest(unittest.TestCase):
+	def test_valid(self):
+		sequence = [insert(0, u"abc"), remove(13, 1), insert(13, u"x")]
+		checked, length, valid = Document.validate_ops(sequence, 11)
+		self.assertTrue(valid)
+		self.assertEqual(checked, sequence)
+		self.assertEqual(length, 14)
+
+	def test_rejected(self):
+		for op in [insert(12, u"x"), insert(-1, u"x"), remove(10, 2),
+				remove(3, -2), {"id": cp.Protocol.RES_TEXT, "cursor": 0}]:
+			checked, length, valid = Document.validate_ops([op], 11)
+			self.assertEqual(checked, None)
+			self.assertFalse(valid)
+
+	def test_clamped(self):
+		checked, length, valid = Document.validate_ops(
+				[insert(20, u"x"), remove(10, 5)], 11, clamp=True)
+		self.assertFalse(valid)
+		self.assertEqual(checked, [insert(11, u"x"), remove(10, 2)])
+		self.assertEqual(length, 10)
+
+	def test_clamped_empty_kept(self):
+		# An operation cut to nothing still comes back (as a no-op).
+		checked, length, valid = Document.validate_ops([remove(20, 3)], 11, clamp=True)
+		self.assertFalse(valid)
+		self.assertEqual(checked, [remove(11, 0)])
+		self.assertEqual(length, 11)
+
+	def test_queued_length(self):
+		doc = Document(u"d", persistent=False)
+		doc.text = u"hello"
+		self.assertTrue(doc.queue_commit(commit(0, [insert(5, u" world")])))
+		# Valid against the text as it will be, not as it is.
+		self.assertTrue(doc.queue_commit(commit(0, [remove(8, 3)])))
+		self.assertFalse(doc.queue_commit(commit(0, [remove(8, 3)])))
+		doc.update()
+		self.assertEqual(doc.text, u"hello wo")
+		self.assertEqual(doc.version, 1)
+
+
+class ClampedCommitTest(unittest.TestCase):
+	"""
+	Commits cut to the text must not leave the author's mirror
+	waiting for operations that never come back.
+	"""
+	def test_emptied_op_echoed(self):
+		doc = Document(u"d", persistent=False)
+		doc.text = u"hello world"
+		a = Mirror(u"d", "A")
+		b = Mirror(u"d", "B")
+		for m in [a, b]:
+			m.set_text(0, doc.text)
+		b.remove(0, 11)
+		commit_b = commit(b.version, b.take_unsent(), 2)
+		a.remove(6, 5)
+		commit_a = commit(a.version, a.take_unsent(), 1)
+
+		self.assertTrue(doc.queue_commit(commit_b, True))
+		merged = doc.update()
+		for uid, m in [(1, a), (2, b)]:
+			m.apply_commit(echo(merged, uid))
+		# Cut to nothing, as the text is gone.
+		self.assertFalse(doc.queue_commit(commit_a, True))
+		merged = doc.update()
+		self.assertNotEqual(merged, None)
+		for uid, m in [(1, a), (2, b)]:
+			m.apply_commit(echo(merged, uid))
+
+		for m in [a, b]:
+			self.assertEqual(m.pending, [])
+			self.assertTrue(m.can_verify())
+			self.assertEqual(m.get_text(), doc.text)
+			self.assertEqual(m.version, doc.version)
@@ -0,0 +1,50 @@
+"""
+Tests of the group commit timing.
+"""
+import unittest
+
+from ctxt.server.group_commit import GroupCommit
+
+
+class GroupCommitTest(unittest.TestCase):
+	def test_quiet(self):
+		# An occasional commit is applied right away.
+		group = GroupCommit(0.01)
+		self.assertFalse(group.is_pending())
+		group.add(0.0)
+		self.assertTrue(group.is_due(0.0))
+		group.flushed()
+		group.add(1.0)
+		self.assertTrue(group.is_due(1.0))
+		group.flushed()
+		self.assertFalse(group.is_due(1.0))
+
+	def test_busy(self):
+		# Commits arriving within the window are collected.
+		group = GroupCommit(0.01)
+		now = 0.0
+		for _ in range(10):
+			group.add(now)
+			group.flushed()
+			now += 0.002
+		group.add(now)
+		self.assertTrue(group.is_pending())
+		self.assertFalse(group.is_due(now + 0.005))
+		group.add(now + 0.005)
+		# The window runs from the first commit queued.
+		self.assertTrue(group.is_due(now + 0.01))
+
+	def test_slowing_down(self):
+		# Once the commits slow down, waiting stops.
+		group = GroupCommit(0.01)
+		now = 0.0
+		for _ in range(10):
+			group.add(now)
+			group.flushed()
+			now += 0.002
+		self.assertEqual(group.get_window(), 0.01)
+		for _ in range(20):
+			group.add(now)
+			group.flushed()
+			now += 0.1
+		self.assertEqual(group.get_window(), 0.0)
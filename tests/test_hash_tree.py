@@ -0,0 +1,109 @@
+"""
+Tests of the hash tree: kept up to date with the edits as if built
+again, and walked down to repair a mirror's text.
+"""
+import random
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.hash_tree import HashTree
+from ctxt.shared_document.mirror import Mirror
+
+
+def hashes(doc, level, first, count, flags=0):
+	"""
+	A hash response, as the server sends it.
+	"""
+	tree = doc.get_hash_tree()
+	if level == cp.Protocol.HASH_ROOT:
+		level = tree.depth() - 1
+	msg = cp.Message({"id": cp.Protocol.RES_HASH, "version": doc.get_version(),
+		"length": len(doc.get_whole()), "depth": tree.depth(), "level": level,
+		"first": first, "flags": flags, "hashes": tree.get(level, first, count), "chunks": []})
+	if flags & cp.Protocol.HASH_TEXT:
+		msg.chunks = tree.get_chunks(doc.get_whole(), first, len(msg.hashes))
+	return msg
+
+
+class HashTreeTest(unittest.TestCase):
+	ALPHABET = u"ab \n\u00e4\u20ac"
+
+	def setUp(self):
+		self.sizes = (HashTree.CHUNK_SIZE, HashTree.CHUNK_MAX, HashTree.FANOUT)
+		# Small chunks and nodes, to have many of them.
+		HashTree.CHUNK_SIZE, HashTree.CHUNK_MAX, HashTree.FANOUT = 16, 64, 4
+		self.rng = random.Random(7)
+
+	def tearDown(self):
+		HashTree.CHUNK_SIZE, HashTree.CHUNK_MAX, HashTree.FANOUT = self.sizes
+
+	def random_text(self, n):
+		return u"".join(self.rng.choice(HashTreeTest.ALPHABET) for _ in range(n))
+
+	def check(self, doc):
+		tree = doc.get_hash_tree()
+		fresh = HashTree()
+		fresh.update(doc.text)
+		self.assertEqual(tree.lengths, fresh.lengths)
+		self.assertEqual(tree.levels, fresh.levels)
+
+	def test_split(self):
+		for n in [0, 1, 50, 500]:
+			text = self.random_text(n) + u"x" * 200
+			lengths = list(HashTree.split(text, 0))
+			self.assertEqual(sum(lengths), len(text))
+			self.assertTrue(all(0 < n <= HashTree.CHUNK_MAX for n in lengths))
+
+	def test_edits(self):
+		for _ in range(50):
+			doc = Document(u"d", persistent=False)
+			doc.text = self.random_text(self.rng.randint(0, 300))
+			doc.get_hash_tree()
+			for i in range(60):
+				if self.rng.random() < 0.5 or len(doc.text) == 0:
+					doc.insert(0, self.rng.randint(0, len(doc.text)),
+						self.random_text(self.rng.choice([1, 5, 40, 200])))
+				else:
+					doc.remove(0, self.rng.randint(0, len(doc.text) - 1),
+						self.rng.choice([1, 3, 20, 150]))
+				if i % 4 == 0:
+					self.check(doc)
+			self.check(doc)
+
+	def test_local(self):
+		# An edit only changes the hashes around it (and their
+		# parents), the chunks after it are only shifted.
+		doc = Document(u"d", persistent=False)
+		doc.text = self.random_text(20000)
+		before = list(doc.get_hash_tree().levels[0])
+		doc.insert(0, 100, u"xyz")
+		after = doc.get_hash_tree().levels[0]
+		changed = [i for i in range(min(len(before), len(after))) if before[i] != after[i]]
+		self.assertTrue(len(changed) <= 2)
+		self.check(doc)
+
+	def repair(self, doc, mirror):
+		"""
+		Walk down the trees from the root, as the client does.
+		"""
+		requests = [(cp.Protocol.HASH_ROOT, 0, 1, 0)]
+		while len(requests) > 0:
+			level, first, count, flags = requests.pop(0)
+			msg = hashes(doc, level, first, count, flags)
+			if flags & cp.Protocol.HASH_TEXT:
+				mirror.repair(msg)
+			else:
+				requests += mirror.verify(msg)
+
+	def test_repair(self):
+		base = self.random_text(3000)
+		for text in [base[:1000] + u"changed" + base[1200:], base[:2000],
+				base + u"\nmore\n" * 10, base[500:], u""]:
+			doc = Document(u"d", persistent=False)
+			doc.text = base
+			mirror = Mirror(u"d", "A")
+			mirror.set_text(0, text)
+			self.repair(doc, mirror)
+			self.assertEqual(mirror.get_text(), base)
+			self.assertEqual(mirror.server.get_hash_tree().get_root(), doc.get_hash_tree().get_root())
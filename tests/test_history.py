@@ -0,0 +1,74 @@
+"""
+Tests of the version history: checkpoints, and going on from
+where the history left off.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.history import History
+
+
+class HistoryTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, "test.history")
+		self.history = History(self.path)
+		self.doc = Document(u"d", persistent=False)
+		self.history.open_doc(self.doc)
+		# Count the checksums.
+		self.checksums = 0
+		get_checksum = self.history.get_checksum
+		def counted(doc):
+			self.checksums += 1
+			return get_checksum(doc)
+		self.history.get_checksum = counted
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def edit(self, count):
+		for i in range(count):
+			self.doc.queue_commit(cp.Message({"id": cp.Protocol.REQ_COMMIT, "version": 0,
+				"sequence": [{"id": cp.Protocol.RES_INSERT, "cursor": 0, "text": u"x",
+				"name": u"A"}]}))
+			self.history.record(self.doc, self.doc.update())
+			self.history.flush(True)
+
+	def reopen(self):
+		"""
+		The same text, at the storage's version (files keep none).
+		"""
+		doc = Document(u"d", persistent=False)
+		doc.text = self.doc.text
+		self.history = History(self.path)
+		self.history.open_doc(doc)
+		return doc
+
+	def test_checksummed_rarely(self):
+		self.edit(History.CHECKPOINT_OPS * 2 + 10)
+		# At the checkpoints only.
+		self.assertEqual(self.checksums, 2)
+		self.history.close()
+		self.assertEqual(self.checksums, 3)
+		doc = self.reopen()
+		self.assertEqual(doc.get_version(), self.doc.get_version())
+
+	def test_not_closed(self):
+		self.edit(History.CHECKPOINT_OPS + 10)
+		self.history.db.close()
+		doc = self.reopen()
+		self.assertEqual(doc.get_version(), self.doc.get_version())
+		self.assertEqual(self.history.get_text(u"d", doc.get_version()), self.doc.text)
+
+	def test_changed_outside(self):
+		self.edit(10)
+		self.history.db.close()
+		self.doc.text += u"y"
+		doc = self.reopen()
+		# A new version, with a checkpoint.
+		self.assertEqual(doc.get_version(), self.doc.get_version() + 1)
+		self.assertEqual(self.history.get_text(u"d", doc.get_version()), doc.text)
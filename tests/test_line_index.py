@@ -0,0 +1,82 @@
+"""
+Tests of the line index, against measures of the whole text.
+"""
+import random
+import unittest
+
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.line_index import Fenwick, LineIndex
+
+
+class FenwickTest(unittest.TestCase):
+	def test_prefix_and_search(self):
+		values = [3, 0, 5, 1, 4]
+		tree = Fenwick(values)
+		for i in range(len(values) + 1):
+			self.assertEqual(tree.prefix(i), sum(values[:i]))
+		tree.add(1, 2)
+		values[1] += 2
+		self.assertEqual(tree.total, sum(values))
+		for value in range(tree.total + 1):
+			item, rest = tree.search(value)
+			self.assertEqual(item, next((i for i in range(len(values))
+				if sum(values[:i + 1]) > value), len(values)))
+			self.assertEqual(rest, value - sum(values[:item]))
+
+
+class LineIndexTest(unittest.TestCase):
+	# Line ends, and characters of 1 to 4 UTF-8 bytes (the last one
+	# taking two UTF-16 units).
+	ALPHABET = u"ab\n\u00e4\u20ac\U0001F600"
+
+	def setUp(self):
+		self.block = LineIndex.BLOCK
+		# Small blocks, to have many of them.
+		LineIndex.BLOCK = 4
+		self.rng = random.Random(5)
+
+	def tearDown(self):
+		LineIndex.BLOCK = self.block
+
+	def random_text(self, n):
+		return u"".join(self.rng.choice(LineIndexTest.ALPHABET) for _ in range(n))
+
+	def check(self, doc):
+		text = doc.text
+		starts = [0] + [i + 1 for i, c in enumerate(text) if c == u"\n"]
+		self.assertEqual(doc.get_line_count(), len(starts))
+		for line, start in enumerate(starts):
+			self.assertEqual(doc.line_to_offset(line), start)
+		self.assertEqual(doc.line_to_offset(len(starts)), len(text))
+		for offset in range(len(text) + 1):
+			self.assertEqual(doc.offset_to_line(offset), text[:offset].count(u"\n"))
+			utf8 = len(text[:offset].encode("utf8"))
+			utf16 = len(text[:offset].encode("utf-16-le")) // 2
+			self.assertEqual(doc.offset_to_utf8(offset), utf8)
+			self.assertEqual(doc.offset_to_utf16(offset), utf16)
+			self.assertEqual(doc.utf8_to_offset(utf8), offset)
+			self.assertEqual(doc.utf16_to_offset(utf16), offset)
+
+	def test_build(self):
+		for text in [u"", u"\n", u"abc", u"a\nb\n", u"\U0001F600\n\u00e4",
+				self.random_text(200)]:
+			doc = Document(u"d", persistent=False)
+			doc.text = text
+			self.check(doc)
+
+	def test_edits(self):
+		for trial in range(10):
+			doc = Document(u"d", persistent=False)
+			doc.text = self.random_text(self.rng.randint(0, 40))
+			doc.get_index()
+			for i in range(200):
+				if self.rng.random() < 0.55 or len(doc.text) < 3:
+					doc.insert(0, self.rng.randint(0, len(doc.text)),
+						self.random_text(self.rng.randint(1, 12)))
+				else:
+					doc.remove(0, self.rng.randint(0, len(doc.text) - 1), self.rng.randint(1, 30))
+				# Kept up to date, rather than built again.
+				self.assertTrue(doc.index_text is doc.text)
+				if i % 20 == 0:
+					self.check(doc)
+			self.check(doc)
@@ -0,0 +1,238 @@
+"""
+Tests of the client mirror: operations transformed against each
+other, mirrors converging, and undoing our own edits only.
+"""
+import random
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.history import apply_ops
+from ctxt.shared_document.mirror import Mirror, transform, transform_ops
+
+
+class Session():
+	"""
+	A server document and the mirrors of its clients, the
+	commits going through the server as they would.
+	"""
+	def __init__(self, text, names):
+		self.doc = Document(u"d", persistent=False)
+		self.doc.text = text
+		self.mirrors = [Mirror(u"d", name) for name in names]
+		for m in self.mirrors:
+			m.set_text(0, text)
+		# Commits on the way to the server, and back to the clients
+		# (how many of them every mirror has got).
+		self.sent = []
+		self.merged = []
+		self.delivered = [0] * len(self.mirrors)
+
+	def send(self, m):
+		if m.has_unsent():
+			self.sent.append(cp.Message({"id": cp.Protocol.REQ_COMMIT,
+				"uid": self.mirrors.index(m), "version": m.version, "sequence": m.take_unsent()}))
+
+	def commit(self):
+		for commit in self.sent:
+			self.doc.queue_commit(commit, True)
+			merged = self.doc.update()
+			if merged != None:
+				self.merged.append(merged)
+		self.sent = []
+
+	def deliver(self, m=None):
+		"""
+		The merged commits arrive (at mirror (m), or at all of them).
+		"""
+		for i, mirror in enumerate(self.mirrors):
+			if m != None and mirror is not m:
+				continue
+			for merged in self.merged[self.delivered[i]:]:
+				mirror.apply_commit(self.echo(merged, i))
+			self.delivered[i] = len(self.merged)
+
+	def echo(self, merged, i):
+		"""
+		A merged commit over the wire, as the client thread sends it to mirror (i).
+		"""
+		header = cp.Protocol.res_commit_header(len(merged.body), None, merged.own.get(i))
+		return cp.Message(cp.Protocol.unpack(header + merged.body))
+
+	def sync(self):
+		for m in self.mirrors:
+			self.send(m)
+		self.commit()
+		self.deliver()
+
+
+def random_ops(rng, length, count):
+	ops = []
+	for _ in range(count):
+		if rng.random() < 0.5 or length == 0:
+			text = rng.choice([u"x", u"yz", u"\n\u00e4\n"])
+			ops.append({"id": cp.Protocol.RES_INSERT, "cursor": rng.randint(0, length), "text": text})
+			length += len(text)
+		else:
+			cursor = rng.randint(0, length - 1)
+			n = rng.randint(1, min(5, length - cursor))
+			ops.append({"id": cp.Protocol.RES_REMOVE, "cursor": cursor, "length": n})
+			length -= n
+	return ops
+
+
+class TransformTest(unittest.TestCase):
+	def test_insert_into_removal(self):
+		# The text inserted into a removed range is kept.
+		insert = {"id": cp.Protocol.RES_INSERT, "cursor": 3, "text": u"X"}
+		remove = {"id": cp.Protocol.RES_REMOVE, "cursor": 1, "length": 4}
+		self.assertEqual(apply_ops(u"abcdef", [remove] + transform(insert, remove)), u"aXf")
+		self.assertEqual(apply_ops(u"abcdef", [insert] + transform(remove, insert)), u"aXf")
+
+	def test_convergence(self):
+		# Either sequence first, the other one transformed,
+		# makes the same text.
+		rng = random.Random(1)
+		for _ in range(2000):
+			text = u"".join(rng.choice(u"abcdef") for _ in range(rng.randint(0, 12)))
+			ops = random_ops(rng, len(text), rng.randint(1, 3))
+			others = random_ops(rng, len(text), rng.randint(1, 3))
+			ops_first = rng.random() < 0.5
+			ops_after, others_after = transform_ops(ops, others, ops_first)
+			self.assertEqual(apply_ops(apply_ops(text, others), ops_after),
+				apply_ops(apply_ops(text, ops), others_after))
+
+
+class ConvergenceTest(unittest.TestCase):
+	def test_same_names(self):
+		# Nicknames aren't unique, the server tells whose operations are whose.
+		s = Session(u"hello", ["A", "A"])
+		a, b = s.mirrors
+		a.insert(0, u"<")
+		s.send(a)
+		b.insert(5, u">")
+		s.send(b)
+		s.commit()
+		# The other's operation first: not taken for ours.
+		self.assertEqual(b.apply_commit(s.echo(s.merged[0], 1)), [s.merged[0].sequence[0]])
+		self.assertEqual(len(b.pending), 1)
+		self.assertEqual(b.get_text(), u"<hello>")
+		s.delivered[1] = 1
+		s.deliver()
+		for m in s.mirrors:
+			self.assertEqual(m.get_text(), s.doc.text)
+			self.assertEqual(m.pending, [])
+
+	def test_random(self):
+		# Edits made concurrently, the commits arriving late.
+		rng = random.Random(5)
+		for _ in range(100):
+			s = Session(u"the quick brown fox", ["A", "B", "A"])
+			for _ in range(40):
+				m = rng.choice(s.mirrors)
+				r = rng.random()
+				if r < 0.6:
+					for op in random_ops(rng, len(m.get_text()), 1):
+						if op["id"] == cp.Protocol.RES_INSERT:
+							m.insert(op["cursor"], op["text"])
+						else:
+							m.remove(op["cursor"], op["length"])
+				elif r < 0.8:
+					s.send(m)
+				elif r < 0.9:
+					s.commit()
+				else:
+					s.deliver(m)
+			s.sync()
+			for m in s.mirrors:
+				self.assertEqual(m.get_text(), s.doc.text)
+				self.assertEqual(m.version, s.doc.version)
+				self.assertTrue(m.can_verify())
+
+
+class UndoTest(unittest.TestCase):
+	def test_local(self):
+		s = Session(u"", ["A"])
+		a = s.mirrors[0]
+		for i, c in enumerate(u"hello"):
+			a.insert(i, c)
+		a.remove(4, 1)
+		a.remove(3, 1)
+		self.assertEqual(a.get_text(), u"hel")
+		a.undo()
+		self.assertEqual(a.get_text(), u"hello")
+		a.undo()
+		self.assertEqual(a.get_text(), u"")
+		self.assertEqual(a.undo(), [])
+		a.redo()
+		self.assertEqual(a.get_text(), u"hello")
+		a.redo()
+		self.assertEqual(a.get_text(), u"hel")
+		s.sync()
+		self.assertEqual(s.doc.text, u"hel")
+
+	def test_replace(self):
+		s = Session(u"hello world", ["A"])
+		a = s.mirrors[0]
+		a.remove(6, 5)
+		a.insert(6, u"there")
+		self.assertEqual(a.get_text(), u"hello there")
+		a.undo()
+		self.assertEqual(a.get_text(), u"hello world")
+
+	def test_others_kept(self):
+		s = Session(u"hello world", ["A", "B"])
+		a, b = s.mirrors
+		a.insert(5, u" there")
+		s.sync()
+		b.insert(0, u"X")
+		b.remove(13, 5)
+		s.sync()
+		self.assertEqual(a.get_text(), u"Xhello there ")
+		a.undo()
+		self.assertEqual(a.get_text(), u"Xhello ")
+		s.sync()
+		self.assertEqual(b.get_text(), u"Xhello ")
+		a.redo()
+		s.sync()
+		self.assertEqual(b.get_text(), u"Xhello there ")
+
+	def test_removal_undone_around_others(self):
+		s = Session(u"hello world", ["A", "B"])
+		a, b = s.mirrors
+		a.remove(0, 6)
+		b.insert(11, u"!")
+		s.sync()
+		self.assertEqual(a.get_text(), u"world!")
+		a.undo()
+		s.sync()
+		for m in [a, b]:
+			self.assertEqual(m.get_text(), u"hello world!")
+
+	def test_random(self):
+		# Whatever is undone, everyone ends up with the same text.
+		rng = random.Random(11)
+		for _ in range(100):
+			s = Session(u"the quick brown fox", ["A", "B", "C"])
+			for _ in range(30):
+				m = rng.choice(s.mirrors)
+				text = m.get_text()
+				r = rng.random()
+				if r < 0.3:
+					m.insert(rng.randint(0, len(text)), rng.choice([u"x", u"yz", u"\n"]))
+				elif r < 0.5 and len(text) > 0:
+					cursor = rng.randint(0, len(text) - 1)
+					m.remove(cursor, rng.randint(1, min(3, len(text) - cursor)))
+				elif r < 0.7:
+					m.undo()
+				elif r < 0.8:
+					m.redo()
+				elif r < 0.9:
+					s.send(m)
+				else:
+					s.commit()
+					s.deliver()
+			s.sync()
+			s.sync()
+			for m in s.mirrors:
+				self.assertEqual(m.get_text(), s.doc.text)
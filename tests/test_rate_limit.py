@@ -0,0 +1,63 @@
+"""
+Tests of the token bucket rate limits.
+"""
+import unittest
+
+from ctxt.server.rate_limit import RateLimit, TokenBucket
+
+
+class Counter():
+	def __init__(self):
+		self.value = 0
+
+	def inc(self):
+		self.value += 1
+
+
+class TokenBucketTest(unittest.TestCase):
+	def test_debt(self):
+		bucket = TokenBucket(10)
+		bucket.refill(0.0)
+		bucket.take(5, 0.0)
+		self.assertEqual(bucket.wait(0.0), 0.0)
+		# A large request goes through, and is paid off later.
+		bucket.take(25, 0.0)
+		self.assertAlmostEqual(bucket.wait(0.0), 2.0)
+		self.assertAlmostEqual(bucket.wait(1.5), 0.5)
+		self.assertEqual(bucket.wait(2.0), 0.0)
+
+	def test_burst(self):
+		# Idle time doesn't add up past a second's worth of tokens.
+		bucket = TokenBucket(10)
+		bucket.refill(0.0)
+		bucket.take(10, 100.0)
+		bucket.take(1, 100.0)
+		self.assertAlmostEqual(bucket.wait(100.0), 0.1)
+
+	def test_unlimited(self):
+		bucket = TokenBucket(0)
+		bucket.take(1000000, 0.0)
+		self.assertEqual(bucket.wait(0.0), 0.0)
+
+
+class RateLimitTest(unittest.TestCase):
+	def test_both_limits(self):
+		limit = RateLimit(100, 1000)
+		limit.take(1, 3000, now=0.0)
+		# The bytes hold it back, not the operations.
+		self.assertAlmostEqual(limit.wait(0.0), 2.0)
+		limit = RateLimit(100, 0)
+		limit.take(300, 10 ** 9, now=0.0)
+		self.assertAlmostEqual(limit.wait(0.0), 2.0)
+
+	def test_counted_once(self):
+		counter = Counter()
+		limit = RateLimit(10, 0, counter)
+		limit.take(30, 0, now=0.0)
+		for now in [0.0, 0.5, 1.0]:
+			self.assertTrue(limit.wait(now) > 0)
+		self.assertEqual(counter.value, 1)
+		self.assertEqual(limit.wait(3.0), 0.0)
+		limit.take(30, 0, now=3.0)
+		limit.wait(3.0)
+		self.assertEqual(counter.value, 2)
@@ -0,0 +1,67 @@
+"""
+Tests of the search index: kept up to date with the edits, and
+only indexed again when it doesn't match the text.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from ctxt.server.search import SearchIndex
+from ctxt.shared_document.document import Document
+
+
+class SearchIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, "test.search")
+		self.doc = self.open(u"hello world")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def open(self, text):
+		doc = Document(u"d", persistent=False)
+		doc.text = text
+		self.index = SearchIndex(self.path)
+		self.checksums = 0
+		get_checksum = self.index.get_checksum
+		def counted(doc):
+			self.checksums += 1
+			return get_checksum(doc)
+		self.index.get_checksum = counted
+		self.index.open_doc(doc)
+		return doc
+
+	def edit(self, count):
+		for i in range(count):
+			self.doc.insert(self.doc.version + 1, 0, u"x")
+			self.doc.version += 1
+			self.index.update(self.doc)
+			self.index.flush(True)
+
+	def test_checksummed_rarely(self):
+		self.edit(100)
+		self.assertEqual(self.checksums, 1)
+		self.assertEqual(self.index.candidates(u"xxhe"), [u"d"])
+		self.index.close()
+		self.assertEqual(self.checksums, 2)
+		doc = self.open(self.doc.text)
+		# Not indexed again.
+		self.assertEqual(doc.trigrams, None)
+		self.assertEqual(self.index.candidates(u"xxhe"), [u"d"])
+
+	def test_not_closed(self):
+		self.edit(10)
+		self.index.db.close()
+		doc = self.open(self.doc.text)
+		self.assertNotEqual(doc.trigrams, None)
+		self.assertEqual(self.index.candidates(u"xxhe"), [u"d"])
+
+	def test_changed_outside(self):
+		self.edit(10)
+		self.index.close()
+		doc = self.open(u"goodbye")
+		self.assertNotEqual(doc.trigrams, None)
+		self.assertEqual(self.index.candidates(u"hello"), [])
+		self.assertEqual(self.index.candidates(u"good"), [u"d"])
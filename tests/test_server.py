@@ -0,0 +1,75 @@
+"""
+Tests of the server's handling of commits (without any clients).
+"""
+import time
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.server.catalog import Catalog
+from ctxt.server.server import Server
+from ctxt.shared_document.document import Document
+
+
+def commit(i, name=u"A", nickname=u"A"):
+	return cp.Message({"id": cp.Protocol.REQ_COMMIT, "doc": u"d", "name": name, "uid": 1,
+		"version": 0, "t_recv": time.time(), "size": 20, "sequence": [
+		{"id": cp.Protocol.RES_INSERT, "cursor": 0, "text": u"x", "name": nickname}]})
+
+
+class DocLimitTest(unittest.TestCase):
+	def setUp(self):
+		self.server = Server()
+		self.server.doc_limits = (10, 0)
+		self.doc = Document(u"d", persistent=False)
+		self.server.documents[u"d"] = self.doc
+
+	def test_flood_drains(self):
+		for i in range(100):
+			self.server.handle(commit(i))
+		# Nothing is charged until the commits are applied.
+		self.assertFalse(self.server.is_limited(u"d", time.time()))
+		self.server.update_doc(self.doc)
+		# A second's worth (and one in debt), the rest waits.
+		self.assertEqual(len(self.doc.text), 11)
+		self.assertEqual(len(self.doc.active_commits), 89)
+		self.assertTrue(self.server.is_limited(u"d", time.time()))
+		self.assertTrue(self.server.groups[u"d"].is_pending())
+		# Another second later, the next ones.
+		self.server.limits[u"d"].ops.t_refill -= 1.1
+		self.assertFalse(self.server.is_limited(u"d", time.time()))
+		self.server.update_doc(self.doc)
+		self.assertTrue(21 <= len(self.doc.text) <= 23)
+		self.server.update_doc(self.doc, True)
+		self.assertEqual(len(self.doc.text), 100)
+		self.assertFalse(self.doc.has_commits())
+		self.assertFalse(self.server.groups[u"d"].is_pending())
+
+	def test_text_request_charged(self):
+		for i in range(30):
+			self.server.handle(commit(i))
+		self.server.handle(cp.Message({"id": cp.Protocol.REQ_RANGE, "doc": u"d", "name": u"B",
+			"uid": 2, "start": 0, "end": 100, "flags": 0}))
+		self.assertEqual(len(self.doc.text), 11)
+		self.assertTrue(self.server.is_limited(u"d", time.time()))
+
+
+class CatalogTest(unittest.TestCase):
+	def setUp(self):
+		self.server = Server()
+		self.server.catalog = Catalog(":memory:")
+		self.doc = Document(u"d", persistent=False)
+		self.server.documents[u"d"] = self.doc
+		self.server.catalog.add(self.doc)
+
+	def tearDown(self):
+		self.server.catalog.close()
+		self.server.catalog = None
+
+	def test_authors(self):
+		# Counted by the names they joined with, whatever the operations say.
+		for i in range(10):
+			self.server.handle(commit(i, [u"A", u"B"][i % 2], u"bot#{}".format(i)))
+			self.server.update_doc(self.doc)
+		total, entries = self.server.catalog.list()
+		self.assertEqual(entries[0]["authors"], 2)
+		self.assertEqual(entries[0]["size"], 10)
@@ -0,0 +1,52 @@
+"""
+Tests of the full text snapshots: chunks built as they're sent,
+and written into the mirror as they arrive.
+"""
+import unittest
+
+import ctxt.protocol as cp
+from ctxt.server.snapshot import Snapshot
+from ctxt.shared_document.mirror import Mirror
+
+
+class ChunkedTextTest(unittest.TestCase):
+	def setUp(self):
+		self.size = cp.Protocol.TEXT_CHUNK_SIZE
+		cp.Protocol.TEXT_CHUNK_SIZE = 100
+
+	def tearDown(self):
+		cp.Protocol.TEXT_CHUNK_SIZE = self.size
+
+	def test_chunks(self):
+		text = u"".join(u"line %d \u00e4\u20ac\U0001F600\n" % i for i in range(500))
+		snapshot = Snapshot(u"d", 7, text)
+		frames = snapshot.get_chunks()
+		mirror = Mirror(u"d", "A")
+		mirror.begin_text(7)
+		crc = 0
+		for frame in frames:
+			d = cp.Protocol.unpack(frame)
+			if d["id"] == cp.Protocol.RES_TEXT_END:
+				self.assertEqual(d["checksum"], crc)
+				self.assertEqual(d["version"], 7)
+				break
+			crc = cp.Protocol.checksum(d["text"].encode("utf8"), crc)
+			mirror.append_text(d["text"])
+			# Written as they arrive (not all of them, but at least half).
+			self.assertTrue(text.startswith(mirror.get_text()))
+			self.assertTrue(2 * len(mirror.get_text()) >= d["offset"] + len(d["text"]))
+		self.assertEqual(mirror.end_text(), [])
+		self.assertFalse(mirror.is_loading())
+		self.assertEqual(mirror.get_text(), text)
+		self.assertEqual(mirror.version, 7)
+
+	def test_abort(self):
+		mirror = Mirror(u"d", "A")
+		mirror.begin_text(1)
+		mirror.append_text(u"abc")
+		mirror.abort_text()
+		self.assertEqual(mirror.get_text(), u"")
+		mirror.begin_text(1)
+		mirror.append_text(u"xyz")
+		mirror.end_text()
+		self.assertEqual(mirror.get_text(), u"xyz")
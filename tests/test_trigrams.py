@@ -0,0 +1,56 @@
+"""
+Tests of the trigram counts, kept up to date with the edits.
+"""
+import random
+import unittest
+
+from ctxt.shared_document.document import Document
+from ctxt.shared_document.trigrams import Trigrams, count
+
+
+class TrigramsTest(unittest.TestCase):
+	def setUp(self):
+		self.rng = random.Random(3)
+
+	def random_text(self, n):
+		return u"".join(self.rng.choice(u"abc \n\u00e4") for _ in range(n))
+
+	def test_edits(self):
+		for _ in range(20):
+			doc = Document(u"d", persistent=False)
+			doc.text = self.random_text(self.rng.randint(0, 50))
+			doc.enable_trigrams()
+			doc.get_trigrams().take_changed()
+			for _ in range(100):
+				before = count(doc.text)
+				if self.rng.random() < 0.5 or len(doc.text) == 0:
+					doc.insert(0, self.rng.randint(0, len(doc.text)),
+						self.random_text(self.rng.randint(1, 6)))
+				else:
+					doc.remove(0, self.rng.randint(0, len(doc.text) - 1), self.rng.randint(1, 6))
+				after = count(doc.text)
+				self.assertEqual(doc.get_trigrams().counts, after)
+				# Whatever appeared or vanished is among the changed ones.
+				rebuilt, changed = doc.get_trigrams().take_changed()
+				self.assertFalse(rebuilt)
+				self.assertTrue(set(before).symmetric_difference(after) <= changed)
+
+	def test_counted(self):
+		# The index has the trigrams already: only counted on the first change.
+		doc = Document(u"d", persistent=False)
+		doc.text = u"hello world"
+		doc.enable_trigrams(counted=True)
+		self.assertEqual(doc.trigrams, None)
+		doc.insert(0, 5, u",")
+		rebuilt, changed = doc.get_trigrams().take_changed()
+		self.assertFalse(rebuilt)
+		self.assertTrue(u"o, " in changed and u"o w" in changed)
+		self.assertTrue(doc.get_trigrams().contains(u"lo,"))
+		self.assertFalse(doc.get_trigrams().contains(u"o w"))
+
+	def test_rebuilt(self):
+		trigrams = Trigrams(u"abcd")
+		self.assertEqual(trigrams.take_changed(), (True, set([u"abc", u"bcd"])))
+		trigrams.reset(u"xyz")
+		self.assertEqual(trigrams.take_changed(), (True, set([u"xyz"])))
+		self.assertEqual(trigrams.take_changed(), (False, set()))